@@ -0,0 +1,173 @@
+"""Runs NebuBot as a cluster of processes, each one an AutoShardedBot over a contiguous range of the shards.
+
+Every process has its own event loop, database pool and caches. Clusters are started one after the other once the
+previous one is ready, and restarted when they crash or ask for it with the `cluster restart` command.
+
+    python cluster.py --clusters 2 --shards 8
+    python cluster.py --clusters 2 --stand-in-ipc
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+import sys
+import time
+from typing import List, Optional, Sequence
+
+import aiohttp
+
+from data.cluster import shard_ranges
+from data.models import NebuBot
+
+GATEWAY_BOT_URL = "https://discord.com/api/v10/gateway/bot"
+
+
+async def recommended_shards(token: str) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(GATEWAY_BOT_URL, headers={"Authorization": f"Bot {token}"}) as response:
+            response.raise_for_status()
+            return (await response.json())["shards"]
+
+
+def run_cluster(cluster_id: int, shard_ids: List[int], shard_count: int, cluster_count: int, launched) -> None:
+    from data.cluster import ClusterBot
+    from main import create_bot
+
+    logging.basicConfig(level=logging.INFO, format=f"[cluster {cluster_id}] %(levelname)s %(name)s: %(message)s")
+    bot = create_bot(ClusterBot, cluster_id=cluster_id, cluster_count=cluster_count, launched=launched,
+                     shard_ids=shard_ids, shard_count=shard_count)
+    bot.starter()
+    sys.exit(bot.exit_code)
+
+
+def run_stand_in_ipc(secret_key: str, port: int) -> None:
+    from tools import ipc_server
+
+    args = argparse.Namespace(host="127.0.0.1", port=port, secret_key=secret_key, legacy=False)
+    asyncio.run(ipc_server.main(args))
+
+
+class ClusterProcess:
+    def __init__(self, context, cluster_id: int, shard_ids: List[int], shard_count: int, cluster_count: int):
+        self.context = context
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.cluster_count = cluster_count
+        self.launched = context.Event()
+        self.process: Optional[multiprocessing.Process] = None
+        self.restarts = 0
+
+    def start(self) -> None:
+        self.launched.clear()
+        args = (self.cluster_id, self.shard_ids, self.shard_count, self.cluster_count, self.launched)
+        self.process = self.context.Process(target=run_cluster, args=args, name=f"cluster-{self.cluster_id}")
+        self.process.start()
+        print(f"Cluster {self.cluster_id} started with shards {self.shard_ids} (pid {self.process.pid})")
+
+    def wait_launched(self, timeout: float, stopping) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not stopping() and self.process.is_alive():
+            if self.launched.wait(1):
+                return True
+        return False
+
+    def stop(self, timeout: float = 30) -> None:
+        if self.process is None or not self.process.is_alive():
+            return
+
+        self.process.terminate()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class Launcher:
+    def __init__(self, clusters: List[ClusterProcess], launch_timeout: float, restart_delay: float):
+        self.clusters = clusters
+        self.launch_timeout = launch_timeout
+        self.restart_delay = restart_delay
+        self.stopping = False
+
+    def stop(self, *_) -> None:
+        self.stopping = True
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            for cluster in self.clusters:
+                if self.stopping:
+                    break
+                cluster.start()
+                if not cluster.wait_launched(self.launch_timeout, lambda: self.stopping):
+                    print(f"Cluster {cluster.cluster_id} was not ready in time, starting the next one anyway.")
+            self.supervise()
+        finally:
+            for cluster in self.clusters:
+                cluster.stop()
+
+    def supervise(self) -> None:
+        while not self.stopping:
+            running = 0
+            for cluster in self.clusters:
+                if cluster.process is None:
+                    continue
+
+                exitcode = cluster.process.exitcode
+                if exitcode is None:
+                    running += 1
+                elif exitcode == 0:
+                    print(f"Cluster {cluster.cluster_id} exited.")
+                    cluster.process = None
+                else:
+                    cluster.restarts += 1
+                    print(f"Cluster {cluster.cluster_id} exited with {exitcode}, restart #{cluster.restarts}.")
+                    time.sleep(self.restart_delay)
+                    cluster.start()
+                    running += 1
+            if not running:
+                return
+            time.sleep(1)
+
+
+def parse_args(argv: Sequence[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clusters", type=int, help="processes to run, defaults to the config or 1")
+    parser.add_argument("--shards", type=int, help="total shard count, asks Discord when omitted")
+    parser.add_argument("--launch-timeout", type=float, default=300, help="seconds to wait for a cluster to be ready")
+    parser.add_argument("--restart-delay", type=float, default=5)
+    parser.add_argument("--stand-in-ipc", action="store_true", help="run tools.ipc_server on the configured port")
+    return parser.parse_args(argv)
+
+
+def main(args: argparse.Namespace) -> None:
+    settings = NebuBot.get_config()
+    cluster_settings = settings.get("cluster", {})
+    cluster_count = args.clusters or cluster_settings.get("clusters", 1)
+    shard_count = args.shards or cluster_settings.get("shard_count")
+    if shard_count is None:
+        shard_count = asyncio.run(recommended_shards(settings["token"]))
+    if not 0 < cluster_count <= shard_count:
+        raise SystemExit(f"Cannot split {shard_count} shards into {cluster_count} clusters.")
+
+    context = multiprocessing.get_context("spawn")
+    stand_in = None
+    if args.stand_in_ipc:
+        stand_in = context.Process(target=run_stand_in_ipc, args=(settings["ipc_key"], settings["ipc_port"]),
+                                   name="stand-in-ipc", daemon=True)
+        stand_in.start()
+
+    clusters = [ClusterProcess(context, cluster_id, shard_ids, shard_count, cluster_count)
+                for cluster_id, shard_ids in enumerate(shard_ranges(shard_count, cluster_count))]
+    print(f"Launching {shard_count} shards over {cluster_count} clusters")
+    try:
+        Launcher(clusters, args.launch_timeout, args.restart_delay).run()
+    finally:
+        if stand_in is not None:
+            stand_in.terminate()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -7,9 +7,11 @@ from typing import Union, Optional
 import discord
 from discord.ext import commands
 
-import utils.image_manipulation as im
+from utils.startup import LazyModule
 from utils.useful import Thinking
 
+im = LazyModule("utils.image_manipulation")
+
 
 class ChannelsCog(commands.Cog, name="Channel"):
     def __init__(self, bot):
@@ -124,12 +126,10 @@ class ChannelsCog(commands.Cog, name="Channel"):
 
             user_names = []
             counters = []
+            users = await self.bot.resolve_users([record["user_id"] for record in data], guild_id=ctx.guild.id)
             for record in reversed(data):
                 user_id = record["user_id"]
-                try:
-                    user = await self.bot.resolve_user(user_id, guild_id=ctx.guild.id)
-                except discord.NotFound:
-                    user = user_id or "Unknown User"
+                user = users.get(user_id, user_id or "Unknown User")
                 user_names.append(str(user))
                 counters.append(record["counter"])
 
@@ -0,0 +1,189 @@
+import io
+import time
+from typing import Optional
+
+import discord
+import humanize
+import tabulate
+from discord.ext import commands
+
+from data.cache import cache_report, current_rss
+from data.cluster import ClusterBot
+from data.models import NebuBot
+from utils.profiler import Profile
+from utils.recorder import EventRecorder
+
+
+class DiagnosticsCog(commands.Cog, name="Diagnostics"):
+    """Commands to look into the internals of the bot. Owner only."""
+    def __init__(self, bot: NebuBot):
+        self.bot = bot
+        self.recorder = EventRecorder(bot)
+
+    async def cog_unload(self) -> None:
+        if self.recorder.recording:
+            self.recorder.stop()
+
+    async def cog_check(self, ctx: commands.Context) -> bool:
+        if not await ctx.bot.is_owner(ctx.author):
+            raise commands.NotOwner("You do not own this bot.")
+        return True
+
+    @commands.command(help="Shows the callbacks that blocked the event loop the longest. "
+                           "Pass a rank to see the stack of that callback.")
+    async def loopstats(self, ctx, rank: Optional[int] = None):
+        monitor = self.bot.loop_monitor
+        offenders = monitor.worst_offenders()
+        if rank is not None:
+            if not 0 < rank <= len(offenders):
+                raise commands.BadArgument(f"Rank must be between 1 and {len(offenders)}.")
+
+            offender = offenders[rank - 1]
+            stack = offender.stack[-(4096 - 100):]
+            embed = discord.Embed(title=f"{offender.name} blocked for {offender.duration:.3f}s",
+                                  description=f"```py\n{stack}```", timestamp=offender.occurred_at)
+            return await ctx.send(embed=embed)
+
+        lines = [f"{i}. `{o.name}` **{o.duration:.3f}s** {discord.utils.format_dt(o.occurred_at, 'R')}"
+                 for i, o in enumerate(offenders, start=1)]
+        embed = discord.Embed(title="Slowest event loop callbacks",
+                              description="\n".join(lines) or "Nothing blocked the loop so far.",
+                              color=self.bot.color)
+        embed.set_footer(text=f"Threshold {monitor.threshold}s | Current lag {monitor.last_lag * 1000:.1f}ms")
+        await ctx.send(embed=embed)
+
+    def resolve_target(self, target: str):
+        if command := self.bot.get_command(target):
+            return command.qualified_name, command.callback.__code__
+
+        for listeners in self.bot.extra_events.values():
+            for listener in listeners:
+                if listener.__name__ == target:
+                    return target, listener.__code__
+
+        raise commands.BadArgument(f'No command or listener named "{target}".')
+
+    async def send_profile(self, ctx, profile: Profile, filename: str):
+        total = profile.loop_samples + profile.executor_samples
+        if not total:
+            raise commands.CommandError("No samples were collected.")
+
+        hottest = "\n".join(f"`{count:,}` {label}" for label, count in profile.hottest())
+        embed = discord.Embed(title=f"Profile of {profile.target or 'everything'}", color=self.bot.color)
+        embed.add_field(name="Duration", value=f"{profile.elapsed:.2f}s")
+        embed.add_field(name="Loop samples", value=f"{profile.loop_samples:,} ({profile.loop_samples / total:.0%})")
+        embed.add_field(name="Executor samples",
+                        value=f"{profile.executor_samples:,} ({profile.executor_samples / total:.0%})")
+        embed.add_field(name="Hottest frames", value=hottest[:1024], inline=False)
+        file = discord.File(io.BytesIO(profile.collapsed().encode()), filename=filename)
+        await ctx.send(embed=embed, file=file)
+
+    @commands.command(help="Shows how long each startup phase took, from the start of the process.")
+    async def startup(self, ctx):
+        timeline = self.bot.startup
+        embed = discord.Embed(title="Startup timeline", description=f"```\n{timeline.report()}```",
+                              color=self.bot.color)
+        await ctx.send(embed=embed)
+
+    @commands.command(help="Compares the size of the client caches against the memory of the process.")
+    async def memory(self, ctx):
+        # estimated on the loop, the caches change size while they are walked otherwise
+        report = cache_report(self.bot)
+        rss = current_rss()
+        rows = [(name, f"{entries:,}", humanize.naturalsize(size, binary=True), f"{size / rss:.1%}")
+                for name, entries, size in sorted(report, key=lambda row: row[2], reverse=True)]
+        table = tabulate.tabulate(rows, headers=("Cache", "Entries", "Estimated", "Of RSS"))
+        intents = ", ".join(name for name, enabled in self.bot.intents if enabled)
+        embed = discord.Embed(title=f"Memory ({self.bot.cache_profile} cache profile)",
+                              description=f"```\n{table}```", color=self.bot.color)
+        embed.add_field(name="RSS", value=humanize.naturalsize(rss, binary=True))
+        embed.add_field(name="Message cache", value=f"{self.bot._connection.max_messages or 0:,} messages")
+        embed.add_field(name="Chunking", value="at startup" if self.bot._connection._chunk_guilds else "lazy")
+        embed.add_field(name="Intents", value=intents[:1024], inline=False)
+        await ctx.send(embed=embed)
+
+    @commands.group(invoke_without_command=True,
+                    help="Sampling profiler that sends a collapsed stack file, ready for flamegraph tools.")
+    async def profile(self, ctx):
+        await ctx.send_help(ctx.command)
+
+    @profile.command(name="window", help="Profiles everything running for the given amount of seconds.")
+    async def profile_window(self, ctx, seconds: commands.Range[float, 0.1, 600.0]):
+        if self.bot.profiler.running:
+            raise commands.CommandError("A profile is already running.")
+
+        async with ctx.typing():
+            profile = await self.bot.profiler.run(Profile(), duration=seconds)
+        await self.send_profile(ctx, profile, "profile-window.collapsed")
+
+    @profile.command(name="next", help="Profiles the next invocations of a command or a listener.")
+    async def profile_next(self, ctx, target: str, invocations: commands.Range[int, 1, 1000] = 1,
+                           timeout: commands.Range[float, 1.0, 3600.0] = 300):
+        if self.bot.profiler.running:
+            raise commands.CommandError("A profile is already running.")
+
+        name, code = self.resolve_target(target)
+        await ctx.send(f"Profiling the next {invocations} invocation(s) of `{name}` for up to {timeout:g}s.")
+        profile = await self.bot.profiler.run(Profile(name, code, invocations), duration=timeout)
+        await self.send_profile(ctx, profile, f"profile-{name.replace(' ', '-')}.collapsed")
+
+    @commands.group(invoke_without_command=True,
+                    help="Records the message gateway events into a trace that tools.replay can play back.")
+    async def record(self, ctx):
+        await ctx.send_help(ctx.command)
+
+    @record.command(name="start", help="Starts recording into data/traces.")
+    async def record_start(self, ctx, name: Optional[str] = None):
+        if self.recorder.recording:
+            raise commands.CommandError(f"Already recording into `{self.recorder.path}`.")
+
+        path = self.recorder.start(name)
+        await ctx.send(f"Recording message events into `{path}`.")
+
+    @record.command(name="stop", help="Stops the recording.")
+    async def record_stop(self, ctx):
+        if not self.recorder.recording:
+            raise commands.CommandError("Nothing is being recorded.")
+
+        recorded = self.recorder.recorded
+        path = self.recorder.stop()
+        await ctx.send(f"Recorded {recorded:,} events into `{path}`.")
+
+    @commands.group(invoke_without_command=True, help="Shows the status every cluster broadcast last.")
+    async def cluster(self, ctx):
+        if not isinstance(self.bot, ClusterBot):
+            raise commands.CommandError("The bot is not running as a cluster.")
+
+        self.bot.cluster_statuses[self.bot.cluster_id] = self.bot.cluster_status()
+        rows = []
+        for cluster_id, status in sorted(self.bot.cluster_statuses.items()):
+            latencies = [latency for latency in status["shards"].values() if latency == latency]
+            latency = f"{max(latencies) * 1000:.0f}ms" if latencies else "-"
+            rows.append((cluster_id, ",".join(status["shards"]), status["guilds"], status["users"],
+                         f"{status['max_rss_kb'] / 1024:.0f}MiB", latency, f"{time.time() - status['updated_at']:.0f}s"))
+        table = tabulate.tabulate(rows, headers=("Cluster", "Shards", "Guilds", "Users", "Peak RSS", "Latency", "Age"))
+        missing = self.bot.cluster_count - len(self.bot.cluster_statuses)
+        footer = f"\n{missing} cluster(s) have not reported yet." if missing > 0 else ""
+        await ctx.send(f"```\n{table}```{footer}")
+
+    async def run_cluster_command(self, ctx, action: str, cluster_id: Optional[int] = None, **data):
+        if not isinstance(self.bot, ClusterBot):
+            raise commands.CommandError("The bot is not running as a cluster.")
+
+        received = await self.bot.broadcast_command(action, cluster_id=cluster_id, **data)
+        target = "every cluster" if cluster_id is None else f"cluster {cluster_id}"
+        await ctx.send(f"Sent `{action}` to {target}, {received} connection(s) received it.")
+
+    @cluster.command(name="reload", help="Reloads an extension on every cluster.")
+    async def cluster_reload(self, ctx, extension: str):
+        await self.run_cluster_command(ctx, "reload", extension=extension)
+
+    @cluster.command(name="restart", help="Restarts one cluster, the launcher starts it again.")
+    async def cluster_restart(self, ctx, cluster_id: int):
+        if not 0 <= cluster_id < getattr(self.bot, "cluster_count", 0):
+            raise commands.BadArgument("Unknown cluster.")
+        await self.run_cluster_command(ctx, "restart", cluster_id)
+
+
+async def setup(bot: NebuBot):
+    await bot.add_cog(DiagnosticsCog(bot))
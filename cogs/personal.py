@@ -7,18 +7,34 @@ import itertools
 import operator
 import shlex
 import textwrap
+import time
 import traceback
-from typing import List, Union, Optional
+from typing import List, Literal, Union, Optional, Set, Tuple
 
 import discord
+import humanize
 from discord.ext import commands, tasks
 from discord.ext.menus import ListPageSource
 
-from data.models import NebuBot, ChannelHistoryRead, UserCount
-import utils.image_manipulation as im
+from data.export import EXPORT_QUERY, MessageExport, exported_messages
+from data.ingest import MessageWriter, StoredMessage
+from data.models import NebuBot, ChannelHistoryRead, UserCount, CACHE_ENTRIES, RANKING_SIZE
+from utils import metrics
 from utils.interaction import InteractionPages
+from utils.singleflight import SingleFlight
+from utils.startup import LazyModule
 from utils.useful import Thinking
 
+im = LazyModule("utils.image_manipulation")
+timeline = LazyModule("data.activity")
+
+ON_MESSAGE_SECONDS = metrics.Histogram("nebu_on_message_seconds", "Processing time of a received message.")
+BACKFILL_REMAINING = metrics.Gauge("nebu_backfill_channels_remaining", "Channels left in the current backfill session.")
+BACKFILL_MESSAGES = metrics.Counter("nebu_backfill_messages_total", "Messages stored by the backfill.")
+BACKFILL_RATE = metrics.Gauge("nebu_backfill_messages_per_second", "Backfill rate of the last channel read.")
+CATCH_UP_REMAINING = metrics.Gauge("nebu_catch_up_channels_remaining", "Channels left to catch up after downtime.")
+CATCH_UP_MESSAGES = metrics.Counter("nebu_catch_up_messages_total", "Messages stored by the catch up.")
+
 
 class BoolOpr:
     value = None
@@ -74,13 +90,52 @@ class PersonalCog(commands.Cog, name="Personal"):
         self.bot = bot
         self.channel_reader = {}
         self.user_counter = {}
+        self.channel_loads = SingleFlight("channel_reader")
+        self.user_loads = SingleFlight("user_counter")
+        self.writer = MessageWriter(bot)
         self.CHANNEL_LIMIT = 1000
+        self.BACKFILL_PAGE = 100
+        self.BACKFILL_QUEUE = 2
+        self.HOT_USER_DAYS = 7
+        self.HOT_USER_LIMIT = 5000
+        self.CATCH_UP_CONCURRENCY = 8
+        self.CATCH_UP_PAGE = 100
+        self.EXPORT_PART_SIZE = 8 * 1024 * 1024
+        self.EXPORT_BATCH = 500
+        self.ACTIVITY_DAYS = 365
+        self.unflushed_channels = {}
+        # live messages leave the position of these channels alone, the gap before them isn't read yet
+        self.awaiting_catch_up = False
+        self.catching_up_channels = set()
+        self._preloading = None
+        self._catching_up = None
+        self._backfilling_guilds = None
 
     async def cog_load(self) -> None:
+        CACHE_ENTRIES.set_function(lambda: len(self.channel_reader), cache="channel_reader")
+        CACHE_ENTRIES.set_function(lambda: len(self.user_counter), cache="user_counter")
+        self.bot.cache_bus.register("channel_reader", invalidate=lambda key: self.channel_reader.pop(key, None),
+                                    clear=self.channel_reader.clear)
+        self.bot.cache_bus.register("user_counter", invalidate=lambda key: self.user_counter.pop(key, None),
+                                    clear=self.user_counter.clear, apply_delta=self.apply_count_delta)
+        self._preloading = asyncio.create_task(self.preload_users())
+        self.flush_newest_read.start()
         if not self.bot.tester:
             self.reader_channels.start()
 
     async def cog_unload(self) -> None:
+        CACHE_ENTRIES.remove(cache="channel_reader")
+        CACHE_ENTRIES.remove(cache="user_counter")
+        self.bot.cache_bus.unregister("channel_reader")
+        self.bot.cache_bus.unregister("user_counter")
+        if self._preloading:
+            self._preloading.cancel()
+        if self._catching_up:
+            self._catching_up.cancel()
+        if self._backfilling_guilds:
+            self._backfilling_guilds.cancel()
+        self.flush_newest_read.cancel()
+        await self.flush_newest_read()
         if not self.bot.tester:
             self.reader_channels.stop()
 
@@ -93,120 +148,350 @@ class PersonalCog(commands.Cog, name="Personal"):
     async def before_reading(self):
         await self.bot.wait_until_ready()
 
-    async def gather_readable_channel(self):
-        for channel in self.bot.get_all_channels():
-            if not isinstance(channel, discord.TextChannel):
-                continue
-
-            if not channel.permissions_for(channel.guild.me).read_message_history:
-                continue
+    async def readable_channels(self) -> List[discord.TextChannel]:
+        channels = [
+            channel for channel in self.bot.get_all_channels()
+            if isinstance(channel, discord.TextChannel)
+            and channel.permissions_for(channel.guild.me).read_message_history
+        ]
+        await self.hydrate_channels([channel.id for channel in channels if channel.id not in self.channel_reader])
+        return channels
 
+    async def gather_readable_channel(self):
+        for channel in await self.readable_channels():
             read_channel = await self.acquire_channel(channel.id)
             if read_channel.fully_read:
                 continue
 
             yield channel, read_channel
 
-    async def save_read(self, messages: List[discord.Message]):
-        tasks = [asyncio.create_task(self.save_message_handler(message)) for message in messages]
-        await asyncio.gather(*tasks)
+    async def save_read(self, messages: List[StoredMessage], *, source: str = "backfill") -> Optional[Set[int]]:
+        try:
+            return await self.writer.write(messages, source=source)
+        except Exception:
+            traceback.print_exc()
 
-    async def save_message_handler(self, message: discord.Message):
+    async def save_message_handler(self, message: discord.Message) -> Optional[Set[int]]:
         try:
-            await self.save_message(message)
+            return await self.writer.write([message], source="live")
         except Exception:
             traceback.print_exc()
 
+    def advance_channel(self, read_channel: ChannelHistoryRead, messages: List[Union[discord.Message, StoredMessage]]):
+        if messages and read_channel.advance(max(message.id for message in messages)):
+            self.unflushed_channels[read_channel.channel_id] = read_channel
+
+    @tasks.loop(seconds=30)
+    async def flush_newest_read(self):
+        """Persists the newest stored message of the channels that moved, in one batch."""
+        channels, self.unflushed_channels = self.unflushed_channels, {}
+        values = [(channel_id, channel.newest_read) for channel_id, channel in channels.items()]
+        if not values:
+            return
+
+        query = "UPDATE channel_count SET newest_read=GREATEST(COALESCE(newest_read, 0), $2) WHERE channel_id=$1"
+        try:
+            await self.bot.pool_pg.lane("backfill").executemany(query, values)
+        except Exception:
+            self.unflushed_channels = {**channels, **self.unflushed_channels}
+            traceback.print_exc()
+
     async def delete_message(self, message_id: int):
         message_query = "DELETE FROM user_messages WHERE message_id=$1"
         embed_query = "SELECT * FROM user_embeds WHERE message_id=$1"
-        executor = self.bot.pool_pg.execute
-        for embed_record in await self.bot.pool_pg.fetch(embed_query, message_id):
+        pool = self.bot.pool_pg.lane("ingestion")
+        executor = pool.execute
+        for embed_record in await pool.fetch(embed_query, message_id):
             embed_field_query = "DELETE FROM embed_fields WHERE embed_id=$1"
             await executor(embed_field_query, embed_record["embed_id"])
 
         await executor(message_query, message_id)
         await executor("DELETE FROM user_embeds WHERE message_id=$1", message_id)
 
-    async def save_embed(self, message_id: int, embed: discord.Embed):
-        embed_query = "INSERT INTO user_embeds VALUES(DEFAULT, $1, $2, $3, $4, $5, $6, $7) RETURNING embed_id"
-        footer = embed.footer.text
-        has_thumb = bool(embed.thumbnail.url)
-        color = getattr(embed.color, "value", None)
-        author = embed.author.name
-        embed_values = (message_id, embed.title, embed.description, footer, has_thumb, color, author)
-        embed_id = await self.bot.pool_pg.fetchval(embed_query, *embed_values)
-        if not embed.fields:
-            return
-
-        fields = [(embed_id, i, field.name, field.value) for i, field in enumerate(embed.fields)]
-        field_query = "INSERT INTO embed_fields VALUES($1, $2, $3, $4)"
-        await self.bot.pool_pg.executemany(field_query, fields)
-
-    async def save_message(self, message: discord.Message):
-        message_query = "INSERT INTO user_messages VALUES($1, $2, $3, $4, $5)"
-        message_values = (message.id, message.author.id, message.channel.id, message.content, len(message.attachments))
-        await self.bot.pool_pg.execute(message_query, *message_values)
-        for embed in message.embeds:
-            await self.save_embed(message.id, embed)
-
     async def reading_session(self):
+        readable = [pair async for pair in self.gather_readable_channel()]
+        BACKFILL_REMAINING.set(len(readable))
+        by_shard = collections.defaultdict(list)
+        for channel, read_channel in readable:
+            by_shard[channel.guild.shard_id].append((channel, read_channel))
+
+        # shards have their own gateway connection and guilds, the backfill of each one runs side by side.
+        channel_read = sum(await asyncio.gather(*(self.read_channels(pairs) for pairs in by_shard.values())))
+        print("I've read", channel_read, "channels")
+        if not channel_read:
+            await asyncio.sleep(10 * 60)
+
+    async def read_channels(self, readable: List[Tuple[discord.TextChannel, ChannelHistoryRead]]) -> int:
         channel_read = 0
-        async for channel, read_channel in self.gather_readable_channel():
+        for channel, read_channel in readable:
             channel_read += 1
             print("Reading", channel)
-            iterator = channel.history(limit=self.CHANNEL_LIMIT, before=read_channel.furthest_read)
-            messages = [message async for message in iterator]
-            await self.save_read(messages)
-            size = len(messages)
+            start = time.perf_counter()
+            size, last_message = await self.stream_channel(channel, read_channel)
+            BACKFILL_RATE.set(size / (time.perf_counter() - start))
+            BACKFILL_REMAINING.dec()
             final_message = size < self.CHANNEL_LIMIT
-            last_message = messages[-1] if size else None
             if last_message:
                 query = "UPDATE channel_count SET fully_read=$1, furthest_read=$2 WHERE channel_id=$3 RETURNING *"
-                await self.bot.pool_pg.fetch(query, final_message, last_message.created_at, channel.id)
+                await self.bot.pool_pg.lane("backfill").fetch(query, final_message, last_message.created_at, channel.id)
                 read_channel.furthest_read = last_message.created_at
             else:
                 query = "UPDATE channel_count SET fully_read=$1 WHERE channel_id=$2 RETURNING *"
-                await self.bot.pool_pg.fetch(query, final_message, channel.id)
+                await self.bot.pool_pg.lane("backfill").fetch(query, final_message, channel.id)
             read_channel.fully_read = final_message
+            self.bot.cache_bus.invalidate("channel_reader", channel.id)
+        return channel_read
+
+    async def stream_channel(self, channel: discord.TextChannel,
+                             read_channel: ChannelHistoryRead) -> Tuple[int, Optional[StoredMessage]]:
+        """Reads up to `CHANNEL_LIMIT` older messages of a channel, writing each page while the next one is fetched.
+
+        Pages are handed to the writer as `StoredMessage` through a queue of `BACKFILL_QUEUE` pages, the fetched
+        messages are released once converted. Returns how many messages were read and the oldest of them.
+        """
+        pages = asyncio.Queue(self.BACKFILL_QUEUE)
+
+        async def write():
+            while (page := await pages.get()) is not None:
+                if await self.save_read(page) is not None:
+                    self.advance_channel(read_channel, page)
+                BACKFILL_MESSAGES.inc(len(page))
+
+        async def hand_over(page):
+            put = asyncio.ensure_future(pages.put(page))
+            await asyncio.wait((put, writer), return_when=asyncio.FIRST_COMPLETED)
+            if not put.done():
+                # nothing reads the queue anymore, the writer's error is raised instead of waiting forever
+                put.cancel()
+                writer.result()
+                raise RuntimeError(f"The backfill writer of {channel} stopped")
+
+        writer = asyncio.create_task(write())
+        size, page, last_message = 0, [], None
+        try:
+            async for message in channel.history(limit=self.CHANNEL_LIMIT, before=read_channel.furthest_read):
+                last_message = StoredMessage.of(message)
+                page.append(last_message)
+                size += 1
+                if len(page) >= self.BACKFILL_PAGE:
+                    await hand_over(page)
+                    page = []
+            if page:
+                await hand_over(page)
+            await hand_over(None)
+            await writer
+        finally:
+            writer.cancel()
+        return size, last_message
+
+    @commands.Cog.listener("on_ready")
+    async def catch_up_on_ready(self):
+        # READY is only received again after a new session, resumed sessions replay the events they missed
+        if self.bot.tester or (self._catching_up and not self._catching_up.done()):
+            return
+        self.awaiting_catch_up = True
+        self._catching_up = asyncio.create_task(self.catch_up())
 
-        print("I've read", channel_read, "channels")
-        if not channel_read:
-            await asyncio.sleep(10 * 60)
+    @commands.Cog.listener("on_ready")
+    async def backfill_guilds_on_ready(self):
+        if self.bot.tester or self._backfilling_guilds:
+            return
+        self._backfilling_guilds = asyncio.create_task(self.backfill_guild_ids())
+
+    async def backfill_guild_ids(self) -> None:
+        """Fills the guild_id of counters stored before the column existed, one guild at a time.
+
+        Counters of channels the bot can't see stay NULL, they get their guild on their next update.
+        """
+        query = "UPDATE user_message SET guild_id=$1 WHERE guild_id IS NULL AND channel_id = ANY($2::bigint[])"
+        pool = self.bot.pool_pg.lane("backfill")
+        for guild in self.bot.guilds:
+            try:
+                await pool.execute(query, guild.id, [channel.id for channel in guild.channels])
+            except Exception:
+                traceback.print_exc()
+                return
+
+    def holds_position(self, channel_id: int) -> bool:
+        return self.awaiting_catch_up or channel_id in self.catching_up_channels
+
+    async def catch_up(self):
+        """Reads forward from the newest stored message of every channel that moved while the bot was offline.
+
+        The most recently active channels are read first, `CATCH_UP_CONCURRENCY` at a time. Each page is stored as it
+        arrives and the channel position moves with it, so an interrupted catch up resumes where it stopped.
+        Live messages don't move the position of a channel until its catch up is done, a channel that failed keeps
+        its position for the next catch up.
+        """
+        self.awaiting_catch_up = True
+        try:
+            behind = await self.plan_catch_up()
+        finally:
+            self.awaiting_catch_up = False
+        CATCH_UP_REMAINING.set(len(behind))
+        queue = asyncio.Queue()
+        for entry in behind:
+            queue.put_nowait(entry)
+
+        async def worker():
+            while not queue.empty():
+                channel, after, until = queue.get_nowait()
+                try:
+                    await self.catch_up_channel(channel, after, until)
+                except Exception as e:
+                    print(f"Failed to catch up {channel}:", repr(e))
+                else:
+                    self.catching_up_channels.discard(channel.id)
+                CATCH_UP_REMAINING.dec()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(min(self.CATCH_UP_CONCURRENCY, len(behind)))))
+        await self.flush_newest_read()
+        if behind:
+            print(f"Caught up {len(behind)} channels in {time.perf_counter() - start:.1f}s")
+
+    async def plan_catch_up(self) -> List[Tuple[discord.TextChannel, int, int]]:
+        """The channels behind as `(channel, newest stored, newest sent)`, taken together before anything is read."""
+        channels = await self.readable_channels()
+        states = {channel.id: await self.acquire_channel(channel.id) for channel in channels}
+        if unknown := [channel_id for channel_id, state in states.items() if state.newest_read is None]:
+            # rows written before newest_read existed, their newest stored message is in user_messages
+            query = "SELECT channel_id, MAX(message_id) AS newest FROM user_messages " \
+                    "WHERE channel_id = ANY($1::bigint[]) GROUP BY channel_id"
+            for record in await self.bot.pool_pg.lane("backfill").fetch(query, unknown):
+                states[record["channel_id"]].advance(record["newest"])
+
+        behind = [
+            (channel, newest, channel.last_message_id) for channel in channels
+            if (newest := states[channel.id].newest_read) is not None
+            and channel.last_message_id is not None and channel.last_message_id > newest
+        ]
+        behind.sort(key=lambda entry: entry[2], reverse=True)
+        self.catching_up_channels.update(channel.id for channel, _, _ in behind)
+        return behind
+
+    async def catch_up_channel(self, channel: discord.TextChannel, after: int, until: int):
+        read_channel = await self.acquire_channel(channel.id)
+        # messages after `until` arrive through on_message
+        iterator = channel.history(limit=None, after=discord.Object(after), before=discord.Object(until + 1),
+                                   oldest_first=True)
+        page = []
+        async for message in iterator:
+            page.append(StoredMessage.of(message))
+            if len(page) >= self.CATCH_UP_PAGE:
+                await self.store_caught_up(read_channel, page)
+                page = []
+        await self.store_caught_up(read_channel, page)
+
+    async def store_caught_up(self, read_channel: ChannelHistoryRead, messages: List[StoredMessage]):
+        if (inserted := await self.save_read(messages, source="catch_up")) is None:
+            raise RuntimeError(f"Could not store the messages of channel {read_channel.channel_id}")
+
+        CATCH_UP_MESSAGES.inc(len(inserted))
+        self.advance_channel(read_channel, messages)
+        # counted the same way on_message would have
+        counts = collections.Counter((m.author_id, m.channel_id) for m in messages if m.id in inserted)
+        for (user_id, channel_id), counter in counts.items():
+            await self.count_messages(user_id, channel_id, counter)
+
+    async def hydrate_channels(self, channel_ids: List[int]) -> None:
+        """Loads the read state of many channels in one query, the missing rows are created in one more."""
+        if not channel_ids:
+            return
+
+        query = "SELECT * FROM channel_count WHERE channel_id = ANY($1::bigint[])"
+        records = await self.bot.pool_pg.lane("backfill").fetch(query, channel_ids)
+        if missing := set(channel_ids).difference(record["channel_id"] for record in records):
+            # rows created in the meantime by on_message are not returned, acquire_channel picks those up.
+            query = "INSERT INTO channel_count(channel_id) SELECT unnest($1::bigint[]) ON CONFLICT DO NOTHING " \
+                    "RETURNING *"
+            records += await self.bot.pool_pg.lane("backfill").fetch(query, list(missing))
+
+        for record in records:
+            self.channel_reader.setdefault(record["channel_id"], ChannelHistoryRead.from_database(record))
+
+    async def preload_users(self) -> None:
+        """Loads the counters of the users that talked recently, in one query."""
+        since = discord.utils.utcnow() - datetime.timedelta(days=self.HOT_USER_DAYS)
+        query = "SELECT * FROM user_message WHERE user_id IN (" \
+                "SELECT user_id FROM user_messages WHERE message_id > $1 " \
+                "GROUP BY user_id ORDER BY MAX(message_id) DESC LIMIT $2) " \
+                "ORDER BY user_id"
+        try:
+            since_id = discord.utils.time_snowflake(since)
+            records = await self.bot.pool_pg.lane("backfill").fetch(query, since_id, self.HOT_USER_LIMIT)
+        except Exception:
+            traceback.print_exc()
+            return
+
+        for user_id, user_records in itertools.groupby(records, key=operator.itemgetter("user_id")):
+            # counters loaded by on_message while this ran are newer
+            self.user_counter.setdefault(user_id, UserCount.from_database(self.bot, user_records))
 
     async def acquire_channel(self, channel_id: int) -> ChannelHistoryRead:
         if channel := self.channel_reader.get(channel_id):
             return channel
 
-        raw = await self.bot.pool_pg.fetchrow("SELECT * FROM channel_count WHERE channel_id=$1", channel_id)
+        return await self.channel_loads.load(channel_id, lambda: self.load_channel(channel_id))
+
+    async def load_channel(self, channel_id: int) -> ChannelHistoryRead:
+        pool = self.bot.pool_pg.lane("ingestion")
+        raw = await pool.fetchrow("SELECT * FROM channel_count WHERE channel_id=$1", channel_id)
         if raw is None:
-            query = "INSERT INTO channel_count(channel_id) VALUES($1) RETURNING *"
-            raw = await self.bot.pool_pg.fetchrow(query, channel_id)
+            query = "INSERT INTO channel_count(channel_id) VALUES($1) ON CONFLICT DO NOTHING RETURNING *"
+            raw = await pool.fetchrow(query, channel_id) or \
+                await pool.fetchrow("SELECT * FROM channel_count WHERE channel_id=$1", channel_id)
 
         assert raw is not None
-        channel = ChannelHistoryRead.from_database(raw)
-        self.channel_reader.update({channel_id: channel})
-        return channel
+        # hydrate_channels may have stored it in the meantime
+        return self.channel_reader.setdefault(channel_id, ChannelHistoryRead.from_database(raw))
 
     async def acquire_user(self, user_id: int) -> UserCount:
         if user_count := self.user_counter.get(user_id):
             return user_count
 
-        raw = await self.bot.pool_pg.fetch("SELECT * FROM user_message WHERE user_id=$1", user_id)
+        return await self.user_loads.load(user_id, lambda: self.load_user(user_id))
+
+    async def load_user(self, user_id: int) -> UserCount:
+        raw = await self.bot.pool_pg.lane("ingestion").fetch("SELECT * FROM user_message WHERE user_id=$1", user_id)
         if not raw:
             user_count = UserCount.empty_record(self.bot, user_id)
         else:
             user_count = UserCount.from_database(self.bot, raw)
 
-        self.user_counter.update({user_id: user_count})
-        return user_count
+        # preload_users may have stored it in the meantime
+        return self.user_counter.setdefault(user_id, user_count)
+
+    async def rank_channels(self, user_id: int, guild: discord.Guild) -> List[Tuple[int, int]]:
+        """The channels of a guild a user talked the most in, highest first, without loading their other guilds."""
+        if user_count := self.user_counter.get(user_id):
+            return user_count.top_channels(guild.id)
+
+        # rows that backfill_guild_ids hasn't reached yet are matched by the guild's channels
+        query = "SELECT channel_id, counter FROM user_message WHERE user_id=$1 " \
+                "AND (guild_id=$2 OR guild_id IS NULL AND channel_id = ANY($4::bigint[])) " \
+                "ORDER BY counter DESC LIMIT $3"
+        channel_ids = [channel.id for channel in guild.channels]
+        records = await self.bot.pool_pg.fetch(query, user_id, guild.id, RANKING_SIZE, channel_ids)
+        return [(record["channel_id"], record["counter"]) for record in records]
 
     @commands.Cog.listener("on_message")
     async def message_counter(self, message: discord.Message):
-        await self.acquire_channel(message.channel.id)
-        await self.save_message_handler(message)
-        user_count = await self.acquire_user(message.author.id)
-        await user_count.update_channel(message.channel.id)
+        with ON_MESSAGE_SECONDS.time():
+            read_channel = await self.acquire_channel(message.channel.id)
+            if await self.save_message_handler(message) is not None and not self.holds_position(message.channel.id):
+                self.advance_channel(read_channel, [message])
+            await self.count_messages(message.author.id, message.channel.id)
+
+    async def count_messages(self, user_id: int, channel_id: int, counter: int = 1):
+        user_count = await self.acquire_user(user_id)
+        total = await user_count.update_channel(channel_id, counter=counter)
+        # the other processes that cache this user count it too
+        self.bot.cache_bus.add_delta("user_counter", user_id, channel_id, counter, total)
+
+    def apply_count_delta(self, user_id: int, channel_id: int, counter: int, total: int):
+        if user_count := self.user_counter.get(user_id):
+            user_count.add_delta(channel_id, counter, total)
 
     @commands.Cog.listener("on_raw_message_delete")
     async def message_raw_delete(self, payload: discord.RawMessageDeleteEvent):
@@ -234,21 +519,23 @@ class PersonalCog(commands.Cog, name="Personal"):
         await self.edit_message(message)
 
     async def edit_message(self, message: discord.Message):
-        if not await self.bot.pool_pg.fetchrow("SELECT * FROM user_messages WHERE message_id=$1", message.id):
-            return await self.save_message(message)
+        pool = self.bot.pool_pg.lane("ingestion")
+        if not await pool.fetchrow("SELECT * FROM user_messages WHERE message_id=$1", message.id):
+            return await self.writer.write([message], source="edit")
 
-        executor = self.bot.pool_pg.execute
+        executor = pool.execute
         message_query = "UPDATE user_messages SET content=$1, attachment_count=$2 WHERE message_id=$3"
         message_values = (message.content, len(message.attachments), message.id)
         await executor(message_query, *message_values)
         embed_query = "SELECT * FROM user_embeds WHERE message_id=$1"
-        for embed_record in await self.bot.pool_pg.fetch(embed_query, message.id):
+        for embed_record in await pool.fetch(embed_query, message.id):
             embed_field_query = "DELETE FROM embed_fields WHERE embed_id=$1"
             await executor(embed_field_query, embed_record["embed_id"])
 
         await executor("DELETE FROM user_embeds WHERE message_id=$1", message.id)
-        for embed in message.embeds:
-            await self.save_embed(message.id, embed)
+        if message.embeds:
+            async with pool.acquire() as con:
+                await self.writer.write_embeds(con, message.id, message.embeds)
 
     def _parse_query(self, content):
         _bool_opr = {"OR": OrOpr, "AND": AndOpr}
@@ -322,6 +609,35 @@ class PersonalCog(commands.Cog, name="Personal"):
             raise commands.BadArgument(f"No {ctx.author} message found with `{value}` in {channel}")
         await InteractionPages(MessageView(rows, parsed.raw_values)).start(ctx)
 
+    @commands.command(help="Sends you every stored message of yours in direct messages, as gzip compressed NDJSON or "
+                           "CSV files. Large histories are split into several files.")
+    @commands.max_concurrency(1, commands.BucketType.user)
+    async def export(self, ctx, fmt: Literal["ndjson", "csv"] = "ndjson"):
+        export = MessageExport(fmt, name=f"messages-{ctx.author.id}", part_size=self.EXPORT_PART_SIZE)
+        async with Thinking(ctx.channel) as think:
+            # read in batches of messages by id on the backfill lane, no connection or transaction is held while a
+            # part is sent, and it never holds more than one file part
+            after = 0
+            while rows := await self.bot.pool_pg.lane("backfill").fetch(EXPORT_QUERY, ctx.author.id, after,
+                                                                        self.EXPORT_BATCH):
+                after = rows[-1]["message_id"]
+                for message in exported_messages(rows):
+                    if part := export.write(message):
+                        await self.send_export(ctx, part)
+            if part := export.finish():
+                await self.send_export(ctx, part)
+            if export.messages:
+                think.set(content=f"Sent `{export.messages:,}` messages in {export.parts} file(s) to your direct "
+                                  f"messages.")
+        if not export.messages:
+            raise commands.CommandError("There are no messages of yours stored.")
+
+    async def send_export(self, ctx, part: discord.File):
+        try:
+            await ctx.author.send(file=part)
+        except discord.Forbidden:
+            raise commands.CommandError("I can't send you direct messages.") from None
+
     @commands.command(help="The total messages for a user in a specified channel. Defaults to current channel.")
     async def totalmessages(self, ctx, channel: discord.TextChannel = commands.param(
         converter=discord.TextChannel, default=lambda ctx: ctx.channel, displayed_default="Current Channel"
@@ -346,16 +662,16 @@ class PersonalCog(commands.Cog, name="Personal"):
     @commands.command(help="Shows a graph of how active you are in the server.")
     async def mostactive(self, ctx, user: Union[discord.Member, discord.User] = None):
         user = user or ctx.author
-        user_count = await self.acquire_user(user.id)
-        channels = ctx.guild.text_channels
         ChannelCount = collections.namedtuple("ChannelCount", "channel count")
-        counters = [ChannelCount(c, user_count.get_count(c.id)) for c in channels]
-        counter_get = operator.attrgetter("count")
-        if not any(map(counter_get, counters)):
+        counters = []
+        for channel_id, count in await self.rank_channels(user.id, ctx.guild):
+            if count and isinstance(channel := ctx.guild.get_channel(channel_id), discord.TextChannel):
+                counters.append(ChannelCount(channel, count))
+        if not counters:
             raise commands.CommandError("This user has no data.")
 
-        counters.sort(key=counter_get, reverse=True)
-        counters = sorted(filter(counter_get, counters[:5]), key=counter_get)
+        # the chart goes from the lowest to the highest
+        counters = counters[:5][::-1]
         async with ctx.typing():
             avatar_bytes = io.BytesIO(await user.display_avatar.read())
             color = major = await im.get_majority_color(avatar_bytes)
@@ -376,6 +692,47 @@ class PersonalCog(commands.Cog, name="Personal"):
         embed.set_image(url="attachment://" + file.filename)
         await ctx.send(embed=embed, file=file)
 
+    @commands.command(help="Shows a timeline of the messages of a user, a channel or the whole server over the last "
+                           "year. Defaults to you.")
+    @commands.guild_only()
+    async def activity(self, ctx, target: Union[Literal["server"], discord.TextChannel, discord.Member,
+                                                discord.User] = commands.Author):
+        channel_ids = [channel.id for channel in ctx.guild.text_channels]
+        since = discord.utils.utcnow() - datetime.timedelta(days=self.ACTIVITY_DAYS)
+        since_id = discord.utils.time_snowflake(since)
+        if target == "server":
+            name, where, args = ctx.guild.name, "channel_id = ANY($1::bigint[])", [channel_ids]
+        elif isinstance(target, discord.TextChannel):
+            name, where, args = target.mention, "channel_id=$1", [target.id]
+        else:
+            name, where, args = str(target), "user_id=$1 AND channel_id = ANY($2::bigint[])", [target.id, channel_ids]
+        query = f"SELECT message_id FROM user_messages WHERE {where} AND message_id > ${len(args) + 1}"
+
+        async with ctx.typing():
+            # the ids come as one binary buffer, read as an array without a record per message
+            buffer = timeline.IdBuffer()
+            async with self.bot.pool_pg.acquire() as con:
+                await con.copy_from_query(query, *args, since_id, output=buffer, format="binary")
+            ids = buffer.ids()
+            if not len(ids):
+                raise commands.CommandError(f"There are no messages of {name} in the last {self.ACTIVITY_DAYS} days.")
+
+            edges, counts, width = timeline.bin_times(timeline.snowflake_times(ids))
+            if len(counts) < 2:
+                raise commands.CommandError(f"The messages of {name} are too close together to make a timeline.")
+
+            color = discord.Color(ctx.bot.color)
+            # create_graph takes the values from the newest
+            graph = await im.create_graph(edges.astype(datetime.datetime), counts[::-1].tolist(), color=color,
+                                          smooth=len(counts) > 2, label="Messages")
+            file = discord.File(graph, filename="activity.png")
+
+        embed = discord.Embed(title=f"Activity of {name}", color=color,
+                              description=f"`{len(ids):,}` messages in the last {self.ACTIVITY_DAYS} days, in bins "
+                                          f"of {humanize.precisedelta(width)}.")
+        embed.set_image(url="attachment://" + file.filename)
+        await ctx.send(embed=embed, file=file)
+
 
 async def setup(bot: NebuBot):
     await bot.add_cog(PersonalCog(bot))
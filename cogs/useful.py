@@ -1,26 +1,93 @@
+import re
+from typing import Tuple
+
+import asyncpg
 import discord
 import tabulate
 from discord.ext import commands
 
 from utils.interaction import pages, InteractionPages
+from utils.menus import CursorPageSource
+
+READ_STATEMENTS = ("select", "values", "table")
+WRITE_STATEMENTS = ("insert", "update", "delete", "merge")
+ROW_STATEMENTS = ("show", "explain")
+SQL_TOKEN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|\w+|[(),]", re.S)
+
+
+def main_statement(query: str) -> Tuple[int, str, bool]:
+    """Where the statement after the CTEs of a leading WITH starts, its first keyword and whether a CTE writes."""
+    tokens = [(m.start(), m.group().lower()) for m in SQL_TOKEN.finditer(query) if not m.group().startswith(("--", "/*"))]
+    if not tokens or tokens[0][1] != "with":
+        return 0, tokens[0][1] if tokens else "", False
+
+    index, writes = 1, False
+    if index < len(tokens) and tokens[index][1] == "recursive":
+        index += 1
+    while index < len(tokens):
+        # name [(columns)] AS [NOT MATERIALIZED] (body)
+        while index < len(tokens) and tokens[index][1] != "as":
+            index += 1
+        while index < len(tokens) and tokens[index][1] != "(":
+            index += 1
+        if index + 1 < len(tokens):
+            writes = writes or tokens[index + 1][1] in WRITE_STATEMENTS
+        depth = 0
+        while index < len(tokens):
+            depth += {"(": 1, ")": -1}.get(tokens[index][1], 0)
+            index += 1
+            if depth == 0:
+                break
+        if index < len(tokens) and tokens[index][1] == ",":
+            index += 1
+        elif index < len(tokens):
+            return tokens[index][0], tokens[index][1], writes
+    return len(query), "", writes
 
 
 class UsefulCog(commands.Cog, name="Useful"):
     def __init__(self, bot):
         self.bot = bot
+        self.SQL_TIMEOUT = 10
+        self.SQL_MAX_ROWS = 1000
+        self.PLAN_PAGE_SIZE = 1900
 
     @commands.command()
     async def uptime(self, ctx):
         await ctx.send(discord.utils.format_dt(self.bot.uptime, style='R'))
 
-    @commands.command()
+    @commands.group(invoke_without_command=True)
     @commands.is_owner()
     async def sql(self, ctx, *, query):
-        to_run = query
+        to_run = query.strip().rstrip(";")
+        start, keyword, cte_writes = main_statement(to_run)
+        read = keyword in READ_STATEMENTS and not cte_writes
+        if read:
+            # reads are paged through a cursor, only the rows of the pages that are viewed are fetched
+            source = CursorPageSource(self.bot.pool_pg, to_run, max_rows=self.SQL_MAX_ROWS, timeout=self.SQL_TIMEOUT)
+            try:
+                await source.open()
+                if not source.pages:
+                    return await ctx.maybe_reply("No rows.")
+                menu = InteractionPages(source)
+                await menu.start(ctx)
+                await menu.wait()
+                return
+            except asyncpg.ReadOnlySQLTransactionError:
+                # reads that call functions with side effects like nextval or setval run as statements
+                pass
+            except Exception as e:
+                raise commands.CommandError(str(e))
+            finally:
+                await source.close()
+
         method = fetch = self.bot.pool_pg.fetch
-        if to_run.lower().startswith(("insert", "update", "delete", "create", "drop")):
-            if "returning" not in to_run.lower():
-                method = self.bot.pool_pg.execute
+        if read or re.search(r"\breturning\b", to_run, re.I):
+            # the returned rows are capped by the database, a RETURNING statement itself still runs in full
+            ctes = f"{to_run[:start].rstrip()}," if start else "WITH"
+            to_run = f"{ctes} returned AS ({to_run[start:]}) SELECT * FROM returned LIMIT {self.SQL_MAX_ROWS}"
+        elif keyword not in ROW_STATEMENTS:
+            method = self.bot.pool_pg.execute
 
         @pages(per_page=8)
         async def tabulation(self, menu, entries):
@@ -35,7 +102,7 @@ class UsefulCog(commands.Cog, name="Useful"):
             return f"```py\n{table}```"
 
         try:
-            rows = await method(to_run)
+            rows = await method(to_run, timeout=self.SQL_TIMEOUT)
             if method is fetch:
                 menu = InteractionPages(tabulation(rows))
                 await menu.start(ctx)
@@ -44,7 +111,38 @@ class UsefulCog(commands.Cog, name="Useful"):
         except Exception as e:
             raise commands.CommandError(str(e))
 
+    @sql.command(name="plan")
+    @commands.is_owner()
+    async def sql_plan(self, ctx, *, query):
+        """Runs the query under EXPLAIN (ANALYZE, BUFFERS) and shows the plan, anything it wrote is rolled back."""
+        @pages(per_page=1)
+        async def plan_pages(self, menu, entry):
+            return f"```\n{entry}```"
+
+        try:
+            async with self.bot.pool_pg.acquire() as con:
+                transaction = con.transaction()
+                await transaction.start()
+                try:
+                    rows = await con.fetch(f"EXPLAIN (ANALYZE, BUFFERS) {query}", timeout=self.SQL_TIMEOUT)
+                finally:
+                    await transaction.rollback()
+        except Exception as e:
+            raise commands.CommandError(str(e))
+
+        chunks, chunk = [], ""
+        for row in rows:
+            # lines longer than a page are split across pages
+            for start in range(0, max(len(row[0]), 1), self.PLAN_PAGE_SIZE):
+                line = row[0][start:start + self.PLAN_PAGE_SIZE]
+                if chunk and len(chunk) + len(line) >= self.PLAN_PAGE_SIZE:
+                    chunks.append(chunk)
+                    chunk = ""
+                chunk += line + "\n"
+        if chunk:
+            chunks.append(chunk)
+        await InteractionPages(plan_pages(chunks)).start(ctx)
+
 
 async def setup(bot):
     await bot.add_cog(UsefulCog(bot))
-
@@ -0,0 +1,69 @@
+import datetime
+from typing import Tuple
+
+import discord
+import numpy as np
+
+from utils import metrics
+
+ACTIVITY_MESSAGES = metrics.Histogram("nebu_activity_messages", "Messages binned per activity graph.",
+                                      buckets=(100, 1_000, 10_000, 100_000, 1_000_000))
+# binary COPY: 11 byte signature, flags and the length of the header extension
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+COPY_HEADER = 19
+COPY_TRAILER = 2
+# a tuple of a single BIGINT column: field count, field length and the value, all big endian
+COPY_ROW = np.dtype([("fields", ">i2"), ("length", ">i4"), ("value", ">i8")])
+BIN_WIDTHS = (
+    datetime.timedelta(minutes=1),
+    datetime.timedelta(minutes=10),
+    datetime.timedelta(hours=1),
+    datetime.timedelta(hours=6),
+    datetime.timedelta(days=1),
+    datetime.timedelta(weeks=1),
+    datetime.timedelta(days=30),
+)
+MAX_BINS = 120
+
+
+class IdBuffer:
+    """Collects the binary COPY output of a query selecting one BIGINT column, to be read as one array."""
+    def __init__(self):
+        self.data = bytearray()
+
+    async def __call__(self, chunk: bytes) -> None:
+        self.data += chunk
+
+    def ids(self) -> np.ndarray:
+        if not self.data:
+            return np.empty(0, dtype=np.int64)
+        if not self.data.startswith(COPY_SIGNATURE):
+            raise ValueError("not a binary COPY output")
+
+        offset = COPY_HEADER + int.from_bytes(self.data[COPY_HEADER - 4:COPY_HEADER], "big")
+        count = (len(self.data) - offset - COPY_TRAILER) // COPY_ROW.itemsize
+        rows = np.frombuffer(self.data, dtype=COPY_ROW, count=count, offset=offset)
+        if count and (rows["length"] != 8).any():
+            raise ValueError("expected a single non null BIGINT column")
+        return rows["value"].astype(np.int64)
+
+
+def snowflake_times(ids: np.ndarray) -> np.ndarray:
+    """Unix milliseconds of snowflake ids."""
+    return (ids >> 22) + discord.utils.DISCORD_EPOCH
+
+
+def bin_times(times: np.ndarray) -> Tuple[np.ndarray, np.ndarray, datetime.timedelta]:
+    """Counts the timestamps per bin of the smallest width that fits them in `MAX_BINS`.
+
+    Returns the start of every bin as `datetime64[ms]`, the counts and the width.
+    """
+    start, end = int(times.min()), int(times.max())
+    width = next((w for w in BIN_WIDTHS if (end - start) // (w // datetime.timedelta(milliseconds=1)) < MAX_BINS),
+                 BIN_WIDTHS[-1])
+    width_ms = width // datetime.timedelta(milliseconds=1)
+    start -= start % width_ms
+    counts = np.bincount((times - start) // width_ms)
+    edges = (start + np.arange(len(counts), dtype=np.int64) * width_ms).astype("datetime64[ms]")
+    ACTIVITY_MESSAGES.observe(len(times))
+    return edges, counts, width
@@ -0,0 +1,123 @@
+import collections
+import os
+import resource
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import discord
+from discord.http import HTTPClient
+from discord.state import ConnectionState
+
+CACHE_PROFILES = ("full", "lean")
+LEAN_INTENTS = ("guilds", "guild_messages", "dm_messages", "message_content")
+# other models are caches of their own, only what an entry holds by itself is counted.
+SHARED_TYPES = (discord.Client, ConnectionState, HTTPClient, discord.Guild, discord.abc.GuildChannel, discord.Message,
+                discord.Member, discord.User, discord.ClientUser, discord.Role, discord.Emoji)
+
+
+def cache_options(settings: Dict[str, Any]) -> Dict[str, Any]:
+    """Client options of the `cache_profile` in the config.
+
+    The full profile is what the library does by default with every intent. The lean profile only keeps what the
+    ingestion needs: message events, no presences, no member list and a small message cache. `intents`, `max_messages`
+    and `chunk_guilds_at_startup` in the config override either profile.
+    """
+    profile = settings.get("cache_profile", "full")
+    if profile not in CACHE_PROFILES:
+        raise ValueError(f"cache_profile must be one of {', '.join(CACHE_PROFILES)}, not {profile!r}")
+
+    intents = discord.Intents.all()
+    if names := settings.get("intents", LEAN_INTENTS if profile == "lean" else None):
+        intents = discord.Intents(**{name: True for name in names})
+
+    if profile == "full":
+        options = {"max_messages": 1000, "chunk_guilds_at_startup": intents.members}
+    else:
+        options = {"max_messages": 200, "chunk_guilds_at_startup": False}
+    options["intents"] = intents
+    options["member_cache_flags"] = discord.MemberCacheFlags.from_intents(intents)
+    for key in ("max_messages", "chunk_guilds_at_startup"):
+        if key in settings:
+            options[key] = settings[key]
+    return options
+
+
+class MemberLRU:
+    """Members fetched on demand, for when the member list itself is not cached."""
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self._members: collections.OrderedDict[Tuple[int, int], discord.Member] = collections.OrderedDict()
+
+    def get(self, guild_id: int, user_id: int) -> Optional[discord.Member]:
+        key = (guild_id, user_id)
+        if (member := self._members.get(key)) is not None:
+            self._members.move_to_end(key)
+        return member
+
+    def add(self, member: discord.Member) -> None:
+        self._members[member.guild.id, member.id] = member
+        self._members.move_to_end((member.guild.id, member.id))
+        while len(self._members) > self.size:
+            self._members.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+
+def current_rss() -> int:
+    """Resident memory of this process in bytes, the peak when /proc is not available."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _own_size(obj: Any, seen: set, depth: int) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+
+    if isinstance(obj, dict):
+        children = [*obj.keys(), *obj.values()]
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        children = obj
+    else:
+        slots = [getattr(obj, name, None) for cls in type(obj).__mro__ for name in getattr(cls, "__slots__", ())]
+        children = [*slots, *getattr(obj, "__dict__", {}).values()]
+    for child in children:
+        if not isinstance(child, SHARED_TYPES):
+            size += _own_size(child, seen, depth - 1)
+    return size
+
+
+def estimate_size(entries: Iterable[Any], count: int, *, sample: int = 200) -> int:
+    """Estimates the memory of a cache of `count` entries from the size of its first `sample` entries."""
+    sizes = [_own_size(entry, set(), 3) for _, entry in zip(range(sample), entries)]
+    if not sizes:
+        return 0
+    return int(sum(sizes) / len(sizes) * count)
+
+
+def cache_report(bot: discord.Client) -> List[Tuple[str, int, int]]:
+    """`(cache, entries, estimated bytes)` of the client state caches."""
+    guilds = bot.guilds
+    members = [member for guild in guilds for member in guild._members.values()]
+    channels = [channel for guild in guilds for channel in guild.channels]
+    roles = [role for guild in guilds for role in guild._roles.values()]
+    messages = bot.cached_messages
+    caches = {
+        "guilds": guilds,
+        "channels": channels,
+        "roles": roles,
+        "members": members,
+        "users": bot.users,
+        "messages": messages,
+        "emojis": bot.emojis,
+    }
+    if (lru := getattr(bot, "lazy_members", None)) is not None:
+        caches["lazy members"] = [*lru._members.values()]
+    return [(name, len(entries), estimate_size(iter(entries), len(entries))) for name, entries in caches.items()]
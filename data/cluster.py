@@ -0,0 +1,107 @@
+import os
+import resource
+import time
+from typing import Any, Dict, List, Optional
+
+from discord.ext import commands, tasks
+
+from data.models import NebuBot
+
+RESTART_EXIT_CODE = 75
+STATUS_INTERVAL = 15
+
+
+def shard_ranges(shard_count: int, clusters: int) -> List[List[int]]:
+    """Splits the shards into contiguous ranges, the first clusters take the remainder."""
+    size, extra = divmod(shard_count, clusters)
+    ranges = []
+    start = 0
+    for cluster_id in range(clusters):
+        end = start + size + (cluster_id < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class ClusterBot(NebuBot, commands.AutoShardedBot):
+    """NebuBot running a range of the shards, one per process started by `cluster.py`.
+
+    Clusters share nothing but the database and the IPC server. Every cluster broadcasts its status over IPC and
+    keeps the last status of the others, cluster wide commands are broadcast the same way.
+    """
+    def __init__(self, command_prefix, *, cluster_id: int, cluster_count: int, launched: Any = None, **kwargs):
+        super().__init__(command_prefix, **kwargs)
+        self.cluster_id = cluster_id
+        self.cluster_count = cluster_count
+        self.launched = launched
+        self.exit_code = 0
+        self.started_at = time.time()
+        self.cluster_statuses: Dict[int, Dict[str, Any]] = {}
+        self.ipc_client.cluster_id = cluster_id
+        # a single cluster has no other process caching counters
+        self.cache_bus.send_deltas = cluster_count > 1
+        self.ipc_client.listen()(self.on_cluster_status)
+        self.ipc_client.listen()(self.on_cluster_command)
+
+    async def setup_hook(self):
+        await super().setup_hook()
+        self.publish_status.start()
+
+    async def close(self):
+        self.publish_status.cancel()
+        await super().close()
+
+    async def on_ready(self):
+        await super().on_ready()
+        if self.launched is not None:
+            # lets the launcher start the next cluster, identifying shards is rate limited per bot.
+            self.launched.set()
+
+    def cluster_status(self) -> Dict[str, Any]:
+        return {
+            "cluster_id": self.cluster_id,
+            "pid": os.getpid(),
+            "shards": {str(shard_id): round(latency, 4) for shard_id, latency in self.latencies},
+            "guilds": len(self.guilds),
+            "users": len(self.users),
+            "messages": len(self.cached_messages),
+            "pool_size": self.pool_pg.get_size() if self.pool_pg else 0,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "uptime": round(time.time() - self.started_at),
+            "updated_at": time.time(),
+        }
+
+    @tasks.loop(seconds=STATUS_INTERVAL)
+    async def publish_status(self):
+        status = self.cluster_status()
+        self.cluster_statuses[self.cluster_id] = status
+        if self.ipc_client.ready:
+            await self.ipc_client.broadcast("cluster_status", status)
+
+    @publish_status.before_loop
+    async def before_publish_status(self):
+        await self.wait_until_ready()
+
+    async def on_cluster_status(self, status: Dict[str, Any]):
+        self.cluster_statuses[status["cluster_id"]] = status
+
+    async def broadcast_command(self, action: str, *, cluster_id: Optional[int] = None, **data: Any) -> int:
+        """Runs a cluster command on `cluster_id`, or on every cluster including this one."""
+        payload = {"action": action, "cluster_id": cluster_id, **data}
+        return await self.ipc_client.broadcast("cluster_command", payload, include_self=True)
+
+    async def on_cluster_command(self, data: Dict[str, Any]):
+        if data.get("cluster_id") not in (None, self.cluster_id):
+            return
+
+        action = data["action"]
+        if action == "reload":
+            await self.reload_extension(data["extension"])
+        elif action == "restart":
+            print(f"Cluster {self.cluster_id} restarting")
+            self.exit_code = RESTART_EXIT_CODE
+            await self.close()
+        elif action == "publish_status":
+            await self.publish_status()
+        else:
+            print(f"Ignoring unknown cluster command {action!r}")
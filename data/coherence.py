@@ -0,0 +1,164 @@
+import collections
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from discord.ext import tasks
+
+from data.ipc import StellaClient
+from utils import metrics
+
+CACHE_SYNC_MESSAGES = metrics.Counter("nebu_cache_sync_messages_total", "Cache sync batches over IPC.", ["direction"])
+CACHE_SYNC_ENTRIES = metrics.Counter("nebu_cache_sync_entries_total", "Invalidated keys and counter deltas synced.",
+                                     ["cache", "kind", "direction"])
+SYNC_EVENT = "cache_sync"
+# past this many pending keys, the batch is replaced by clearing the caches it touched
+MAX_PENDING = 10_000
+
+Invalidate = Callable[[Any], None]
+ApplyDelta = Callable[[Any, Any, int, int], None]
+Clear = Callable[[], None]
+
+
+class SyncedCache:
+    __slots__ = ("invalidate", "apply_delta", "clear")
+
+    def __init__(self, invalidate: Invalidate, apply_delta: Optional[ApplyDelta], clear: Clear):
+        self.invalidate = invalidate
+        self.apply_delta = apply_delta
+        self.clear = clear
+
+
+class CacheBus:
+    """Keeps the caches of every bot process, and the scripts that write to the database, coherent over IPC.
+
+    A cache registers how to drop a key, clear itself and, for counters, apply a delta. Changes made in this process
+    are collected and sent once per `interval` as a single `cache_sync` broadcast. Deltas of the same counter are
+    summed before they are sent, along with the highest database total they were written at, so a process that loaded
+    the counter after the write can tell the delta is already counted. Every other process applies them to its own
+    copy. A process that is not connected keeps what it has pending until it is, since invalidations and deltas can be
+    applied late in any order. Without `send_deltas`, when no other process caches counters, deltas aren't collected.
+    """
+    def __init__(self, ipc_client: StellaClient, *, interval: float = 1, send_deltas: bool = True):
+        self.ipc_client = ipc_client
+        self.send_deltas = send_deltas
+        self.caches: Dict[str, SyncedCache] = {}
+        self.invalidated: Dict[str, Set[Hashable]] = collections.defaultdict(set)
+        self.deltas: Dict[str, Dict[Tuple[Hashable, Hashable], List[int]]] = collections.defaultdict(dict)
+        self.cleared: Set[str] = set()
+        self.flush.change_interval(seconds=interval)
+        ipc_client.listen()(self.on_cache_sync)
+
+    def register(self, name: str, *, invalidate: Invalidate, clear: Clear, apply_delta: Optional[ApplyDelta] = None):
+        self.caches[name] = SyncedCache(invalidate, apply_delta, clear)
+
+    def unregister(self, name: str) -> None:
+        self.caches.pop(name, None)
+
+    @property
+    def pending(self) -> int:
+        return sum(map(len, self.invalidated.values())) + sum(map(len, self.deltas.values())) + len(self.cleared)
+
+    def invalidate(self, cache: str, key: Hashable) -> None:
+        """Drops `key` from `cache` in the other processes."""
+        if cache not in self.cleared:
+            self.invalidated[cache].add(key)
+            self.check_pending()
+
+    def add_delta(self, cache: str, key: Hashable, field: Hashable, amount: int, total: int) -> None:
+        """Adds `amount` to `field` of the cached `key` in the other processes that have it.
+
+        `total` is the value of the field in the database once `amount` was written to it.
+        """
+        if self.send_deltas and cache not in self.cleared:
+            delta = self.deltas[cache].setdefault((key, field), [0, total])
+            delta[0] += amount
+            delta[1] = max(delta[1], total)
+            self.check_pending()
+
+    def clear(self, cache: str) -> None:
+        """Empties `cache` in the other processes."""
+        self.cleared.add(cache)
+        self.invalidated.pop(cache, None)
+        self.deltas.pop(cache, None)
+
+    def check_pending(self) -> None:
+        if self.pending > MAX_PENDING:
+            for cache in {*self.invalidated, *self.deltas}:
+                self.clear(cache)
+
+    def take_batch(self) -> Optional[Dict[str, Any]]:
+        if not self.pending:
+            return None
+
+        batch = {
+            "clear": sorted(self.cleared),
+            "invalidate": [[cache, [*keys]] for cache, keys in self.invalidated.items() if keys],
+            "deltas": [[cache, [[key, field, amount, total] for (key, field), (amount, total) in deltas.items()
+                                if amount]]
+                       for cache, deltas in self.deltas.items() if deltas],
+        }
+        self.cleared = set()
+        self.invalidated = collections.defaultdict(set)
+        self.deltas = collections.defaultdict(dict)
+        return batch
+
+    def restore(self, batch: Dict[str, Any]) -> None:
+        """Puts back a batch that could not be sent, merged with what was collected since."""
+        for cache in batch["clear"]:
+            self.clear(cache)
+        for cache, keys in batch["invalidate"]:
+            for key in keys:
+                self.invalidate(cache, key)
+        for cache, deltas in batch["deltas"]:
+            for key, field, amount, total in deltas:
+                self.add_delta(cache, key, field, amount, total)
+
+    @tasks.loop(seconds=1)
+    async def flush(self):
+        if not self.ipc_client.ready or (batch := self.take_batch()) is None:
+            return
+
+        try:
+            await self.ipc_client.broadcast(SYNC_EVENT, batch)
+        except Exception as e:
+            self.restore(batch)
+            print("Failure to sync caches:", repr(e))
+            return
+
+        CACHE_SYNC_MESSAGES.inc(direction="sent")
+        self.count(batch, "sent")
+
+    async def on_cache_sync(self, batch: Dict[str, Any]):
+        CACHE_SYNC_MESSAGES.inc(direction="received")
+        self.count(batch, "received")
+        self.apply(batch)
+
+    def apply(self, batch: Dict[str, Any]) -> None:
+        for name in batch.get("clear", ()):
+            if cache := self.caches.get(name):
+                cache.clear()
+        for name, keys in batch.get("invalidate", ()):
+            if cache := self.caches.get(name):
+                for key in keys:
+                    cache.invalidate(key)
+        for name, deltas in batch.get("deltas", ()):
+            if (cache := self.caches.get(name)) and cache.apply_delta:
+                for key, field, amount, total in deltas:
+                    cache.apply_delta(key, field, amount, total)
+
+    @staticmethod
+    def count(batch: Dict[str, Any], direction: str) -> None:
+        for cache in batch.get("clear", ()):
+            CACHE_SYNC_ENTRIES.inc(cache=cache, kind="clear", direction=direction)
+        for cache, keys in batch.get("invalidate", ()):
+            CACHE_SYNC_ENTRIES.inc(len(keys), cache=cache, kind="invalidate", direction=direction)
+        for cache, deltas in batch.get("deltas", ()):
+            CACHE_SYNC_ENTRIES.inc(len(deltas), cache=cache, kind="delta", direction=direction)
+
+    def start(self) -> None:
+        if not self.flush.is_running():
+            self.flush.start()
+
+    async def close(self) -> None:
+        """Stops the batching, sending what is still pending when connected."""
+        self.flush.cancel()
+        await self.flush()
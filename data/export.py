@@ -0,0 +1,129 @@
+import csv
+import gzip
+import io
+import json
+import tempfile
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+import discord
+
+from utils import metrics
+
+EXPORTED_MESSAGES = metrics.Counter("nebu_exported_messages_total", "Messages written by exports.", ["format"])
+EXPORT_FORMATS = ("ndjson", "csv")
+CSV_COLUMNS = ("message_id", "channel_id", "created_at", "content", "attachments", "embeds")
+# one row per embed field of the next $3 messages after the message id $2, ordered so the rows of a message, and of
+# each of its embeds, come one after the other
+EXPORT_QUERY = "SELECT m.message_id, m.channel_id, m.content, m.attachment_count, e.embed_id, e.title, " \
+               "e.description, e.footer_text, e.has_thumbnail, e.color, e.author, f.name, f.value " \
+               "FROM user_messages m " \
+               "LEFT JOIN user_embeds e ON e.message_id = m.message_id " \
+               "LEFT JOIN embed_fields f ON f.embed_id = e.embed_id " \
+               "WHERE m.message_id IN (" \
+               "SELECT message_id FROM user_messages WHERE user_id = $1 AND message_id > $2 " \
+               "ORDER BY message_id LIMIT $3) " \
+               "ORDER BY m.message_id, e.embed_id, f.field_index"
+# compressed bytes that can still be buffered by the compressor when a part is checked
+PART_MARGIN = 256 * 1024
+
+
+def exported_messages(rows: Iterable[Any]) -> Iterator[Dict[str, Any]]:
+    """Folds the rows of `EXPORT_QUERY` into one dict per message, with its embeds and their fields."""
+    message = embed = None
+    embed_id = None
+    for row in rows:
+        if message is None or row["message_id"] != message["message_id"]:
+            if message is not None:
+                yield message
+            message = {
+                "message_id": row["message_id"],
+                "channel_id": row["channel_id"],
+                "created_at": discord.utils.snowflake_time(row["message_id"]).isoformat(),
+                "content": row["content"],
+                "attachments": row["attachment_count"],
+                "embeds": [],
+            }
+            embed_id = None
+
+        if row["embed_id"] is not None and row["embed_id"] != embed_id:
+            embed_id = row["embed_id"]
+            embed = {
+                "title": row["title"],
+                "description": row["description"],
+                "footer": row["footer_text"],
+                "thumbnail": row["has_thumbnail"],
+                "color": row["color"],
+                "author": row["author"],
+                "fields": [],
+            }
+            message["embeds"].append(embed)
+        if row["name"] is not None:
+            embed["fields"].append({"name": row["name"], "value": row["value"]})
+
+    if message is not None:
+        yield message
+
+
+class MessageExport:
+    """Encodes exported messages into gzip compressed files of at most `part_size` bytes.
+
+    Every part is a complete file of its own, CSV parts repeat the header. A part is kept in memory up to
+    `spool_size` and in a temporary file past that, only the part being written exists at a time.
+    """
+    def __init__(self, fmt: str, *, name: str, part_size: int, spool_size: int = 1024 * 1024):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}, not {fmt!r}")
+
+        self.format = fmt
+        self.name = name
+        self.part_size = max(part_size - PART_MARGIN, PART_MARGIN)
+        self.spool_size = spool_size
+        self.parts = 0
+        self.messages = 0
+        self._line = io.StringIO()
+        self._csv = csv.writer(self._line)
+        self._file: Optional[tempfile.SpooledTemporaryFile] = None
+        self._gzip: Optional[gzip.GzipFile] = None
+
+    def open_part(self) -> None:
+        self._file = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode="wb")
+        if self.format == "csv":
+            self._csv.writerow(CSV_COLUMNS)
+            self._gzip.write(self.take_line())
+
+    def take_line(self) -> bytes:
+        line = self._line.getvalue().encode()
+        self._line.seek(0)
+        self._line.truncate()
+        return line
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        if self.format == "ndjson":
+            return json.dumps(message, ensure_ascii=False).encode() + b"\n"
+
+        embeds = json.dumps(message["embeds"], ensure_ascii=False) if message["embeds"] else ""
+        self._csv.writerow([*(message[column] for column in CSV_COLUMNS[:-1]), embeds])
+        return self.take_line()
+
+    def write(self, message: Dict[str, Any]) -> Optional[discord.File]:
+        """Adds a message, returns the part it completed if it was full."""
+        if self._gzip is None:
+            self.open_part()
+        self._gzip.write(self.encode(message))
+        self.messages += 1
+        EXPORTED_MESSAGES.inc(format=self.format)
+        if self._file.tell() >= self.part_size:
+            return self.finish()
+
+    def finish(self) -> Optional[discord.File]:
+        """Completes the part being written, if any."""
+        if self._gzip is None:
+            return None
+
+        self._gzip.close()
+        self._file.seek(0)
+        self.parts += 1
+        file = discord.File(self._file, filename=f"{self.name}-{self.parts}.{self.format}.gz")
+        self._file = self._gzip = None
+        return file
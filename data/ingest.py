@@ -0,0 +1,92 @@
+import contextlib
+import datetime
+from typing import Any, Iterable, Sequence, Set, Union
+
+import discord
+
+from utils import metrics
+
+INGESTED_MESSAGES = metrics.Counter("nebu_ingested_messages_total", "Messages newly stored.", ["source"])
+DUPLICATE_MESSAGES = metrics.Counter("nebu_duplicate_messages_total", "Messages that were already stored.", ["source"])
+# pool lane of each source, the rest is written as ingestion
+SOURCE_LANES = {"backfill": "backfill", "catch_up": "backfill"}
+
+
+class StoredMessage:
+    """The stored columns of a message, without the state, member and attachments a `discord.Message` keeps alive."""
+    __slots__ = ("id", "author_id", "channel_id", "content", "attachments", "embeds")
+
+    def __init__(self, message_id: int, author_id: int, channel_id: int, content: str, attachments: int,
+                 embeds: Sequence[discord.Embed] = ()):
+        self.id = message_id
+        self.author_id = author_id
+        self.channel_id = channel_id
+        self.content = content
+        self.attachments = attachments
+        self.embeds = embeds
+
+    @classmethod
+    def of(cls, message: Union[discord.Message, "StoredMessage"]) -> "StoredMessage":
+        if isinstance(message, cls):
+            return message
+        return cls(message.id, message.author.id, message.channel.id, message.content, len(message.attachments),
+                   tuple(message.embeds))
+
+    @property
+    def created_at(self) -> datetime.datetime:
+        return discord.utils.snowflake_time(self.id)
+
+    def __repr__(self) -> str:
+        return f"<StoredMessage id={self.id} author_id={self.author_id} channel_id={self.channel_id}>"
+
+
+class MessageWriter:
+    """Stores messages in batches, so each message is written at most once.
+
+    A batch is deduplicated by message id and inserted in one statement that ignores conflicts. Only the messages that
+    the database reports as new get their embeds written, in the same transaction. When the backfill overlaps with
+    on_message, or retries a page, the messages that were already stored are counted as duplicates.
+    """
+    MESSAGE_QUERY = "INSERT INTO user_messages " \
+                    "SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::text[], $5::smallint[]) " \
+                    "ON CONFLICT DO NOTHING RETURNING message_id"
+    EMBED_QUERY = "INSERT INTO user_embeds VALUES(DEFAULT, $1, $2, $3, $4, $5, $6, $7) RETURNING embed_id"
+    FIELD_QUERY = "INSERT INTO embed_fields VALUES($1, $2, $3, $4)"
+
+    def __init__(self, bot: Any):
+        self.bot = bot
+
+    async def write(self, messages: Iterable[Union[discord.Message, StoredMessage]], *, source: str) -> Set[int]:
+        """Stores the messages, returns the ids of the ones that were not stored before."""
+        unique = {message.id: StoredMessage.of(message) for message in messages}
+        if not unique:
+            return set()
+
+        rows = [(message.id, message.author_id, message.channel_id, message.content, message.attachments)
+                for message in unique.values()]
+        columns = [list(column) for column in zip(*rows)]
+
+        # the insert alone is atomic, the transaction only keeps the embeds together with their message
+        with_embeds = any(message.embeds for message in unique.values())
+        async with self.bot.pool_pg.lane(SOURCE_LANES.get(source, "ingestion")).acquire() as con:
+            async with con.transaction() if with_embeds else contextlib.nullcontext():
+                inserted = {record["message_id"] for record in await con.fetch(self.MESSAGE_QUERY, *columns)}
+                for message_id in inserted:
+                    if embeds := unique[message_id].embeds:
+                        await self.write_embeds(con, message_id, embeds)
+
+        INGESTED_MESSAGES.inc(len(inserted), source=source)
+        if duplicates := len(unique) - len(inserted):
+            DUPLICATE_MESSAGES.inc(duplicates, source=source)
+        return inserted
+
+    async def write_embeds(self, con: Any, message_id: int, embeds: Sequence[discord.Embed]) -> None:
+        for embed in embeds:
+            footer = embed.footer.text
+            has_thumb = bool(embed.thumbnail.url)
+            color = getattr(embed.color, "value", None)
+            embed_values = (message_id, embed.title, embed.description, footer, has_thumb, color, embed.author.name)
+            embed_id = await con.fetchval(self.EMBED_QUERY, *embed_values)
+            if embed.fields:
+                fields = [(embed_id, i, field.name, field.value) for i, field in enumerate(embed.fields)]
+                await con.executemany(self.FIELD_QUERY, fields)
@@ -0,0 +1,392 @@
+import asyncio
+import collections
+import enum
+import itertools
+import random
+import traceback
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import aiohttp
+from discord.ext import ipc
+
+from data import wire
+from utils import metrics
+
+IPC_REQUEST_SECONDS = metrics.Histogram("nebu_ipc_request_seconds", "Round trip of IPC requests.", ["endpoint"])
+IPC_PENDING = metrics.Gauge("nebu_ipc_pending_requests", "IPC requests waiting for a reply.")
+IPC_TIMEOUTS = metrics.Counter("nebu_ipc_timeouts_total", "IPC requests that were never answered.", ["endpoint"])
+IPC_QUEUED = metrics.Gauge("nebu_ipc_queued_requests", "IPC requests waiting for the connection to come back.")
+IPC_RECONNECTS = metrics.Counter("nebu_ipc_reconnects_total", "IPC connection attempts after a disconnect.", ["result"])
+IPC_CONNECTED = metrics.Gauge("nebu_ipc_connected", "Whether the IPC connection is up and subscribed.")
+
+
+class ConnectionState(enum.Enum):
+    disconnected = 0
+    connecting = 1
+    connected = 2
+
+
+class PendingRequest:
+    __slots__ = ("endpoint", "future", "deadline")
+
+    def __init__(self, endpoint: str, future: asyncio.Future, deadline: float):
+        self.endpoint = endpoint
+        self.future = future
+        self.deadline = deadline
+
+
+class StellaClient(ipc.Client):
+    """IPC client that multiplexes requests over a single websocket.
+
+    Every request is registered in a table with a deadline and is removed once it is answered, times out or the
+    connection drops. Server pushed events are handed to their listeners as tasks, bounded by `max_concurrency`, so
+    a slow listener never holds up the replies behind it.
+
+    `subscribe` offers the binary formats of `data.wire`. Servers that accept one authenticate the connection once,
+    servers that don't keep receiving JSON with the headers on every payload.
+
+    When the connection drops, it is re-established with jittered exponential backoff starting at `backoff_base`
+    seconds. Requests made in the meantime wait in a queue of at most `max_queued` entries and are sent once the
+    client subscribed again.
+    """
+    def __init__(self, *args: Any, request_timeout: float = 30, max_concurrency: int = 16, max_in_flight: int = 64,
+                 max_queued: int = 256, backoff_base: float = .05, backoff_cap: float = 5,
+                 cluster_id: Optional[int] = None, **kwargs: Any):
+        bot_id = kwargs.pop("bot_id", None)
+        super().__init__(*args, **kwargs)
+        self.bot_id = bot_id
+        self.cluster_id = cluster_id
+        self.request_timeout = request_timeout
+        self.max_in_flight = max_in_flight
+        self.events: Dict[str, List[Callable]] = {}
+        self.connect = None
+        self._requests: Dict[str, PendingRequest] = {}
+        self._request_ids = itertools.count(1)
+        self._dispatch_limit = asyncio.Semaphore(max_concurrency)
+        self._dispatching: Set[asyncio.Task] = set()
+        self._send_lock = asyncio.Lock()
+        self.codec: Optional[wire.Codec] = None
+        self.compress_threshold: Optional[int] = None
+        self.state = ConnectionState.disconnected
+        self.max_queued = max_queued
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._outbound: Deque[Tuple[str, str, Dict[str, Any]]] = collections.deque()
+        self._reconnecting: Optional[asyncio.Task] = None
+        self._closing = False
+        IPC_PENDING.set_function(lambda: len(self._requests))
+        IPC_QUEUED.set_function(lambda: len(self._outbound))
+        IPC_CONNECTED.set_function(lambda: self.state is ConnectionState.connected)
+
+    def __call__(self, bot_id: int) -> None:
+        self.bot_id = bot_id
+
+    def exception_catching_callback(self, task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            task.print_stack()
+
+    @property
+    def ready(self) -> bool:
+        return self.state is ConnectionState.connected
+
+    async def open(self) -> None:
+        """One connection attempt, which only succeeds once the server answered the subscription."""
+        await self.close_socket()
+        try:
+            await self.init_sock()
+            self.connect = asyncio.create_task(self.connection())
+            self.connect.add_done_callback(self.exception_catching_callback)
+            await self.subscribe()
+        except BaseException:
+            await self.close_socket()
+            raise
+
+    async def close_socket(self) -> None:
+        if self.connect is not None:
+            self.connect.cancel()
+            self.connect = None
+        if self.websocket is not None and not self.websocket.closed:
+            await self.websocket.close()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.websocket = None
+        self.session = None
+        self.use_wire(None)
+
+    async def start(self) -> None:
+        """Connects for the first time. Keeps retrying in the background when the server is not up yet."""
+        self._closing = False
+        self.state = ConnectionState.connecting
+        try:
+            await self.open()
+        except Exception:
+            self.state = ConnectionState.disconnected
+            self.schedule_reconnect()
+            raise
+        self.state = ConnectionState.connected
+        await self.flush_outbound()
+
+    def schedule_reconnect(self) -> asyncio.Task:
+        if self._reconnecting is None or self._reconnecting.done():
+            self._reconnecting = asyncio.create_task(self.reconnect_loop())
+            self._reconnecting.add_done_callback(self.exception_catching_callback)
+        return self._reconnecting
+
+    async def reconnect(self) -> None:
+        """Drops the current connection and waits until the client is subscribed again."""
+        if self.state is ConnectionState.connected:
+            self.state = ConnectionState.disconnected
+            self.fail_pending(ConnectionError("IPC connection is being re-established"))
+            await self.close_socket()
+        await asyncio.shield(self.schedule_reconnect())
+
+    async def reconnect_loop(self) -> None:
+        attempt = 0
+        while not self._closing:
+            self.state = ConnectionState.connecting
+            try:
+                await self.open()
+            except (OSError, aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+                self.state = ConnectionState.disconnected
+                IPC_RECONNECTS.inc(result="failure")
+                attempt += 1
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+                if attempt % 10 == 0:
+                    print(f"IPC server still unreachable after {attempt} attempts:", e)
+                await asyncio.sleep(delay)
+            except BaseException:
+                # refused subscriptions are not retried, queued requests are failed with the rest.
+                self.state = ConnectionState.disconnected
+                self.fail_pending(ConnectionError("IPC server refused the connection"))
+                self._outbound.clear()
+                raise
+            else:
+                IPC_RECONNECTS.inc(result="success")
+                self.state = ConnectionState.connected
+                await self.flush_outbound()
+                return
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        self.state = ConnectionState.disconnected
+        error = ConnectionError("IPC client is closed")
+        self.fail_pending(error)
+        self._outbound.clear()
+        await self.close_socket()
+
+    def enqueue(self, request_id: str, endpoint: str, data: Dict[str, Any]) -> None:
+        if len(self._outbound) >= self.max_queued:
+            # requests that timed out while queued are only dropped here and on flush.
+            self._outbound = collections.deque(entry for entry in self._outbound if entry[0] in self._requests)
+        if len(self._outbound) >= self.max_queued:
+            raise ConnectionError("Server is not connected and the IPC queue is full")
+        self._outbound.append((request_id, endpoint, data))
+
+    async def flush_outbound(self) -> None:
+        while self._outbound and self.ready:
+            request_id, endpoint, data = self._outbound.popleft()
+            if request_id not in self._requests:
+                continue
+
+            payload = self.create_payload(endpoint, data)
+            payload.update({"request_id": request_id})
+            try:
+                await self.send_payload(payload)
+            except ConnectionError:
+                self._outbound.appendleft((request_id, endpoint, data))
+                return
+
+    def listen(self) -> Callable[[Callable], Callable]:
+        def inner(coro: Callable) -> Callable:
+            name = coro.__name__
+            listeners = self.events.setdefault(name, [])
+            listeners.append(coro)
+            return coro
+        return inner
+
+    def create_payload(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Union[int, str, Dict[str, Any]]]:
+        if self.codec is not None:
+            # the connection was authenticated during the handshake
+            return {"endpoint": endpoint, "data": data}
+
+        return {
+            "endpoint": endpoint,
+            "data": data,
+            "headers": {"Authorization": self.secret_key, "Bot_id": self.bot_id}
+        }
+
+    def register_request(self, endpoint: str, timeout: float) -> Tuple[str, PendingRequest]:
+        # ids only have to be unique for this connection, the server echoes them back as is.
+        request_id = format(next(self._request_ids), "x")
+        loop = asyncio.get_running_loop()
+        pending = PendingRequest(endpoint, loop.create_future(), loop.time() + timeout)
+        self._requests[request_id] = pending
+        return request_id, pending
+
+    async def send_payload(self, payload: Dict[str, Any]) -> None:
+        if self.websocket is None or self.websocket.closed:
+            raise ConnectionError("Server is not connected")
+
+        # aiohttp waits for the transport to drain once its write buffer is full, which pauses every sender here.
+        async with self._send_lock:
+            if self.codec is None:
+                await self.websocket.send_str(wire.legacy_dumps(payload))
+            else:
+                frame = wire.encode_frame(self.codec, payload, compress_threshold=self.compress_threshold)
+                await self.websocket.send_bytes(frame)
+
+    async def wait_reply(self, request_id: str, pending: PendingRequest) -> Any:
+        timeout = pending.deadline - asyncio.get_running_loop().time()
+        try:
+            return await asyncio.wait_for(pending.future, timeout)
+        except asyncio.TimeoutError:
+            IPC_TIMEOUTS.inc(endpoint=pending.endpoint)
+            raise
+        finally:
+            self._requests.pop(request_id, None)
+
+    async def do_request(self, endpoint: str, data: Dict[str, Any], *, timeout: Optional[float] = None,
+                         queue: bool = True) -> Any:
+        if queue and self.state is ConnectionState.disconnected and not self._closing:
+            self.schedule_reconnect()
+
+        with IPC_REQUEST_SECONDS.time(endpoint=endpoint):
+            request_id, pending = self.register_request(endpoint, timeout or self.request_timeout)
+            try:
+                if queue and not self.ready:
+                    self.enqueue(request_id, endpoint, data)
+                else:
+                    payload = self.create_payload(endpoint, data)
+                    payload.update({"request_id": request_id})
+                    await self.send_payload(payload)
+            except BaseException:
+                self._requests.pop(request_id, None)
+                raise
+            return await self.wait_reply(request_id, pending)
+
+    async def request(self, endpoint: str, **kwargs: Any) -> Dict[str, Any]:
+        return await self.do_request(endpoint, kwargs)
+
+    async def request_many(self, requests: Iterable[Tuple[str, Dict[str, Any]]], *, timeout: Optional[float] = None,
+                           return_exceptions: bool = False) -> List[Any]:
+        """Pipelines `(endpoint, data)` requests, keeping at most `max_in_flight` of them unanswered at once.
+
+        Results are returned in the order of the requests.
+        """
+        window = asyncio.Semaphore(self.max_in_flight)
+
+        async def pipelined(endpoint: str, data: Dict[str, Any]) -> Any:
+            async with window:
+                return await self.do_request(endpoint, data, timeout=timeout)
+
+        tasks = [pipelined(endpoint, data) for endpoint, data in requests]
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+
+    async def subscribe(self) -> Dict[str, Any]:
+        self.use_wire(None)
+        offer: Dict[str, Any] = {"wire": {"formats": wire.available_formats(), "compression": ["zlib"]}}
+        if self.cluster_id is not None:
+            offer["cluster"] = self.cluster_id
+        data = await self.do_request("start_connection", offer, queue=False)
+        if data.get("error") is not None:
+            self.connect.cancel()
+            raise Exception(f"Unable to get event from server: {data['error']}")
+        return data
+
+    async def broadcast(self, event: str, data: Any = None, *, include_self: bool = False) -> int:
+        """Has the server push `event` to the other connected clusters, returns how many of them received it."""
+        payload = {"event": event, "data": data, "include_self": include_self}
+        return await self.do_request("broadcast", payload)
+
+    def use_wire(self, accepted: Optional[Dict[str, Any]]) -> None:
+        if not accepted or accepted.get("format") not in wire.CODECS:
+            self.codec = None
+            self.compress_threshold = None
+            return
+
+        self.codec = wire.CODECS[accepted["format"]]
+        compressed = accepted.get("compression") == "zlib"
+        self.compress_threshold = accepted.get("threshold", wire.DEFAULT_COMPRESS_THRESHOLD) if compressed else None
+
+    def decode(self, message: aiohttp.WSMessage) -> Dict[str, Any]:
+        if message.type == aiohttp.WSMsgType.BINARY:
+            return wire.decode_frame(self.codec or wire.CODECS["json"], message.data)
+        return wire.legacy_loads(message.data)
+
+    def resolve(self, request_id: str, value: Any) -> None:
+        pending = self._requests.pop(str(request_id), None)
+        if pending is not None and not pending.future.done():
+            pending.future.set_result(value)
+
+    def fail_pending(self, error: BaseException) -> None:
+        """Fails the requests that were already sent, the queued ones are kept for the next connection."""
+        queued = {entry[0] for entry in self._outbound}
+        for request_id, pending in [*self._requests.items()]:
+            if request_id in queued and not self._closing:
+                continue
+            del self._requests[request_id]
+            if not pending.future.done():
+                pending.future.set_exception(error)
+
+    def dispatch(self, event: str, value: Any) -> None:
+        for coro in self.events.get(event, ()):
+            task = asyncio.create_task(self.run_listener(coro, value))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def run_listener(self, coro: Callable, value: Any) -> None:
+        async with self._dispatch_limit:
+            try:
+                await coro(value)
+            except Exception:
+                print(f"Ignoring error in IPC listener {coro.__name__}:")
+                traceback.print_exc()
+
+    async def get_response(self) -> AsyncGenerator[aiohttp.WSMessage, None]:
+        closing = (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED,
+                   aiohttp.WSMsgType.ERROR)
+        while True:
+            recv = await self.websocket.receive()
+            if recv.type == aiohttp.WSMsgType.PING:
+                await self.websocket.ping()
+                continue
+            elif recv.type == aiohttp.WSMsgType.PONG:
+                continue
+            elif recv.type in closing:
+                return
+            else:
+                yield recv
+
+    def on_disconnect(self) -> None:
+        was_connected = self.state is ConnectionState.connected
+        self.state = ConnectionState.disconnected
+        self.fail_pending(ConnectionError("IPC connection closed"))
+        self.connect = None
+        if was_connected and not self._closing:
+            print("IPC connection lost, reconnecting.")
+            self.schedule_reconnect()
+
+    async def connection(self) -> None:
+        try:
+            await self.receive_loop()
+        finally:
+            if self.connect is asyncio.current_task():
+                self.on_disconnect()
+
+    async def receive_loop(self) -> None:
+        async for data in self.get_response():
+            try:
+                respond = self.decode(data)
+                event = "on_" + respond.pop("endpoint")
+                value = respond.pop("response")
+                if event == "on_start_connection" and isinstance(value, dict):
+                    # switched before reading on, the server uses the accepted format right after this reply.
+                    self.use_wire(value.get("wire"))
+                if (request_id := respond.get("request_id")) is not None:
+                    self.resolve(request_id, value)
+
+                self.dispatch(event, value)
+            except Exception as e:
+                print("Ignoring error in gateway:", e)
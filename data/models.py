@@ -1,45 +1,123 @@
 import asyncio
+import bisect
 import collections
 import dataclasses
 import datetime
+import heapq
+import importlib
 import json
+import operator
 import os
 import sys
+import time
 import traceback
-from typing import Dict, Optional, Callable, Any, AsyncGenerator, Union
+from typing import Dict, Optional, Callable, Any, Iterable, List, Set, Tuple
 
-import aiohttp
 import asyncpg
 import discord
 import humanize
 
-from discord.ext import commands, ipc
+from discord.ext import commands
+
+from data.cache import MemberLRU, cache_options
+from data.coherence import CacheBus
+from data.ipc import StellaClient
+from utils import metrics
+from utils.monitor import LoopMonitor
+from utils.pool import MeteredPool
+from utils.profiler import SamplingProfiler
+from utils.startup import StartupTimeline
+
+GATEWAY_EVENTS = metrics.Counter("nebu_gateway_events_total", "Events dispatched by the client.", ["event"])
+LISTENER_SECONDS = metrics.Histogram("nebu_listener_seconds", "Time spent inside each event listener.", ["listener"])
+CACHE_ENTRIES = metrics.Gauge("nebu_cache_entries", "Entries held by the in-memory caches.", ["cache"])
+# imported in a thread once the bot is ready, the cogs only import them on first use
+PREWARM_MODULES = ("utils.image_manipulation", "data.activity")
+# channels ranked per user and guild, more than mostactive shows since some may be gone or not text channels
+RANKING_SIZE = 10
 
 
 class NebuBot(commands.Bot):
     def __init__(self, command_prefix, **kwargs):
-        super().__init__(command_prefix, **kwargs)
+        startup = StartupTimeline()
+        created = time.monotonic()
+        startup.record("imports", startup.origin, created)
         settings = self.get_config()
+        super().__init__(command_prefix, **{**cache_options(settings), **kwargs})
+        self.cache_profile = settings.get("cache_profile", "full")
+        self.lazy_members = MemberLRU(settings.get("lazy_member_cache_size", 1000))
         self.http.token = settings.pop("token")
         self.db_user = settings.pop("db_user")
         self.db_pass = settings.pop("db_pass")
         self.db_dbname = settings.pop("db_dbname")
+        self.db_pool_size = settings.get("db_pool_size", 10)
+        self.db_lanes = settings.get("db_lanes")
         self.color = settings.pop("color")
         self.tester = settings.get("tester", False)
         self.websocket_IP = settings.pop("websocket_ip")
         self.ipc_key = settings.pop("ipc_key")
         self.ipc_port = settings.pop("ipc_port")
         self.ipc_client = StellaClient(host=self.websocket_IP, secret_key=self.ipc_key, port=self.ipc_port)
+        # a lone process has no peer caching counters, ClusterBot turns deltas on when it has some
+        self.cache_bus = CacheBus(self.ipc_client, interval=settings.get("cache_sync_interval", 1), send_deltas=False)
+        self.metrics_host = settings.get("metrics_host", "127.0.0.1")
+        self.metrics_port = settings.get("metrics_port")
+        self.metrics_server = None
+        self.loop_monitor = LoopMonitor(threshold=settings.get("slow_callback_threshold", .25))
+        self.profiler = SamplingProfiler()
         self.pool_pg = None
+        self.startup = startup
+        self._prewarm = None
+        CACHE_ENTRIES.set_function(lambda: len(self.users), cache="users")
+        CACHE_ENTRIES.set_function(lambda: len(self.guilds), cache="guilds")
+        CACHE_ENTRIES.set_function(lambda: len(self.cached_messages), cache="messages")
+        CACHE_ENTRIES.set_function(lambda: len(self.lazy_members), cache="lazy_members")
+        startup.record("config", created, time.monotonic())
+
+    def get_cached_member(self, guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+        return guild.get_member(user_id) or self.lazy_members.get(guild.id, user_id)
 
     async def resolve_user(self, user_id: int, *, guild_id: Optional[int] = None):
-        if not guild_id:
-            user = self.get_guild(guild_id).get_member(user_id)
-            if user:
-                return user
+        if guild_id and (guild := self.get_guild(guild_id)):
+            if member := self.get_cached_member(guild, user_id):
+                return member
 
         return self.get_user(user_id) or await self.fetch_user(user_id)
 
+    async def resolve_users(self, user_ids: Iterable[int], *, guild_id: Optional[int] = None
+                            ) -> Dict[int, discord.abc.User]:
+        """Resolves many users at once, the members that are not cached are requested in one gateway request.
+
+        Users that no longer exist are left out.
+        """
+        resolved = {}
+        missing = []
+        guild = self.get_guild(guild_id) if guild_id else None
+        for user_id in dict.fromkeys(user_ids):
+            if guild and (member := self.get_cached_member(guild, user_id)):
+                resolved[user_id] = member
+            else:
+                missing.append(user_id)
+
+        if guild and missing:
+            for chunk in discord.utils.as_chunks(missing, 100):
+                try:
+                    members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=False)
+                except asyncio.TimeoutError:
+                    continue
+                for member in members:
+                    self.lazy_members.add(member)
+                    resolved[member.id] = member
+
+        for user_id in missing:
+            if user_id in resolved:
+                continue
+            try:
+                resolved[user_id] = self.get_user(user_id) or await self.fetch_user(user_id)
+            except discord.NotFound:
+                pass
+        return resolved
+
     @staticmethod
     def get_config():
         with open("data/config.json") as r:
@@ -47,30 +125,90 @@ class NebuBot(commands.Bot):
 
     async def load_extensions(self):
         root = "cogs"
-        await self.load_extension("jishaku")
-        for file in os.listdir(root):
-            if file.endswith(".py"):
-                formed_name = f"{root}.{file[:-3]}"
+        names = ["jishaku", *(f"{root}.{file[:-3]}" for file in sorted(os.listdir(root)) if file.endswith(".py"))]
+        # the extensions don't depend on each other, their setup and cog_load awaits overlap
+        with self.startup.phase("extensions"):
+            await asyncio.gather(*map(self.load_extension_timed, names))
+
+    async def load_extension_timed(self, formed_name: str):
+        try:
+            with self.startup.phase(f"extension {formed_name}"):
+                await self.load_extension(formed_name)
+            print("Loaded", formed_name)
+        except Exception as e:
+            trace = traceback.format_exception(type(e), e, e.__traceback__)
+            print(f"Failure loading", formed_name, ":", "".join(trace))
+
+    async def prewarm(self):
+        for name in PREWARM_MODULES:
+            with self.startup.phase(f"prewarm {name}"):
                 try:
-                    await self.load_extension(formed_name)
-                    print("Loaded", formed_name)
-                except Exception as e:
-                    trace = traceback.format_exception(type(e), e, e.__traceback__)
-                    print(f"Failure loading", formed_name, ":", "".join(trace))
+                    await asyncio.to_thread(importlib.import_module, name)
+                except Exception:
+                    traceback.print_exc()
 
     async def connect_db(self):
-        self.pool_pg = await asyncpg.create_pool(
+        self.startup.mark("connect_db")
+        with self.startup.phase("db_pool"):
+            await self.create_db_pool()
+
+    async def create_db_pool(self):
+        pool = await asyncpg.create_pool(
             user=self.db_user,
             password=self.db_pass,
-            database=self.db_dbname
+            database=self.db_dbname,
+            min_size=min(10, self.db_pool_size),
+            max_size=self.db_pool_size
         )
+        self.pool_pg = MeteredPool(pool, lanes=self.db_lanes)
+
+    async def start_metrics(self):
+        if not self.metrics_port:
+            return
+
+        self.metrics_server = metrics.MetricsServer(self.metrics_host, self.metrics_port)
+        try:
+            await self.metrics_server.start()
+        except OSError as e:
+            print("Failure to start metrics endpoint.", e, file=sys.stderr)
+            self.metrics_server = None
+
+    def dispatch(self, event_name: str, /, *args: Any, **kwargs: Any) -> None:
+        GATEWAY_EVENTS.inc(event=event_name)
+        super().dispatch(event_name, *args, **kwargs)
+
+    async def _run_event(self, coro: Callable[..., Any], event_name: str, *args: Any, **kwargs: Any) -> None:
+        listener = getattr(coro, "__qualname__", event_name)
+        with LISTENER_SECONDS.time(listener=listener), self.profiler.track(getattr(coro, "__name__", None)):
+            await super()._run_event(coro, event_name, *args, **kwargs)
+
+    async def invoke(self, ctx: commands.Context) -> None:
+        name = ctx.command.qualified_name if ctx.command else None
+        with self.profiler.track(name):
+            await super().invoke(ctx)
 
     async def setup_hook(self):
+        self.startup.mark("login")
+        self.loop_monitor.start()
+        self.cache_bus.start()
+        with self.startup.phase("metrics"):
+            await self.start_metrics()
         await self.load_extensions()
         self.loop.create_task(self.after_ready())
 
+    async def close(self):
+        await super().close()
+        self.loop_monitor.stop()
+        await self.cache_bus.close()
+        await self.ipc_client.close()
+        if self.metrics_server:
+            await self.metrics_server.close()
+
     async def on_ready(self):
         print("Bot is ready")
+        self.startup.mark("gateway_ready")
+        if self._prewarm is None:
+            self._prewarm = asyncio.create_task(self.prewarm())
 
     async def after_ready(self):
         await self.wait_until_ready()
@@ -79,7 +217,7 @@ class NebuBot(commands.Bot):
     async def greet_server(self):
         self.ipc_client(self.user.id)
         try:
-            await self.ipc_client.subscribe()
+            await self.ipc_client.start()
         except Exception as e:
             print("Failure to connect to server.", e, file=sys.stderr)
         else:
@@ -110,13 +248,54 @@ class ChannelHistoryRead:
     channel_id: int
     furthest_read: datetime.datetime
     fully_read: bool
+    newest_read: Optional[int] = None
 
     @classmethod
     def from_database(cls, record):
         channel_id = record["channel_id"]
         furthest_read = record["furthest_read"]
         fully_read = record["fully_read"]
-        return cls(channel_id, furthest_read, fully_read)
+        newest_read = record.get("newest_read")
+        return cls(channel_id, furthest_read, fully_read, newest_read)
+
+    def advance(self, message_id: int) -> bool:
+        """Moves the newest stored message forward, returns whether it moved."""
+        if self.newest_read is not None and message_id <= self.newest_read:
+            return False
+        self.newest_read = message_id
+        return True
+
+
+class ChannelRanking:
+    """The `size` channels of a guild with the highest counts, moved as the counts change instead of sorted again."""
+    __slots__ = ("counts", "size", "channels", "top")
+
+    def __init__(self, counts: Dict[int, int], size: int, channels: Iterable[int]):
+        self.counts = counts
+        self.size = size
+        self.channels: Set[int] = set(channels)
+        self.top: List[Tuple[int, int]] = []
+        self.rank()
+
+    def rank(self) -> None:
+        self.top = heapq.nlargest(self.size, ((c, self.counts[c]) for c in self.channels),
+                                  key=operator.itemgetter(1))
+
+    def update(self, channel_id: int) -> None:
+        self.channels.add(channel_id)
+        count = self.counts[channel_id]
+        for index, (ranked, previous) in enumerate(self.top):
+            if ranked == channel_id:
+                del self.top[index]
+                if count < previous and len(self.channels) > self.size:
+                    # a channel outside of the ranking may be ahead of it now
+                    return self.rank()
+                break
+
+        if len(self.top) >= self.size and count <= self.top[-1][1]:
+            return
+        bisect.insort(self.top, (channel_id, count), key=lambda entry: -entry[1])
+        del self.top[self.size:]
 
 
 @dataclasses.dataclass
@@ -125,33 +304,86 @@ class UserCount:
     user_id: int
     channel_ids: Dict[int, int]
     last_update_channel_ids: Dict[int, int]
+    guild_ids: Dict[int, int] = dataclasses.field(default_factory=dict, repr=False)
+    # the database counters as they were loaded, deltas of other processes written before are already in them
+    loaded_channel_ids: Dict[int, int] = dataclasses.field(default_factory=dict, repr=False)
     _counted: Optional[int] = 0
+    _pending: Dict[int, int] = dataclasses.field(default_factory=collections.Counter, repr=False)
+    _lock: asyncio.Lock = dataclasses.field(default_factory=asyncio.Lock, repr=False)
+    _rankings: Dict[int, ChannelRanking] = dataclasses.field(default_factory=dict, repr=False)
 
     def get_count(self, channel_id: int):
         return self.channel_ids.get(channel_id) or 0
 
-    async def update_channel(self, channel_id: int, /, *, counter: int = 1):
-        if channel_id not in self.last_update_channel_ids:
-            await self.insert_channel(channel_id)
+    def guild_of(self, channel_id: int) -> Optional[int]:
+        if (guild_id := self.guild_ids.get(channel_id)) is None:
+            # DMs and channels the bot can't see yet have no guild, they are looked up again next time
+            if guild := getattr(self.bot.get_channel(channel_id), "guild", None):
+                guild_id = self.guild_ids[channel_id] = guild.id
+        return guild_id
 
+    def add_count(self, channel_id: int, counter: int) -> None:
+        """Counts in memory, keeping the ranking of the channel's guild in order."""
         self.channel_ids[channel_id] += counter
-        await self.update_db(channel_id, counter)
+        if (ranking := self._rankings.get(self.guild_of(channel_id))) is not None:
+            ranking.update(channel_id)
+
+    def add_delta(self, channel_id: int, counter: int, total: int) -> None:
+        """Counts `counter` messages another process wrote, up to the database counter `total`.
+
+        What was written before this user was loaded is already counted.
+        """
+        counter = min(counter, total - self.loaded_channel_ids.get(channel_id, 0))
+        if counter > 0:
+            self.add_count(channel_id, counter)
+
+    def top_channels(self, guild_id: int) -> List[Tuple[int, int]]:
+        """The channels of a guild with the most messages as `(channel_id, count)`, highest first."""
+        if (ranking := self._rankings.get(guild_id)) is None:
+            channels = [c for c in self.channel_ids if self.guild_of(c) == guild_id]
+            ranking = self._rankings[guild_id] = ChannelRanking(self.channel_ids, RANKING_SIZE, channels)
+        return ranking.top
+
+    async def update_channel(self, channel_id: int, /, *, counter: int = 1) -> int:
+        """Counts in memory right away, the database is updated by one caller at a time per user.
+
+        Increments that arrive while an update is running are written together by the next caller. Returns the
+        database counter once the increment is written.
+        """
+        self.add_count(channel_id, counter)
+        self._pending[channel_id] += counter
+        async with self._lock:
+            if not (pending := self._pending.pop(channel_id, 0)):
+                return self.last_update_channel_ids[channel_id]
+
+            try:
+                if channel_id not in self.last_update_channel_ids:
+                    await self.insert_channel(channel_id)
+                await self.update_db(channel_id, pending)
+            except BaseException:
+                self._pending[channel_id] += pending
+                raise
+            return self.last_update_channel_ids[channel_id]
 
     async def update_db(self, channel_id: int, counter: int):
-        query = "UPDATE user_message u SET counter=u.counter + $3 WHERE user_id=$1 AND channel_id=$2 RETURNING counter"
-        data = await self.bot.pool_pg.fetchval(query, self.user_id, channel_id, counter)
+        # rows counted before guild_id existed get it on their next update
+        query = "UPDATE user_message u SET counter=u.counter + $3, guild_id=COALESCE(u.guild_id, $4) " \
+                "WHERE user_id=$1 AND channel_id=$2 RETURNING counter"
+        data = await self.bot.pool_pg.lane("ingestion").fetchval(query, self.user_id, channel_id, counter,
+                                                                 self.guild_of(channel_id))
         self.last_update_channel_ids[channel_id] = data
 
     async def insert_channel(self, channel_id):
-        query = "INSERT INTO user_message(user_id, channel_id) VALUES($1, $2) " \
+        query = "INSERT INTO user_message(user_id, channel_id, guild_id) VALUES($1, $2, $3) " \
                 "ON CONFLICT DO NOTHING"
-        await self.bot.pool_pg.execute(query, self.user_id, channel_id)
+        await self.bot.pool_pg.lane("ingestion").execute(query, self.user_id, channel_id, self.guild_of(channel_id))
         self.last_update_channel_ids[channel_id] = 1
 
     @classmethod
     def from_database(cls, bot: NebuBot, records):
         channel_ids = collections.Counter()
         last_update_channel_ids = {}
+        guild_ids = {}
         user_id = None
         for record in records:
             user_id = record["user_id"]
@@ -159,8 +391,11 @@ class UserCount:
             counted = record['counter']
             channel_ids[channel_id] = counted
             last_update_channel_ids[channel_id] = counted
+            # databases that weren't migrated yet have no guild_id column
+            if (guild_id := record.get("guild_id")) is not None:
+                guild_ids[channel_id] = guild_id
 
-        return cls(bot, user_id, channel_ids, last_update_channel_ids)
+        return cls(bot, user_id, channel_ids, last_update_channel_ids, guild_ids, dict(channel_ids))
 
     @classmethod
     def empty_record(cls, bot: NebuBot, user_id: int):
@@ -171,99 +406,3 @@ class UserCount:
     @property
     def sum_counter(self):
         return sum([*self.channel_ids.values()])
-
-
-class StellaClient(ipc.Client):
-    def __init__(self, *args: Any, **kwargs: Any):
-        super().__init__(*args, **kwargs)
-        self.bot_id = kwargs.pop("bot_id", None)
-        self._listeners = {}
-        self.events = {}
-        self.connect = None
-
-    def __call__(self, bot_id: int) -> None:
-        self.bot_id = bot_id
-
-    def exception_catching_callback(self, task):
-        if task.exception():
-            task.print_stack()
-
-    async def check_init(self) -> None:
-        if not self.session:
-            await self.init_sock()
-        if not self.connect:
-            self.connect = asyncio.create_task(self.connection())
-            self.connect.add_done_callback(self.exception_catching_callback)
-
-    def listen(self) -> Callable[[], Callable]:
-        def inner(coro) -> Callable[..., None]:
-            name = coro.__name__
-            listeners = self.events.setdefault(name, [])
-            listeners.append(coro)
-        return inner
-
-    def wait_for(self, event: str, request_id: str, timeout: Optional[int] = None) -> Any:
-        future = asyncio.get_event_loop().create_future()
-        listeners = self._listeners.setdefault("on_" + event, {})
-        listeners.update({request_id: future})
-        return asyncio.wait_for(future, timeout)
-
-    async def do_request(self, endpoint: str, **data: Dict[str, Any]):
-        await self.check_init()
-        request_id = os.urandom(32).hex()
-        payload = self.create_payload(endpoint, data)
-        payload.update({"request_id": request_id})
-        if self.websocket is None:
-            raise Exception("Server is not connected")
-        await self.websocket.send_json(payload)
-        return await self.wait_for(endpoint, request_id)
-
-    def create_payload(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Union[int, str, Dict[str, Any]]]:
-        return {
-            "endpoint": endpoint,
-            "data": data,
-            "headers": {"Authorization": self.secret_key, "Bot_id": self.bot_id}
-        }
-
-    async def request(self, endpoint: str, **kwargs: Any) -> Dict[str, Any]:
-        return await self.do_request(endpoint, **kwargs)
-
-    async def subscribe(self) -> Dict[str, Any]:
-        data = await self.do_request("start_connection")
-        if data.get("error") is not None:
-            self.connect.cancel()
-            raise Exception(f"Unable to get event from server: {data['error']}")
-        return data
-
-    async def get_response(self) -> AsyncGenerator[Dict[str, Any], None]:
-        while True:
-            recv = await self.websocket.receive()
-            if recv.type == aiohttp.WSMsgType.PING:
-                await self.websocket.ping()
-                continue
-            elif recv.type == aiohttp.WSMsgType.PONG:
-                continue
-            elif recv.type == aiohttp.WSMsgType.CLOSED:
-                await self.session.close()
-                await asyncio.sleep(5)
-                await self.init_sock()
-                continue
-            else:
-                yield recv
-
-    async def connection(self) -> None:
-        async for data in self.get_response():
-            try:
-                respond = json.loads(data.data)
-                event = "on_" + respond.pop("endpoint")
-                value = respond.pop("response")
-                if listeners := self._listeners.get(event):
-                    if request_id := respond.get("request_id"):
-                        if future := listeners.pop(request_id):
-                            future.set_result(value)
-
-                if events := self.events.get(event):
-                    for coro in events:
-                        await coro(value)
-            except Exception as e:
-                print("Ignoring error in gateway:", e)
@@ -0,0 +1,84 @@
+"""Encodings of the IPC protocol.
+
+A connection starts with JSON text frames that carry the `headers` on every payload, which is all the original
+server understands. When the server accepts a format during `start_connection`, both sides switch to binary frames:
+one flag byte followed by the payload in the negotiated format, zlib compressed when the flag says so.
+"""
+import json
+import zlib
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COMPRESSED = 0x01
+DEFAULT_COMPRESS_THRESHOLD = 1024
+
+
+class Codec:
+    def __init__(self, name: str, dumps: Callable[[Any], bytes], loads: Callable[[bytes], Any]):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self) -> str:
+        return f"<Codec name={self.name!r}>"
+
+
+def _json_dumps(value: Any) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+CODECS: Dict[str, Codec] = {}
+if msgpack is not None:
+    CODECS["msgpack"] = Codec("msgpack", msgpack.packb, lambda data: msgpack.unpackb(data, strict_map_key=False))
+if orjson is not None:
+    CODECS["orjson"] = Codec("orjson", orjson.dumps, orjson.loads)
+CODECS["json"] = Codec("json", _json_dumps, json.loads)
+
+
+def available_formats() -> List[str]:
+    """Formats this side supports, the preferred one first."""
+    return [*CODECS]
+
+
+# the text frames stay on the standard json module, like the original peers, which takes int keys and big ints
+def legacy_loads(data: str) -> Any:
+    return json.loads(data)
+
+
+def legacy_dumps(value: Any) -> str:
+    return json.dumps(value)
+
+
+def encode_frame(codec: Codec, value: Any, *, compress_threshold: Optional[int] = None) -> bytes:
+    body = codec.dumps(value)
+    flags = 0
+    if compress_threshold is not None and len(body) >= compress_threshold:
+        body = zlib.compress(body)
+        flags |= COMPRESSED
+    return bytes((flags,)) + body
+
+
+def decode_frame(codec: Codec, frame: bytes) -> Any:
+    body = memoryview(frame)[1:]
+    if frame[0] & COMPRESSED:
+        body = zlib.decompress(body)
+    return codec.loads(bytes(body))
+
+
+def negotiate(offer: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Server side of the handshake, picks the first offered format that is available here."""
+    chosen = next((name for name in offer.get("formats", ()) if name in CODECS), None)
+    if chosen is None:
+        return None
+
+    compression = "zlib" if "zlib" in offer.get("compression", ()) else None
+    return {"format": chosen, "compression": compression, "threshold": DEFAULT_COMPRESS_THRESHOLD}
@@ -1,32 +1,30 @@
-import asyncio
 import logging
+from typing import Type
 
 import discord
 
 from data.models import NebuBot
 
-logging.basicConfig(level=logging.INFO)
-intents = discord.Intents.all()
-bot = NebuBot("!uwu ", intents=intents)
-bot.uptime = discord.utils.utcnow()
 
+def create_bot(bot_class: Type[NebuBot] = NebuBot, **kwargs) -> NebuBot:
+    # intents and caching come from the cache_profile of the config
+    bot = bot_class("!uwu ", **kwargs)
+    bot.uptime = discord.utils.utcnow()
 
-@bot.ipc_client.listen()
-async def on_restarting_server(data):
-    print("Server restarting...")
-    server = bot.ipc_client
-    await server.session.close()
-    print("Server waiting for server respond.")
-    await asyncio.sleep(10)
-    print("Server re-establishing connection")
-    await server.init_sock()
-    print("Server Connection Successful.")
+    @bot.ipc_client.listen()
+    async def on_restarting_server(data):
+        print("Server restarting...")
+        await bot.ipc_client.reconnect()
+        print("Server Connection Successful.")
 
+    @bot.ipc_client.listen()
+    async def on_kill(data):
+        print("Kill has been ordered")
+        await bot.close()
 
-@bot.ipc_client.listen()
-async def on_kill(data):
-    print("Kill has been ordered")
-    await bot.close()
+    return bot
 
 
-bot.starter()
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    create_bot().starter()
@@ -0,0 +1,4 @@
+-- Databases created from sqlcommand before user_message had a guild_id.
+-- Existing rows keep a NULL guild_id until the Personal cog backfills them on ready, or their next count update.
+ALTER TABLE user_message ADD COLUMN IF NOT EXISTS guild_id BIGINT;
+CREATE INDEX IF NOT EXISTS user_message_guild_counter ON user_message(user_id, guild_id, counter DESC);
@@ -0,0 +1,3 @@
+-- Databases created from sqlcommand before channel_count had a newest_read.
+-- Channels without one are caught up from their newest stored message, and the position is saved on the next flush.
+ALTER TABLE channel_count ADD COLUMN IF NOT EXISTS newest_read BIGINT;
@@ -0,0 +1,139 @@
+"""CacheBus between clients of the stand-in IPC server of tools.ipc_server."""
+import asyncio
+import contextlib
+import types
+
+from data.coherence import CacheBus
+from data.ipc import StellaClient
+from data.models import UserCount
+from tools.stand_in_db import Record
+from tools.ipc_server import StandInIPCServer
+
+GUILD_ID = 10
+CHANNELS = {100 + i: types.SimpleNamespace(id=100 + i, guild=types.SimpleNamespace(id=GUILD_ID)) for i in range(3)}
+
+
+class Process:
+    """The caches of one bot process, kept coherent by its own bus."""
+    def __init__(self, client: StellaClient):
+        self.client = client
+        self.bus = CacheBus(client)
+        self.bot = types.SimpleNamespace(get_channel=CHANNELS.get)
+        self.channels = {100: "read state", 101: "read state"}
+        self.users = {1: UserCount.empty_record(self.bot, 1)}
+        self.bus.register("channel_reader", invalidate=lambda key: self.channels.pop(key, None),
+                          clear=self.channels.clear)
+        self.bus.register("user_counter", invalidate=lambda key: self.users.pop(key, None), clear=self.users.clear,
+                          apply_delta=self.apply_delta)
+
+    def apply_delta(self, user_id, channel_id, counter, total):
+        if user_count := self.users.get(user_id):
+            user_count.add_delta(channel_id, counter, total)
+
+
+@contextlib.asynccontextmanager
+async def processes(count):
+    server = StandInIPCServer("secret")
+    port = await server.start()
+    started = []
+    try:
+        for _ in range(count):
+            client = StellaClient(host="127.0.0.1", port=port, secret_key="secret", request_timeout=5)
+            await client.start()
+            started.append(Process(client))
+        yield started
+    finally:
+        for process in started:
+            await process.client.close()
+        await server.close()
+
+
+async def eventually(predicate):
+    while not predicate():
+        await asyncio.sleep(.01)
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+def test_invalidations_fan_out_to_every_other_process():
+    async def main():
+        async with processes(3) as (sender, *others):
+            sender.bus.invalidate("channel_reader", 100)
+            await sender.bus.flush()
+            for other in others:
+                await eventually(lambda: 100 not in other.channels)
+                assert other.channels == {101: "read state"}
+
+            sender.bus.clear("channel_reader")
+            await sender.bus.flush()
+            for other in others:
+                await eventually(lambda: not other.channels)
+
+    run(main())
+
+
+def test_counter_deltas_are_summed_and_applied_through_add_count():
+    async def main():
+        async with processes(2) as (sender, receiver):
+            ranking = receiver.users[1].top_channels(GUILD_ID)
+            assert ranking == []
+            for total in range(1, 4):
+                sender.bus.add_delta("user_counter", 1, 101, 1, total)
+            sender.bus.add_delta("user_counter", 1, 102, 2, 2)
+            # one delta per counter goes over the wire
+            assert sender.bus.pending == 2
+            await sender.bus.flush()
+
+            user_count = receiver.users[1]
+            await eventually(lambda: user_count.get_count(101) == 3)
+            assert user_count.get_count(102) == 2
+            assert user_count.top_channels(GUILD_ID) == [(101, 3), (102, 2)]
+
+    run(main())
+
+
+def test_a_process_ignores_its_own_broadcasts():
+    async def main():
+        async with processes(2) as (sender, receiver):
+            sender.bus.invalidate("channel_reader", 100)
+            sender.bus.add_delta("user_counter", 1, 100, 5, 5)
+            await sender.bus.flush()
+            await eventually(lambda: receiver.users[1].get_count(100) == 5)
+            await asyncio.sleep(.05)
+            assert sender.channels == {100: "read state", 101: "read state"}
+            assert sender.users[1].get_count(100) == 0
+            assert sender.bus.pending == 0
+
+    run(main())
+
+
+def test_deltas_already_in_a_later_load_are_not_counted_again():
+    async def main():
+        async with processes(2) as (sender, receiver):
+            # loaded once the sender wrote 101 up to 5, 102 up to 1 and before it wrote 100
+            index = {"user_id": 0, "channel_id": 1, "counter": 2}
+            records = [Record((1, 101, 5), index), Record((1, 102, 1), index)]
+            receiver.users[1] = UserCount.from_database(receiver.bot, records)
+            sender.bus.add_delta("user_counter", 1, 100, 2, 2)
+            sender.bus.add_delta("user_counter", 1, 101, 2, 5)
+            sender.bus.add_delta("user_counter", 1, 102, 3, 3)
+            await sender.bus.flush()
+
+            user_count = receiver.users[1]
+            await eventually(lambda: user_count.get_count(100) == 2)
+            assert user_count.get_count(101) == 5
+            assert user_count.get_count(102) == 3
+
+    run(main())
+
+
+def test_deltas_are_not_collected_without_peers():
+    async def main():
+        async with processes(1) as (process,):
+            process.bus.send_deltas = False
+            process.bus.add_delta("user_counter", 1, 100, 1, 1)
+            assert process.bus.pending == 0
+
+    run(main())
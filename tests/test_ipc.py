@@ -0,0 +1,148 @@
+"""StellaClient against the stand-in IPC server of tools.ipc_server."""
+import asyncio
+import contextlib
+
+import pytest
+
+from data import wire
+from data.ipc import StellaClient
+from tools.ipc_server import StandInIPCServer
+
+SECRET = "secret"
+
+
+@contextlib.asynccontextmanager
+async def connected(*, negotiate=True, secret_key=SECRET):
+    server = StandInIPCServer(SECRET, negotiate=negotiate)
+
+    @server.route()
+    async def echo(data, session):
+        return data
+
+    port = await server.start()
+    client = StellaClient(host="127.0.0.1", port=port, secret_key=secret_key, request_timeout=5)
+    try:
+        await client.start()
+        yield server, client
+    finally:
+        await client.close()
+        await server.close()
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+
+def test_negotiate_picks_first_offered_format_available():
+    accepted = wire.negotiate({"formats": ["cbor", "json"], "compression": ["zlib"]})
+    assert accepted == {"format": "json", "compression": "zlib", "threshold": wire.DEFAULT_COMPRESS_THRESHOLD}
+    assert wire.negotiate({"formats": ["cbor"]}) is None
+    assert wire.negotiate({"formats": ["json"]})["compression"] is None
+
+
+def test_negotiates_preferred_format():
+    async def main():
+        async with connected() as (server, client):
+            assert client.codec is wire.CODECS[wire.available_formats()[0]]
+            [session] = server.sessions
+            assert session.codec is client.codec
+
+    run(main())
+
+
+def test_negotiates_msgpack_when_both_sides_have_it():
+    pytest.importorskip("msgpack")
+
+    async def main():
+        async with connected() as (_, client):
+            assert client.codec.name == "msgpack"
+            assert await client.request("echo", value={1: [b"bytes", 2.5]}) == {"value": {1: [b"bytes", 2.5]}}
+
+    run(main())
+
+
+def test_falls_back_to_json_without_msgpack(monkeypatch):
+    monkeypatch.delitem(wire.CODECS, "msgpack", raising=False)
+    monkeypatch.delitem(wire.CODECS, "orjson", raising=False)
+    # the client still offers msgpack first, the server only has json
+    monkeypatch.setattr(wire, "available_formats", lambda: ["msgpack", "json"])
+
+    async def main():
+        async with connected() as (_, client):
+            assert client.codec.name == "json"
+            assert await client.request("echo", value=[1, "two"]) == {"value": [1, "two"]}
+
+    run(main())
+
+
+def test_legacy_server_keeps_json_text_frames():
+    async def main():
+        async with connected(negotiate=False) as (server, client):
+            assert client.codec is None
+            [session] = server.sessions
+            assert session.codec is None
+            assert await client.request("echo", value="text") == {"value": "text"}
+            # like the original peers' json, which orjson refuses
+            assert await client.request("echo", value=2 ** 70, keys={1: 2}) == {"value": 2 ** 70, "keys": {"1": 2}}
+
+    run(main())
+
+
+def test_legacy_server_checks_authorization():
+    async def main():
+        server = StandInIPCServer(SECRET, negotiate=False)
+        port = await server.start()
+        client = StellaClient(host="127.0.0.1", port=port, secret_key="wrong", request_timeout=5)
+        try:
+            with pytest.raises(Exception, match="Invalid Authorization"):
+                await client.start()
+        finally:
+            await client.close()
+            await server.close()
+
+    run(main())
+
+
+def test_frames_compressed_above_threshold_only():
+    codec = wire.CODECS["json"]
+    small = wire.encode_frame(codec, {"value": "x"}, compress_threshold=wire.DEFAULT_COMPRESS_THRESHOLD)
+    large_value = {"value": "x" * wire.DEFAULT_COMPRESS_THRESHOLD * 4}
+    large = wire.encode_frame(codec, large_value, compress_threshold=wire.DEFAULT_COMPRESS_THRESHOLD)
+    assert not small[0] & wire.COMPRESSED
+    assert large[0] & wire.COMPRESSED
+    assert len(large) < wire.DEFAULT_COMPRESS_THRESHOLD
+    assert wire.decode_frame(codec, large) == large_value
+
+
+def test_replies_compressed_above_threshold(monkeypatch):
+    flags = []
+    decode_frame = wire.decode_frame
+
+    def recording(codec, frame):
+        flags.append(bool(frame[0] & wire.COMPRESSED))
+        return decode_frame(codec, frame)
+
+    monkeypatch.setattr(wire, "decode_frame", recording)
+
+    async def main():
+        async with connected() as (_, client):
+            assert client.compress_threshold == wire.DEFAULT_COMPRESS_THRESHOLD
+            flags.clear()
+            assert await client.request("echo", value="small") == {"value": "small"}
+            large = "x" * wire.DEFAULT_COMPRESS_THRESHOLD * 4
+            assert await client.request("echo", value=large) == {"value": large}
+
+    run(main())
+    # decoded by the server for the requests and by the client for the replies
+    assert flags == [False, False, True, True]
+
+
+def test_request_round_trip_and_unknown_endpoint():
+    async def main():
+        async with connected() as (_, client):
+            replies = await client.request_many([("echo", {"n": n}) for n in range(50)])
+            assert replies == [{"n": n} for n in range(50)]
+            assert await client.request("missing") == {"error": "Unknown endpoint missing"}
+            assert not client._requests
+
+    run(main())
@@ -0,0 +1,290 @@
+"""Ingestion and query benchmarks for PersonalCog and ChannelsCog.
+
+Runs against the sqlite stand-in by default, or against a scratch Postgres database with `--dsn`. The tables of that
+database are wiped, so never point it at the production database.
+
+    python -m tools.bench_ingestion --rows 10000 1000000 --output bench.json
+    python -m tools.bench_ingestion --rows 10000 --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+import types
+from typing import Any, Awaitable, Callable, Dict, List, Sequence
+
+import discord
+
+from cogs.channels import ChannelsCog
+from cogs.personal import PersonalCog
+from tools.fakes import MessageFactory, SyntheticBot, SyntheticChannel, SyntheticContext, SyntheticGuild, \
+    SyntheticUser
+from tools.stand_in_db import SCHEMA_PATH, StandInPool
+from utils.pool import MeteredPool
+
+TABLES = ("embed_fields", "user_embeds", "user_messages", "user_message", "channel_count")
+SEED_CHUNK = 50_000
+
+
+def percentile(values: Sequence[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    return {
+        "count": len(latencies),
+        "seconds": round(elapsed, 4),
+        "per_second": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        "p50_ms": round(percentile(latencies, .5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, .99) * 1000, 3),
+    }
+
+
+async def measure(coros: Sequence[Awaitable[Any]]) -> Dict[str, float]:
+    """Schedules every coroutine at once, the same way the gateway dispatches listeners."""
+    latencies = []
+
+    async def timed(coro: Awaitable[Any]) -> None:
+        start = time.perf_counter()
+        await coro
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*map(timed, coros))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def measure_serial(func: Callable[[], Awaitable[Any]], iterations: int) -> Dict[str, float]:
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        begin = time.perf_counter()
+        await func()
+        latencies.append(time.perf_counter() - begin)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def create_pool(args: argparse.Namespace):
+    if not args.dsn:
+        return StandInPool.with_schema()
+
+    import asyncpg
+    pool = await asyncpg.create_pool(args.dsn)
+    exists = await pool.fetchval("SELECT to_regclass('user_messages') IS NOT NULL")
+    if not exists:
+        with open(SCHEMA_PATH) as schema:
+            await pool.execute(schema.read())
+    elif await pool.fetchval("SELECT EXISTS(SELECT 1 FROM user_messages)") and not args.reset:
+        await pool.close()
+        raise SystemExit("user_messages is not empty, pass --reset to wipe it.")
+    await pool.execute(f"TRUNCATE {', '.join(TABLES)}")
+    return pool
+
+
+class World:
+    """Guild, channels and users the benchmark runs against."""
+    def __init__(self, pool: Any, *, seed: int, channels: int, users: int):
+        self.factory = MessageFactory(seed)
+        me = SyntheticUser(1, "Nebu")
+        self.guild = SyntheticGuild(10, "Benchmark", me, icon=self.factory.avatar(256))
+        self.users = [SyntheticUser(1000 + i, f"user{i}") for i in range(users)]
+        self.author = self.users[0]
+        for i in range(channels):
+            self.guild.channels.append(SyntheticChannel(100 + i, f"channel-{i}", self.guild))
+        self.channel = self.guild.channels[0]
+        self.bot = SyntheticBot(MeteredPool(pool), [self.guild], user=me)
+        self.bot.users.update((user.id, user) for user in self.users)
+        self.personal = PersonalCog(self.bot)
+        self.channels = ChannelsCog(self.bot)
+
+    def context(self) -> SyntheticContext:
+        return SyntheticContext(self.bot, self.author, self.channel, self.factory.message(self.author, self.channel))
+
+    async def seed(self, rows: int) -> None:
+        """Bulk loads `rows` messages, a fifth of them belonging to the benchmark author in the first channel."""
+        rng = self.factory.rng
+        contents = [self.factory.content() for _ in range(1000)]
+        pool = self.bot.pool_pg
+        remaining = rows
+        while remaining:
+            size = min(SEED_CHUNK, remaining)
+            records = []
+            for _ in range(size):
+                if rng.random() < .2:
+                    user, channel = self.author, self.channel
+                else:
+                    user, channel = rng.choice(self.users), rng.choice(self.guild.channels)
+                records.append((self.factory.next_id(), user.id, channel.id, rng.choice(contents), 0))
+            async with pool.acquire() as con:
+                await con.copy_records_to_table("user_messages", records=records)
+            remaining -= size
+
+        await pool.execute("INSERT INTO user_message(user_id, channel_id, guild_id, counter) "
+                           "SELECT user_id, channel_id, $1, COUNT(*) FROM user_messages GROUP BY user_id, channel_id",
+                           self.guild.id)
+        for channel in self.guild.channels:
+            await pool.execute("INSERT INTO channel_count(channel_id, fully_read) VALUES($1, $2)", channel.id, True)
+
+
+async def run_scale(args: argparse.Namespace, rows: int) -> Dict[str, Any]:
+    pool = await create_pool(args)
+    world = World(pool, seed=args.seed, channels=args.channels, users=args.users)
+    try:
+        start = time.perf_counter()
+        await world.seed(rows)
+        results: Dict[str, Any] = {"seed_seconds": round(time.perf_counter() - start, 4)}
+        cog, factory = world.personal, world.factory
+
+        channel_ids = [channel.id for channel in world.guild.channels]
+        results["hydrate"] = await measure_serial(lambda: cog.hydrate_channels(channel_ids), 1)
+        # the synthetic history starts at MessageFactory.EPOCH, every seeded user counts as recently active
+        cog.HOT_USER_DAYS = (discord.utils.utcnow() - MessageFactory.EPOCH).days + 1
+        results["preload_users"] = await measure_serial(cog.preload_users, 1)
+
+        live = [factory.message(factory.rng.choice(world.users), factory.rng.choice(world.guild.channels))
+                for _ in range(args.messages)]
+        results["on_message"] = await measure([cog.message_counter(message) for message in live])
+
+        backlog = []
+        for i in range(args.backfill_channels):
+            channel = SyntheticChannel(5000 + i, f"backfill-{i}", world.guild)
+            factory.history(channel, world.users, cog.CHANNEL_LIMIT)
+            world.guild.channels.append(channel)
+            backlog.extend(channel.messages)
+        start = time.perf_counter()
+        backfill = asyncio.create_task(cog.reading_session())
+        # commands take their connections from the interactive lane while the backfill holds its own
+        results["totalmessages_during_backfill"] = await measure_serial(
+            lambda: cog.totalmessages.callback(cog, world.context(), world.channel), args.iterations
+        )
+        await backfill
+        elapsed = time.perf_counter() - start
+        results["backfill"] = {"count": len(backlog), "seconds": round(elapsed, 4),
+                               "per_second": round(len(backlog) / elapsed, 2)}
+
+        # messages posted while the bot was offline, read forward from where the backfill stopped
+        downtime = [factory.message(factory.rng.choice(world.users), channel)
+                    for channel in world.guild.channels[args.channels:]
+                    for _ in range(args.downtime_messages // args.backfill_channels)]
+        for message in downtime:
+            message.channel.messages.append(message)
+        start = time.perf_counter()
+        await cog.catch_up()
+        elapsed = time.perf_counter() - start
+        results["catch_up"] = {"count": len(downtime), "seconds": round(elapsed, 4),
+                               "per_second": round(len(downtime) / elapsed, 2)}
+        del world.guild.channels[args.channels:]
+
+        edited = live[:args.messages // 2]
+        for message in edited:
+            message._update({"content": factory.content()})
+        results["edit"] = await measure([cog.edit_message(message) for message in edited])
+        payloads = [types.SimpleNamespace(message_id=message.id) for message in live[args.messages // 2:]]
+        results["delete"] = await measure([cog.message_raw_delete(payload) for payload in payloads])
+
+        search_terms = "bot OR discord OR stella"
+        results["search"] = await measure_serial(
+            lambda: cog.search.callback(cog, world.context(), world.channel, content=search_terms), args.iterations
+        )
+        results["totalmessages"] = await measure_serial(
+            lambda: cog.totalmessages.callback(cog, world.context(), world.channel), args.iterations
+        )
+        for fmt in ("ndjson", "csv"):
+            results[f"export_{fmt}"] = await measure_serial(
+                lambda: cog.export.callback(cog, world.context(), fmt), 1
+            )
+        # mostactive reads the ranking kept by the cached counters, or the guild's top rows for an uncached user
+        results["rank_channels"] = await measure_serial(
+            lambda: cog.rank_channels(world.author.id, world.guild), args.iterations
+        )
+        cog.user_counter.pop(world.author.id, None)
+        results["rank_channels_uncached"] = await measure_serial(
+            lambda: cog.rank_channels(world.author.id, world.guild), args.iterations
+        )
+        cog.ACTIVITY_DAYS = cog.HOT_USER_DAYS
+        results["activity"] = await measure_serial(
+            lambda: cog.activity.callback(cog, world.context(), "server"), max(args.iterations // 10, 1)
+        )
+        channels_cog = world.channels
+        results["topuserchannel"] = await measure_serial(
+            lambda: channels_cog.topuserchannel.callback(channels_cog, world.context(), world.channel),
+            max(args.iterations // 10, 1)
+        )
+        return results
+    finally:
+        await pool.close()
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    for scale, results in current["results"].items():
+        old_results = baseline["results"].get(scale)
+        if old_results is None:
+            continue
+
+        print(f"rows={scale}")
+        for name, values in results.items():
+            old = old_results.get(name)
+            if not isinstance(values, dict) or not isinstance(old, dict):
+                continue
+            changes = [f"{key} {old[key]} -> {value} ({(value - old[key]) / old[key]:+.1%})"
+                       for key, value in values.items() if key != "count" and old.get(key)]
+            print(f"  {name}: " + ", ".join(changes))
+
+
+async def main(args: argparse.Namespace) -> None:
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "discord.py": discord.__version__,
+            "backend": "postgres" if args.dsn else "stand-in",
+            "created_at": discord.utils.utcnow().isoformat(),
+        },
+        "results": {},
+    }
+    for rows in args.rows:
+        print(f"Running with {rows:,} rows", file=sys.stderr)
+        report["results"][str(rows)] = await run_scale(args, rows)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(report, json.load(file))
+
+
+def parse_args(argv: Sequence[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000], help="seeded rows, one run per value")
+    parser.add_argument("--dsn", help="scratch Postgres database, the stand-in is used when omitted")
+    parser.add_argument("--reset", action="store_true", help="allow wiping a non empty database")
+    parser.add_argument("--messages", type=int, default=2000, help="live messages sent through on_message")
+    parser.add_argument("--backfill-channels", type=int, default=5)
+    parser.add_argument("--downtime-messages", type=int, default=2000, help="messages read by the catch up")
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--iterations", type=int, default=50, help="runs of each query command")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare against")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
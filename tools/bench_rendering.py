@@ -0,0 +1,192 @@
+"""Micro benchmarks for utils.image_manipulation.
+
+Every input is generated from a fixed seed so runs are comparable between commits. The functions are called
+synchronously, without the executor hop, to measure the rendering itself. Memory is measured once more per case in
+a forked child, as the growth of its resident set, since Pillow and Agg allocate their buffers outside of the Python
+heap.
+
+    python -m tools.bench_rendering --output render.json
+    python -m tools.bench_rendering --backend agg cairo --only create_bar create_graph
+"""
+import argparse
+import datetime
+import inspect
+import io
+import json
+import multiprocessing
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+import tabulate
+from matplotlib import pyplot as plt
+
+import utils.image_manipulation as im
+from tools.fakes import MessageFactory
+
+BAR_SIZES = (5, 20, 50, 200)
+GRAPH_SIZES = (10, 100, 1000, 10_000)
+AVATAR_SIZES = (128, 512, 1024, 4096)
+ANIMATED_SIZES = (128, 512)
+MATPLOTLIB_FUNCTIONS = ("create_bar", "create_graph")
+
+Case = Tuple[str, str, Callable[[], Any]]
+
+
+def raw(function: Callable) -> Callable:
+    """The synchronous body of an `executor_function`."""
+    return inspect.unwrap(function)
+
+
+def cases(seed: int) -> Iterator[Case]:
+    factory = MessageFactory(seed)
+    rng = factory.rng
+    color = "#ffcccb"
+
+    create_bar = raw(im.create_bar)
+    for size in BAR_SIZES:
+        names = [f"channel-{i}" for i in range(size)]
+        values = [rng.randint(1, 100_000) for _ in range(size)]
+        yield "create_bar", f"{size} bars", lambda n=names, v=values: create_bar(n, v, color)
+
+    create_graph = raw(im.create_graph)
+    start = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    for size in GRAPH_SIZES:
+        dates = [start + datetime.timedelta(hours=i) for i in range(size)]
+        values = [rng.randint(0, 500) for _ in range(size)]
+        yield "create_graph", f"{size} points", lambda d=dates, v=values: create_graph(d, v, color=color)
+
+    bar = create_bar([f"channel-{i}" for i in range(5)], [5, 4, 3, 2, 1], color).getvalue()
+    avatars = [(f"{size}px", factory.avatar(size)) for size in AVATAR_SIZES]
+    avatars += [(f"{size}px animated", factory.avatar(size, frames=10)) for size in ANIMATED_SIZES]
+
+    process_image = raw(im.process_image)
+    for label, avatar in avatars:
+        yield "process_image", label, lambda a=avatar: process_image(io.BytesIO(a), io.BytesIO(bar))
+
+    get_majority_color = raw(im.get_majority_color)
+    for label, avatar in avatars:
+        yield "get_majority_color", label, lambda a=avatar: get_majority_color(io.BytesIO(a))
+
+
+def output_size(value: Any) -> Any:
+    if isinstance(value, io.BytesIO):
+        return len(value.getbuffer())
+    return None
+
+
+def resident_kib(field: str) -> int:
+    """`VmRSS` or `VmHWM` of this process, from /proc."""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise LookupError(field)
+
+
+def measure_memory(func: Callable[[], Any], connection: Any) -> None:
+    """Runs in the child, sends the peak resident growth of one call and the peak of the Python heap in KiB."""
+    try:
+        # resets VmHWM to the current resident set, the child inherits the high water mark of the parent
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        before = resident_kib("VmRSS")
+        peak = None
+    except OSError:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = lambda: resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    func()
+    _, heap = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    after = peak() if peak else resident_kib("VmHWM")
+    connection.send((max(after - before, 0), round(heap / 1024, 1)))
+    connection.close()
+
+
+def run_case(func: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    walls, cpus = [], []
+    value = None
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        value = func()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+
+    # measured in a forked child, the cases are closures and the parent's memory would hide the peak
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(target=measure_memory, args=(func, sender))
+    child.start()
+    sender.close()
+    rss_kib, heap_kib = receiver.recv()
+    child.join()
+    return {
+        "wall_ms": round(statistics.median(walls) * 1000, 3),
+        "cpu_ms": round(statistics.median(cpus) * 1000, 3),
+        "peak_rss_kib": rss_kib,
+        "python_heap_peak_kib": heap_kib,
+        "png_bytes": output_size(value),
+    }
+
+
+def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    for backend in args.backend:
+        plt.switch_backend(backend)
+        for function, label, func in cases(args.seed):
+            if args.only and function not in args.only:
+                continue
+            if backend != args.backend[0] and function not in MATPLOTLIB_FUNCTIONS:
+                continue  # pillow does not care about the matplotlib backend
+
+            print(f"[{backend}] {function} {label}", file=sys.stderr)
+            result = {"function": function, "case": label, "backend": backend}
+            result.update(run_case(func, args.repeat))
+            results.append(result)
+    return results
+
+
+def side_by_side(results: Sequence[Dict[str, Any]], backends: Sequence[str]) -> str:
+    rows: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for result in results:
+        row = rows.setdefault((result["function"], result["case"]), {})
+        row[result["backend"]] = result
+
+    table = []
+    for (function, label), per_backend in rows.items():
+        line = [function, label]
+        for backend in backends:
+            result = per_backend.get(backend)
+            line.append(f"{result['wall_ms']}ms / {result['peak_rss_kib']}KiB" if result else "-")
+        table.append(line)
+    return tabulate.tabulate(table, ["function", "case", *backends], "pretty")
+
+
+def parse_args(argv: Sequence[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", nargs="+", default=["agg"], help="matplotlib backends to compare")
+    parser.add_argument("--only", nargs="+", help="only run these functions")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs of every case, the median is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+def main(args: argparse.Namespace) -> None:
+    results = run(args)
+    print(side_by_side(results, args.backend), file=sys.stderr)
+    output = json.dumps({"seed": args.seed, "repeat": args.repeat, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main(parse_args())
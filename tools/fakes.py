@@ -0,0 +1,335 @@
+"""Synthetic discord objects that are just real enough for the cogs to run offline."""
+import contextlib
+import datetime
+import io
+import itertools
+import random
+import types
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+import discord
+from PIL import Image, ImageDraw
+
+from data.coherence import CacheBus
+from data.ipc import StellaClient
+
+WORDS = (
+    "the", "i", "you", "it", "to", "a", "is", "and", "that", "lol", "of", "in", "this", "what", "for", "me", "on",
+    "no", "yes", "but", "so", "just", "like", "be", "with", "not", "can", "do", "was", "have", "bot", "discord",
+    "python", "async", "await", "server", "channel", "message", "stella", "nebu", "hello", "bruh", "nice", "why",
+    "how", "code", "error", "database", "query", "image", "graph", "when", "rust", "thanks", "good", "night",
+    "morning", "idk", "maybe", "ok", "cool", "pog", "help", "command", "prefix", "ping", "reload", "cog", "test",
+    "commit", "branch", "merge", "review", "deploy", "restart", "shard", "gateway", "embed", "button", "menu",
+)
+LINKS = ("https://github.com/InterStella0", "https://discord.com/developers/docs", "https://docs.python.org/3/")
+
+
+class SyntheticAsset:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def read(self) -> bytes:
+        return self.data
+
+
+class SyntheticUser:
+    def __init__(self, user_id: int, name: str, avatar: Optional[bytes] = None):
+        self.id = user_id
+        self.name = name
+        self.bot = False
+        self.display_avatar = SyntheticAsset(avatar or b"")
+        self.sent: List[SyntheticSentMessage] = []
+        self.received_bytes = 0
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> "SyntheticSentMessage":
+        if (file := kwargs.get("file")) is not None:
+            # uploaded and closed, the way discord.py does
+            self.received_bytes += len(file.fp.read())
+            file.close()
+        message = SyntheticSentMessage(self, content=content, **kwargs)
+        self.sent.append(message)
+        return message
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __eq__(self, other: Any) -> bool:
+        return getattr(other, "id", None) == self.id
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+
+class SyntheticSentMessage:
+    def __init__(self, channel: "SyntheticChannel", **kwargs: Any):
+        self.channel = channel
+        self.kwargs = kwargs
+        self.edits = 0
+
+    async def edit(self, **kwargs: Any) -> "SyntheticSentMessage":
+        self.kwargs.update(kwargs)
+        self.edits += 1
+        return self
+
+    async def delete(self, *, delay: Optional[float] = None) -> None:
+        pass
+
+
+class SyntheticPartialMessage:
+    def __init__(self, channel: "SyntheticChannel", message_id: int):
+        self.channel = channel
+        self.id = message_id
+
+    @property
+    def created_at(self) -> datetime.datetime:
+        return discord.utils.snowflake_time(self.id)
+
+    @property
+    def jump_url(self) -> str:
+        return f"https://discord.com/channels/{self.channel.guild.id}/{self.channel.id}/{self.id}"
+
+
+def _snowflake(value: Union[None, int, datetime.datetime, discord.abc.Snowflake], *, high: bool) -> Optional[int]:
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return discord.utils.time_snowflake(value, high=high)
+    if isinstance(value, int):
+        return value
+    return value.id
+
+
+class SyntheticChannel(discord.TextChannel):
+    """TextChannel that serves its history from memory. Only the attributes the cogs touch are set."""
+    def __init__(self, channel_id: int, name: str, guild: "SyntheticGuild"):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.messages: List[SyntheticMessage] = []
+        self.sent: List[SyntheticSentMessage] = []
+
+    def __repr__(self) -> str:
+        return f"<SyntheticChannel id={self.id} name={self.name!r}>"
+
+    @property
+    def last_message_id(self) -> Optional[int]:
+        return self.messages[-1].id if self.messages else None
+
+    def permissions_for(self, _: Any) -> discord.Permissions:
+        return discord.Permissions.all()
+
+    async def history(self, *, limit: Optional[int] = 100, before: Any = None, after: Any = None,
+                      around: Any = None, oldest_first: Optional[bool] = None):
+        before_id, after_id = _snowflake(before, high=False), _snowflake(after, high=True)
+        if oldest_first is None:
+            oldest_first = after is not None
+
+        messages = self.messages if oldest_first else reversed(self.messages)
+        selected = (m for m in messages
+                    if (before_id is None or m.id < before_id) and (after_id is None or m.id > after_id))
+        for message in itertools.islice(selected, limit):
+            yield message
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> SyntheticSentMessage:
+        message = SyntheticSentMessage(self, content=content, **kwargs)
+        self.sent.append(message)
+        return message
+
+    def get_partial_message(self, message_id: int) -> SyntheticPartialMessage:
+        return SyntheticPartialMessage(self, message_id)
+
+    async def fetch_message(self, message_id: int) -> "SyntheticMessage":
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+        raise discord.NotFound(types.SimpleNamespace(status=404, reason="Not Found"), "Unknown Message")
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class SyntheticGuild:
+    def __init__(self, guild_id: int, name: str, me: SyntheticUser, icon: bytes = b""):
+        self.id = guild_id
+        self.name = name
+        self.me = me
+        self.icon = SyntheticAsset(icon)
+        self.channels: List[SyntheticChannel] = []
+        self.members: Dict[int, SyntheticUser] = {}
+        self.shard_id = 0
+
+    @property
+    def text_channels(self) -> List[SyntheticChannel]:
+        return self.channels
+
+    def get_channel(self, channel_id: int) -> Optional[SyntheticChannel]:
+        return discord.utils.get(self.channels, id=channel_id)
+
+    def get_member(self, user_id: int) -> Optional[SyntheticUser]:
+        return self.members.get(user_id)
+
+
+class SyntheticMessage:
+    def __init__(self, message_id: int, author: SyntheticUser, channel: SyntheticChannel, content: str,
+                 embeds: Iterable[discord.Embed] = (), attachments: int = 0):
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.embeds = list(embeds)
+        self.attachments = [object()] * attachments
+
+    @property
+    def guild(self) -> SyntheticGuild:
+        return self.channel.guild
+
+    @property
+    def created_at(self) -> datetime.datetime:
+        return discord.utils.snowflake_time(self.id)
+
+    @property
+    def jump_url(self) -> str:
+        return f"https://discord.com/channels/{self.guild.id}/{self.channel.id}/{self.id}"
+
+    def _update(self, data: Dict[str, Any]) -> None:
+        if "content" in data:
+            self.content = data["content"]
+        if "embeds" in data:
+            self.embeds = [discord.Embed.from_dict(embed) for embed in data["embeds"]]
+        if "attachments" in data:
+            self.attachments = [object()] * len(data["attachments"])
+
+
+class SyntheticBot:
+    def __init__(self, pool: Any, guilds: Iterable[SyntheticGuild] = (), *, user: Optional[SyntheticUser] = None):
+        self.pool_pg = pool
+        self.guilds = list(guilds)
+        self.user = user or SyntheticUser(1, "Nebu")
+        self.users: Dict[int, SyntheticUser] = {}
+        self.tester = True
+        self.color = 0xffcccb
+        # never connected, the batches stay pending. A lone process like NebuBot, no counter deltas
+        self.cache_bus = CacheBus(StellaClient(host="127.0.0.1", secret_key=None, port=0), send_deltas=False)
+
+    def get_all_channels(self):
+        for guild in self.guilds:
+            yield from guild.channels
+
+    def get_channel(self, channel_id: int) -> Optional[SyntheticChannel]:
+        for guild in self.guilds:
+            if channel := guild.get_channel(channel_id):
+                return channel
+
+    def get_guild(self, guild_id: int) -> Optional[SyntheticGuild]:
+        return discord.utils.get(self.guilds, id=guild_id)
+
+    def get_user(self, user_id: int) -> Optional[SyntheticUser]:
+        return self.users.get(user_id)
+
+    async def fetch_user(self, user_id: int) -> SyntheticUser:
+        return self.users.setdefault(user_id, SyntheticUser(user_id, f"user{user_id % 10000}"))
+
+    async def resolve_user(self, user_id: int, *, guild_id: Optional[int] = None) -> SyntheticUser:
+        return self.get_user(user_id) or await self.fetch_user(user_id)
+
+    async def resolve_users(self, user_ids: Iterable[int], *, guild_id: Optional[int] = None
+                            ) -> Dict[int, SyntheticUser]:
+        return {user_id: await self.resolve_user(user_id) for user_id in user_ids}
+
+    async def wait_until_ready(self) -> None:
+        pass
+
+    async def is_owner(self, _: Any) -> bool:
+        return True
+
+
+class SyntheticContext:
+    def __init__(self, bot: SyntheticBot, author: SyntheticUser, channel: SyntheticChannel,
+                 message: SyntheticMessage):
+        self.bot = bot
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.me = channel.guild.me
+        self.message = message
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> SyntheticSentMessage:
+        return await self.channel.send(content, **kwargs)
+
+    reply = send
+
+    def typing(self):
+        return self.channel.typing()
+
+
+class MessageFactory:
+    """Produces reproducible messages with a word frequency close to a real chat."""
+    EPOCH = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def __init__(self, seed: int = 0, *, start: datetime.datetime = EPOCH):
+        self.rng = random.Random(seed)
+        self.clock = discord.utils.time_snowflake(start) >> 22
+        self.sequence = itertools.count()
+        self._weights = list(itertools.accumulate(1 / rank for rank in range(1, len(WORDS) + 1)))
+
+    def next_id(self) -> int:
+        self.clock += self.rng.randint(1, 5000)
+        return (self.clock << 22) | (next(self.sequence) & 0x3FFFFF)
+
+    def words(self, amount: int) -> str:
+        return " ".join(self.rng.choices(WORDS, cum_weights=self._weights, k=amount))
+
+    def content(self) -> str:
+        content = self.words(self.rng.randint(1, 40))
+        if self.rng.random() < .08:
+            content += " " + self.rng.choice(LINKS)
+        return content
+
+    def embed(self) -> discord.Embed:
+        rng = self.rng
+        embed = discord.Embed(title=self.words(rng.randint(1, 8)), description=self.words(rng.randint(5, 120)),
+                              color=rng.randint(0, 0xFFFFFF))
+        embed.set_author(name=self.words(2))
+        if rng.random() < .5:
+            embed.set_footer(text=self.words(rng.randint(1, 10)))
+        if rng.random() < .3:
+            embed.set_thumbnail(url=rng.choice(LINKS))
+        for _ in range(rng.choice((0, 0, 1, 2, 3, 5))):
+            embed.add_field(name=self.words(rng.randint(1, 4)), value=self.words(rng.randint(1, 30)))
+        return embed
+
+    def message(self, author: SyntheticUser, channel: SyntheticChannel) -> SyntheticMessage:
+        embeds = [self.embed()] if self.rng.random() < .15 else []
+        attachments = self.rng.choice((0,) * 9 + (1, 2))
+        return SyntheticMessage(self.next_id(), author, channel, self.content(), embeds, attachments)
+
+    def history(self, channel: SyntheticChannel, authors: List[SyntheticUser], amount: int) -> None:
+        channel.messages.extend(self.message(self.rng.choice(authors), channel) for _ in range(amount))
+
+    def avatar(self, size: int = 128, *, frames: int = 1) -> bytes:
+        """Gradient avatar with a few shapes, animated as a GIF when more than one frame is asked."""
+        images = []
+        for frame in range(frames):
+            image = Image.new("RGB", (size, size))
+            draw = ImageDraw.Draw(image)
+            base = [self.rng.randint(0, 255) for _ in range(3)]
+            for y in range(0, size, max(size // 64, 1)):
+                shade = tuple((c + y * 255 // size + frame * 10) % 256 for c in base)
+                draw.rectangle((0, y, size, y + max(size // 64, 1)), fill=shade)
+            for _ in range(6):
+                x0, y0 = self.rng.randint(0, size - 1), self.rng.randint(0, size - 1)
+                draw.ellipse((x0, y0, x0 + size // 4, y0 + size // 4), fill=tuple(self.rng.randint(0, 255)
+                                                                                  for _ in range(3)))
+            images.append(image)
+
+        buffer = io.BytesIO()
+        if frames > 1:
+            images[0].save(buffer, format="GIF", save_all=True, append_images=images[1:], duration=80, loop=0)
+        else:
+            images[0].save(buffer, format="PNG")
+        return buffer.getvalue()
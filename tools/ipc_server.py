@@ -0,0 +1,163 @@
+"""Local stand-in for the IPC server StellaClient talks to.
+
+It speaks both the legacy JSON protocol and the negotiated binary formats of `data.wire`, so the client can be
+exercised without the real server.
+
+    python -m tools.ipc_server --port 20000 --secret-key <ipc_key>
+"""
+import argparse
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from aiohttp import web, WSMsgType
+
+from data import wire
+
+Handler = Callable[[Dict[str, Any], "IPCSession"], Awaitable[Any]]
+
+
+class IPCSession:
+    def __init__(self, websocket: web.WebSocketResponse):
+        self.websocket = websocket
+        self.bot_id: Optional[int] = None
+        self.cluster_id: Optional[int] = None
+        self.subscribed = False
+        self.codec: Optional[wire.Codec] = None
+        self.compress_threshold: Optional[int] = None
+
+    async def send(self, payload: Dict[str, Any]) -> None:
+        if self.codec is None:
+            await self.websocket.send_str(wire.legacy_dumps(payload))
+        else:
+            frame = wire.encode_frame(self.codec, payload, compress_threshold=self.compress_threshold)
+            await self.websocket.send_bytes(frame)
+
+
+class StandInIPCServer:
+    def __init__(self, secret_key: Optional[str] = None, *, host: str = "127.0.0.1", port: int = 0,
+                 negotiate: bool = True):
+        self.secret_key = secret_key
+        self.host = host
+        self.port = port
+        self.negotiate = negotiate
+        self.sessions: Set[IPCSession] = set()
+        self.routes: Dict[str, Handler] = {}
+        self.runner: Optional[web.AppRunner] = None
+        self._responding: Set[asyncio.Task] = set()
+        self.route("start_connection")(self.start_connection)
+        self.route("get_restart_data")(self.get_restart_data)
+        self.route("broadcast")(self.broadcast)
+
+    def route(self, name: Optional[str] = None) -> Callable[[Handler], Handler]:
+        def decorator(func: Handler) -> Handler:
+            self.routes[name or func.__name__] = func
+            return func
+        return decorator
+
+    async def start(self) -> int:
+        app = web.Application()
+        app.router.add_get("/", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+        return self.port
+
+    async def close(self) -> None:
+        for session in [*self.sessions]:
+            await session.websocket.close()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def start_connection(self, data: Dict[str, Any], session: IPCSession) -> Dict[str, Any]:
+        session.subscribed = True
+        session.cluster_id = data.get("cluster")
+        response: Dict[str, Any] = {"error": None}
+        if self.negotiate and (offer := data.get("wire")) and (accepted := wire.negotiate(offer)):
+            response["wire"] = accepted
+        return response
+
+    async def get_restart_data(self, data: Dict[str, Any], session: IPCSession) -> Any:
+        return None
+
+    async def broadcast(self, data: Dict[str, Any], session: IPCSession) -> int:
+        """Relays an event between the clusters of a sharded bot."""
+        exclude = None if data.get("include_self") else session
+        return await self.push(data["event"], data.get("data"), exclude=exclude)
+
+    async def push(self, endpoint: str, response: Any, *, exclude: Optional[IPCSession] = None) -> int:
+        """Sends a server event to every subscribed client, returns how many received it."""
+        payload = {"endpoint": endpoint, "response": response}
+        sessions = [s for s in self.sessions if s.subscribed and s is not exclude]
+        results = await asyncio.gather(*(session.send(payload) for session in sessions), return_exceptions=True)
+        return sum(not isinstance(result, BaseException) for result in results)
+
+    def read(self, message: Any, session: IPCSession) -> Optional[Dict[str, Any]]:
+        if message.type == WSMsgType.BINARY:
+            return None if session.codec is None else wire.decode_frame(session.codec, message.data)
+        return wire.legacy_loads(message.data)
+
+    def authorize(self, message: Any, payload: Dict[str, Any], session: IPCSession) -> bool:
+        if message.type == WSMsgType.BINARY:
+            # only negotiated sessions can send binary frames, they were authorized by their handshake
+            return True
+
+        headers = payload.get("headers") or {}
+        if self.secret_key is not None and headers.get("Authorization") != self.secret_key:
+            return False
+        session.bot_id = headers.get("Bot_id", session.bot_id)
+        return True
+
+    async def handle(self, request: web.Request) -> web.WebSocketResponse:
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        session = IPCSession(websocket)
+        self.sessions.add(session)
+        try:
+            async for message in websocket:
+                if message.type not in (WSMsgType.TEXT, WSMsgType.BINARY):
+                    continue
+                task = asyncio.create_task(self.respond(message, session))
+                self._responding.add(task)
+                task.add_done_callback(self._responding.discard)
+        finally:
+            self.sessions.discard(session)
+        return websocket
+
+    async def respond(self, message: Any, session: IPCSession) -> None:
+        payload = self.read(message, session)
+        if payload is None:
+            return
+
+        endpoint = payload.get("endpoint")
+        if not self.authorize(message, payload, session):
+            response = {"error": "Invalid Authorization"}
+        elif (handler := self.routes.get(endpoint)) is None:
+            response = {"error": f"Unknown endpoint {endpoint}"}
+        else:
+            response = await handler(payload.get("data") or {}, session)
+        await session.send({"endpoint": endpoint, "response": response, "request_id": payload.get("request_id")})
+        if endpoint == "start_connection" and isinstance(response, dict) and (accepted := response.get("wire")):
+            session.codec = wire.CODECS[accepted["format"]]
+            session.compress_threshold = accepted["threshold"] if accepted["compression"] else None
+
+
+async def main(args: argparse.Namespace) -> None:
+    server = StandInIPCServer(args.secret_key, host=args.host, port=args.port, negotiate=not args.legacy)
+    port = await server.start()
+    print(f"Stand-in IPC server listening on ws://{args.host}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=20000)
+    parser.add_argument("--secret-key")
+    parser.add_argument("--legacy", action="store_true", help="behave like the original JSON only server")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,208 @@
+"""Replays a gateway trace recorded with the `record` command into PersonalCog, offline.
+
+Events are dispatched as tasks at their recorded offsets divided by `--speed`, or as fast as possible with
+`--speed max`. Latency is measured from the moment an event was due, so it includes the time spent queued behind
+earlier events.
+
+    python -m tools.replay data/traces/raid.jsonl.gz --speed 10
+    python -m tools.replay data/traces/raid.jsonl.gz --speed max --dsn postgres://localhost/nebu_bench --reset
+"""
+import argparse
+import asyncio
+import collections
+import gzip
+import json
+import math
+import sys
+import time
+import types
+from typing import Any, Awaitable, Dict, Iterator, List, Optional, Sequence
+
+import discord
+
+from cogs.personal import PersonalCog
+from tools.bench_ingestion import create_pool, percentile
+from tools.fakes import SyntheticBot, SyntheticChannel, SyntheticGuild, SyntheticMessage, SyntheticUser
+from utils.pool import MeteredPool
+
+SAMPLE_INTERVAL = .1
+
+
+def read_trace(path: str) -> Iterator[Dict[str, Any]]:
+    with gzip.open(path, "rt") as file:
+        header = json.loads(next(file))
+        if header.get("version") != 1:
+            raise SystemExit(f"Unsupported trace version {header.get('version')}")
+        for line in file:
+            yield json.loads(line)
+
+
+class ReplayWorld:
+    """Creates the guilds, channels and users of the trace as they show up."""
+    def __init__(self, pool: Any):
+        self.bot = SyntheticBot(MeteredPool(pool))
+        self.cog = PersonalCog(self.bot)
+        self.guilds: Dict[int, SyntheticGuild] = {}
+        self.channels: Dict[int, SyntheticChannel] = {}
+        self.users: Dict[int, SyntheticUser] = {}
+        self.messages: Dict[int, SyntheticMessage] = {}
+
+    def channel(self, channel_id: int, guild_id: Optional[int]) -> SyntheticChannel:
+        if channel := self.channels.get(channel_id):
+            return channel
+
+        guild_id = int(guild_id or 0)
+        if (guild := self.guilds.get(guild_id)) is None:
+            guild = self.guilds[guild_id] = SyntheticGuild(guild_id, f"guild-{guild_id}", self.bot.user)
+            self.bot.guilds.append(guild)
+        channel = self.channels[channel_id] = SyntheticChannel(channel_id, f"channel-{channel_id}", guild)
+        guild.channels.append(channel)
+        return channel
+
+    def user(self, data: Dict[str, Any]) -> SyntheticUser:
+        user_id = int(data["id"])
+        if (user := self.users.get(user_id)) is None:
+            user = self.users[user_id] = SyntheticUser(user_id, data.get("username", str(user_id)))
+        return user
+
+    def handle(self, event: str, data: Dict[str, Any]) -> Awaitable[Any]:
+        channel = self.channel(int(data["channel_id"]), data.get("guild_id"))
+        if event == "MESSAGE_CREATE":
+            embeds = [discord.Embed.from_dict(embed) for embed in data.get("embeds", [])]
+            message = SyntheticMessage(int(data["id"]), self.user(data["author"]), channel, data.get("content", ""),
+                                       embeds, len(data.get("attachments", [])))
+            self.messages[message.id] = message
+            channel.messages.append(message)
+            return self.cog.message_counter(message)
+
+        if event == "MESSAGE_UPDATE":
+            message_id = int(data["id"])
+            payload = types.SimpleNamespace(message_id=message_id, channel_id=channel.id, guild_id=channel.guild.id,
+                                            data=data, cached_message=self.messages.get(message_id))
+            return self.cog.message_raws_edit(payload)
+
+        if event == "MESSAGE_DELETE":
+            message_id = int(data["id"])
+            self.messages.pop(message_id, None)
+            return self.cog.message_raw_delete(types.SimpleNamespace(message_id=message_id))
+
+        message_ids = {int(message_id) for message_id in data["ids"]}
+        for message_id in message_ids:
+            self.messages.pop(message_id, None)
+        return self.cog.message_raws_delete(types.SimpleNamespace(message_ids=message_ids))
+
+
+class Replayer:
+    def __init__(self, world: ReplayWorld, speed: float):
+        self.world = world
+        self.speed = speed
+        self.latencies: Dict[str, List[float]] = collections.defaultdict(list)
+        self.completions: collections.Counter = collections.Counter()
+        self.queue_samples: List[int] = []
+        self.started = 0.0
+
+    async def run_event(self, event: str, coro: Awaitable[Any], due: float) -> None:
+        try:
+            await coro
+        except Exception as e:
+            print(f"{event} failed: {e!r}", file=sys.stderr)
+        now = time.perf_counter()
+        self.latencies[event].append(now - due)
+        self.completions[int(now - self.started)] += 1
+
+    def in_flight(self, baseline: int) -> int:
+        return len(asyncio.all_tasks()) - baseline
+
+    async def sampler(self, baseline: int) -> None:
+        while True:
+            self.queue_samples.append(self.in_flight(baseline))
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    async def replay(self, events: Iterator[Dict[str, Any]]) -> Dict[str, Any]:
+        baseline = len(asyncio.all_tasks()) + 1
+        sampler = asyncio.create_task(self.sampler(baseline))
+        self.started = time.perf_counter()
+        dispatched = 0
+        for event in events:
+            due = self.started + (event["at"] / self.speed if self.speed else 0)
+            if (delay := due - time.perf_counter()) > 0:
+                await asyncio.sleep(delay)
+            elif not self.speed and dispatched % 100 == 0:
+                await asyncio.sleep(0)
+
+            coro = self.world.handle(event["t"], event["d"])
+            asyncio.create_task(self.run_event(event["t"], coro, max(due, self.started)))
+            dispatched += 1
+
+        # bulk deletes spawn their own tasks, wait for everything the listeners started.
+        while self.in_flight(baseline) > 0:
+            await asyncio.sleep(SAMPLE_INTERVAL)
+        elapsed = time.perf_counter() - self.started
+        sampler.cancel()
+        return self.report(dispatched, elapsed)
+
+    def report(self, dispatched: int, elapsed: float) -> Dict[str, Any]:
+        per_second = [self.completions[second] for second in range(math.ceil(elapsed))] or [0]
+        full_seconds = per_second[:-1] or per_second
+        latencies = {
+            event: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, .5) * 1000, 3),
+                "p99_ms": round(percentile(values, .99) * 1000, 3),
+                "p999_ms": round(percentile(values, .999) * 1000, 3),
+                "max_ms": round(max(values) * 1000, 3),
+            }
+            for event, values in self.latencies.items()
+        }
+        return {
+            "events": dispatched,
+            "seconds": round(elapsed, 4),
+            "per_second": round(dispatched / elapsed, 2) if elapsed else 0,
+            "sustained_per_second": sorted(full_seconds)[len(full_seconds) // 2],
+            "peak_per_second": max(per_second),
+            "queue": {
+                "max": max(self.queue_samples, default=0),
+                "mean": round(sum(self.queue_samples) / len(self.queue_samples), 2) if self.queue_samples else 0,
+            },
+            "latency": latencies,
+        }
+
+
+def parse_speed(value: str) -> float:
+    if value.lower() == "max":
+        return 0
+    speed = float(value.rstrip("x"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def parse_args(argv: Sequence[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="trace file written by the record command")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="1, 10 or max")
+    parser.add_argument("--dsn", help="scratch Postgres database, the stand-in is used when omitted")
+    parser.add_argument("--reset", action="store_true", help="allow wiping a non empty database")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser.parse_args(argv)
+
+
+async def main(args: argparse.Namespace) -> None:
+    pool = await create_pool(args)
+    try:
+        replayer = Replayer(ReplayWorld(pool), args.speed)
+        report = await replayer.replay(read_trace(args.trace))
+    finally:
+        await pool.close()
+
+    report["speed"] = args.speed or "max"
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
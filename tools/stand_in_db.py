@@ -0,0 +1,298 @@
+"""In-process stand-in for an asyncpg pool, backed by sqlite.
+
+It understands the subset of PostgreSQL that the cogs use by rewriting queries into sqlite, which is enough to run
+the benchmarks and replays without a database server. Numbers are only comparable to other stand-in runs.
+"""
+import asyncio
+import contextlib
+import datetime
+import functools
+import itertools
+import json
+import os
+import re
+import sqlite3
+import struct
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sqlcommand")
+
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat())
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("BOOLEAN", lambda value: bool(int(value)))
+
+_REWRITES: List[Tuple[re.Pattern, Any]] = [
+    (re.compile(r"=\s*ANY\(\$(\d+)(::\w+\[\])?\)", re.I), r"IN (SELECT value FROM json_each(?\1))"),
+    (re.compile(r"SELECT \* FROM unnest\(((?:\s*\$\d+(?:::\w+\[\])?\s*,?)+)\)", re.I), lambda m: _zip_arrays(m[1])),
+    # the WHERE keeps sqlite from reading a following ON CONFLICT as a join constraint
+    (re.compile(r"SELECT\s+unnest\(\$(\d+)(::\w+\[\])?\)", re.I), r"SELECT value FROM json_each(?\1) WHERE true"),
+    (re.compile(r"::\w+(\[\])?"), ""),
+    (re.compile(r"\$(\d+)"), r"?\1"),
+    (re.compile(r"VALUES\s*\(\s*DEFAULT\s*,", re.I), "VALUES(NULL,"),
+    (re.compile(r"UPDATE\s+(\w+)\s+(?!SET\b)(\w+)\s+SET", re.I), r"UPDATE \1 AS \2 SET"),
+    (re.compile(r"\bGREATEST\(", re.I), "MAX("),
+    (re.compile(r"\bLEAST\(", re.I), "MIN("),
+    (re.compile(r"BIGSERIAL PRIMARY KEY", re.I), "INTEGER PRIMARY KEY"),
+]
+
+
+def _zip_arrays(arguments: str) -> str:
+    """Multi-array unnest, the other arrays are indexed by the position in the first one."""
+    first, *rest = re.findall(r"\$(\d+)", arguments)
+    columns = "".join(f", json_extract(?{n}, '$[' || a.key || ']')" for n in rest)
+    return f"SELECT a.value{columns} FROM json_each(?{first}) a WHERE true"
+
+
+@functools.lru_cache(maxsize=512)
+def translate(query: str) -> str:
+    for pattern, replacement in _REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def adapt(value: Any) -> Any:
+    if isinstance(value, (list, tuple)):
+        return json.dumps([adapt(v) for v in value], default=str)
+    return value
+
+
+class Record:
+    """Read-only row that can be indexed by position or by column name, like `asyncpg.Record`."""
+    __slots__ = ("_values", "_index")
+
+    def __init__(self, values: Sequence[Any], index: Dict[str, int]):
+        self._values = values
+        self._index = index
+
+    def __getitem__(self, key: Any) -> Any:
+        if isinstance(key, str):
+            return self._values[self._index[key]]
+        return self._values[key]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        index = self._index.get(key)
+        return default if index is None else self._values[index]
+
+    def keys(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def values(self) -> Iterator[Any]:
+        return iter(self._values)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return zip(self._index, self._values)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._values)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __repr__(self) -> str:
+        return "<Record " + " ".join(f"{k}={v!r}" for k, v in self.items()) + ">"
+
+
+def _status(query: str, cursor: sqlite3.Cursor) -> str:
+    verb = query.lstrip().split(None, 1)[0].upper()
+    if verb == "INSERT":
+        return f"INSERT 0 {cursor.rowcount}"
+    if verb in ("UPDATE", "DELETE"):
+        return f"{verb} {cursor.rowcount}"
+    return verb
+
+
+class StandInConnection:
+    _savepoints = itertools.count()
+
+    def __init__(self, database: sqlite3.Connection, transaction_lock: asyncio.Lock):
+        self._db = database
+        self._transaction_lock = transaction_lock
+
+    def _run(self, query: str, args: Sequence[Any]) -> Tuple[sqlite3.Cursor, List[Record]]:
+        cursor = self._db.execute(translate(query), [adapt(arg) for arg in args])
+        rows = cursor.fetchall()
+        if cursor.description is None:
+            return cursor, []
+        index = {column[0]: i for i, column in enumerate(cursor.description)}
+        return cursor, [Record(row, index) for row in rows]
+
+    async def execute(self, query: str, *args: Any, timeout: Optional[float] = None) -> str:
+        await asyncio.sleep(0)
+        if not args and ";" in query.strip().rstrip(";"):
+            self._db.executescript(translate(query))
+            return "SCRIPT"
+        cursor, _ = self._run(query, args)
+        return _status(query, cursor)
+
+    async def executemany(self, command: str, args: Iterable[Sequence[Any]], *,
+                          timeout: Optional[float] = None) -> None:
+        await asyncio.sleep(0)
+        self._db.executemany(translate(command), ([adapt(v) for v in row] for row in args))
+
+    async def fetch(self, query: str, *args: Any, timeout: Optional[float] = None) -> List[Record]:
+        await asyncio.sleep(0)
+        return self._run(query, args)[1]
+
+    async def fetchrow(self, query: str, *args: Any, timeout: Optional[float] = None) -> Optional[Record]:
+        rows = await self.fetch(query, *args)
+        return rows[0] if rows else None
+
+    async def fetchval(self, query: str, *args: Any, column: int = 0, timeout: Optional[float] = None) -> Any:
+        row = await self.fetchrow(query, *args)
+        return None if row is None else row[column]
+
+    def cursor(self, query: str, *args: Any, prefetch: Optional[int] = None,
+               timeout: Optional[float] = None) -> "StandInCursor":
+        return StandInCursor(self._db, query, args, prefetch or 50)
+
+    async def copy_records_to_table(self, table_name: str, *, records: Iterable[Sequence[Any]],
+                                    columns: Optional[Sequence[str]] = None, **_: Any) -> str:
+        records = list(records)
+        if not records:
+            return "COPY 0"
+        names = f"({', '.join(columns)})" if columns else ""
+        marks = ", ".join("?" * len(records[0]))
+        self._db.executemany(f"INSERT INTO {table_name}{names} VALUES({marks})", records)
+        await asyncio.sleep(0)
+        return f"COPY {len(records)}"
+
+    async def copy_from_query(self, query: str, *args: Any, output: Any, format: str,
+                              timeout: Optional[float] = None, **_: Any) -> str:
+        """Writes the rows in PostgreSQL's binary COPY format, integers as BIGINT and text as UTF-8.
+
+        Only `format="binary"` is part of the stand-in, the callers that copy out only read binary rows.
+        """
+        if format != "binary":
+            raise ValueError(f"the stand-in copies out with format='binary' only, not {format!r}")
+
+        _, records = self._run(query, args)
+        chunks = [b"PGCOPY\n\xff\r\n\x00", struct.pack(">ii", 0, 0)]
+        for record in records:
+            chunks.append(struct.pack(">h", len(record)))
+            for value in record:
+                if value is None:
+                    chunks.append(struct.pack(">i", -1))
+                elif isinstance(value, int):
+                    chunks.append(struct.pack(">iq", 8, value))
+                else:
+                    data = str(value).encode()
+                    chunks.append(struct.pack(">i", len(data)) + data)
+        chunks.append(struct.pack(">h", -1))
+        data = b"".join(chunks)
+        if callable(output):
+            await output(data)
+        else:
+            output.write(data)
+        await asyncio.sleep(0)
+        return f"COPY {len(records)}"
+
+    @contextlib.asynccontextmanager
+    async def transaction(self, **_: Any):
+        # every connection shares the sqlite connection, interleaved savepoints would release each other
+        async with self._transaction_lock:
+            name = f"sp_{next(self._savepoints)}"
+            self._db.execute(f"SAVEPOINT {name}")
+            try:
+                yield
+            except BaseException:
+                self._db.execute(f"ROLLBACK TO {name}")
+                self._db.execute(f"RELEASE {name}")
+                raise
+            else:
+                self._db.execute(f"RELEASE {name}")
+
+
+class StandInCursor:
+    """Rows of a query, iterated `prefetch` at a time or moved with `fetch` once awaited, like an asyncpg cursor."""
+    def __init__(self, database: sqlite3.Connection, query: str, args: Sequence[Any], prefetch: int):
+        self._db = database
+        self.query = query
+        self.args = args
+        self.prefetch = prefetch
+        self._cursor: Optional[sqlite3.Cursor] = None
+        self._index: Dict[str, int] = {}
+
+    def _open(self) -> sqlite3.Cursor:
+        cursor = self._db.execute(translate(self.query), [adapt(arg) for arg in self.args])
+        self._index = {column[0]: i for i, column in enumerate(cursor.description)}
+        return cursor
+
+    def __await__(self):
+        async def opened() -> "StandInCursor":
+            await asyncio.sleep(0)
+            self._cursor = self._open()
+            return self
+        return opened().__await__()
+
+    async def fetch(self, n: int, *, timeout: Optional[float] = None) -> List[Record]:
+        await asyncio.sleep(0)
+        return [Record(row, self._index) for row in self._cursor.fetchmany(n)]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        cursor = self._open()
+        try:
+            while rows := cursor.fetchmany(self.prefetch):
+                for row in rows:
+                    yield Record(row, self._index)
+                await asyncio.sleep(0)
+        finally:
+            cursor.close()
+
+
+class _StandInAcquire:
+    def __init__(self, pool: "StandInPool"):
+        self.pool = pool
+        self.connection = None
+
+    async def _acquire(self) -> StandInConnection:
+        self.pool._in_use += 1
+        return StandInConnection(self.pool._db, self.pool._transaction_lock)
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+    async def __aenter__(self) -> StandInConnection:
+        self.connection = await self._acquire()
+        return self.connection
+
+    async def __aexit__(self, *_: Any) -> None:
+        await self.pool.release(self.connection)
+
+
+class StandInPool(StandInConnection):
+    """Pool shaped object over a single in-memory sqlite connection."""
+    def __init__(self, path: str = ":memory:", *, max_size: int = 10):
+        database = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
+        database.execute("PRAGMA journal_mode=MEMORY")
+        database.execute("PRAGMA synchronous=OFF")
+        super().__init__(database, asyncio.Lock())
+        self._max_size = max_size
+        self._in_use = 0
+
+    @classmethod
+    def with_schema(cls, path: str = ":memory:", **kwargs: Any) -> "StandInPool":
+        pool = cls(path, **kwargs)
+        with open(SCHEMA_PATH) as schema:
+            pool._db.executescript(translate(schema.read()))
+        return pool
+
+    def acquire(self, *, timeout: Optional[float] = None) -> _StandInAcquire:
+        return _StandInAcquire(self)
+
+    async def release(self, connection: StandInConnection) -> None:
+        self._in_use -= 1
+
+    def get_size(self) -> int:
+        return self._max_size
+
+    def get_max_size(self) -> int:
+        return self._max_size
+
+    def get_idle_size(self) -> int:
+        return max(self._max_size - self._in_use, 0)
+
+    async def close(self) -> None:
+        self._db.close()
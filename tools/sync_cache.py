@@ -0,0 +1,45 @@
+"""Tells the running bot processes to drop cached entries, after the database was changed outside of the bot.
+
+Connects to the IPC server of the config and sends one cache_sync batch, the same way the processes sync each other.
+
+    python -m tools.sync_cache --invalidate user_counter 1234 5678
+    python -m tools.sync_cache --clear channel_reader
+"""
+import argparse
+import asyncio
+from typing import Sequence
+
+from data.coherence import SYNC_EVENT, CacheBus
+from data.ipc import StellaClient
+from data.models import NebuBot
+
+
+async def main(args: argparse.Namespace) -> None:
+    settings = NebuBot.get_config()
+    client = StellaClient(host=settings["websocket_ip"], secret_key=settings["ipc_key"], port=settings["ipc_port"])
+    bus = CacheBus(client)
+    for cache in args.clear:
+        bus.clear(cache)
+    if args.invalidate:
+        cache, *keys = args.invalidate
+        for key in keys:
+            bus.invalidate(cache, int(key) if key.isdigit() else key)
+
+    await client.start()
+    try:
+        batch = bus.take_batch()
+        received = await client.broadcast(SYNC_EVENT, batch) if batch else 0
+        print(f"Sent to {received} processes")
+    finally:
+        await client.close()
+
+
+def parse_args(argv: Sequence[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--invalidate", nargs="+", metavar=("CACHE", "KEY"), help="cache followed by its keys")
+    parser.add_argument("--clear", nargs="+", default=[], metavar="CACHE", help="caches to empty")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
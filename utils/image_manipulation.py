@@ -18,8 +18,11 @@ from matplotlib.patches import Polygon
 from scipy.interpolate import make_interp_spline
 from jishaku.functools import executor_function
 
+from utils import metrics
+
 
 matplotlib.use('Agg')
+RENDER_SECONDS = metrics.Histogram("nebu_render_seconds", "Time spent rendering images.", ["function"])
 
 
 def create_gradient_array(color: str, *, alpha_min: Optional[int] = 0, alpha_max: Optional[int] = 1) -> np.array:
@@ -30,7 +33,8 @@ def create_gradient_array(color: str, *, alpha_min: Optional[int] = 0, alpha_max
 
 
 @executor_function
-def create_graph(x: List[datetime.datetime], y: List[int], **kwargs: int):
+@metrics.timed(RENDER_SECONDS, function="create_graph")
+def create_graph(x: List[datetime.datetime], y: List[int], **kwargs: Any):
     color = str(kwargs.get("color"))
     fig, axes = plt.subplots()
     date_np = np.array(sorted(x))
@@ -62,7 +66,7 @@ def create_graph(x: List[datetime.datetime], y: List[int], **kwargs: int):
     for side in 'bottom', 'top', 'left', 'right':
         axes.spines[side].set_color('white')
 
-    for side, name in zip(("x", "y"), ("Time (UTC)", "Command Usage")):
+    for side, name in zip(("x", "y"), ("Time (UTC)", kwargs.get("label", "Command Usage"))):
         getattr(axes, side + 'axis').label.set_color('white')
         axes.tick_params(axis=side, colors=color)
         getattr(axes, f"set_{side}label")(name, fontsize=17)
@@ -100,6 +104,7 @@ def inverse_color(*rgb: int) -> List[int]:
 
 
 @executor_function
+@metrics.timed(RENDER_SECONDS, function="create_bar")
 def create_bar(x_val: List[Any], y_val: List[Any], color: str, **kwargs: Any) -> Coroutine[Any, Any, io.BytesIO]:
     h = len(x_val) * .48
     fig, axes = plt.subplots(figsize=(6.4, h))
@@ -155,6 +160,7 @@ def save_matplotlib(fig: Figure, axes: Axes) -> io.BytesIO:
     fig.add_axes(axes)
     buffer = io.BytesIO()
     fig.savefig(buffer, transparent=True, bbox_inches="tight")
+    buffer.seek(0)
     axes.clear()
     fig.clf()
     plt.close(fig)
@@ -162,6 +168,7 @@ def save_matplotlib(fig: Figure, axes: Axes) -> io.BytesIO:
 
 
 @executor_function
+@metrics.timed(RENDER_SECONDS, function="process_image")
 def process_image(avatar_bytes: io.BytesIO, target: io.BytesIO) -> Coroutine[Any, Any, io.BytesIO]:
     with Image.open(avatar_bytes).convert('RGBA') as avatar, Image.open(target) as target:
         side = max(avatar.size)
@@ -185,6 +192,7 @@ def process_image(avatar_bytes: io.BytesIO, target: io.BytesIO) -> Coroutine[Any
 
 
 @executor_function
+@metrics.timed(RENDER_SECONDS, function="get_majority_color")
 def get_majority_color(b: io.BytesIO) -> Coroutine[Any, Any, discord.Color]:
     with Image.open(b) as target:
         smol = target.quantize(4)
@@ -119,6 +119,7 @@ class InteractionPages(CallbackView, MenuBase):
         self.current_interaction = None
         self.cooldown = commands.CooldownMapping.from_cooldown(1, 10, commands.BucketType.user)
         self.prompter: Optional[InteractionPages.PagePrompt] = None
+        self.init_render_cache()
 
     class PagePrompt(BaseModal):
         page_number = discord.ui.TextInput(label="Page Number", min_length=1, required=True)
@@ -161,6 +162,7 @@ class InteractionPages(CallbackView, MenuBase):
         if self.prompter:
             self.prompter.stop()
 
+        self.stop_prerendering()
         super().stop()
 
     def selecting_page(self, interaction: discord.Interaction) -> Awaitable[None]:
@@ -175,8 +177,8 @@ class InteractionPages(CallbackView, MenuBase):
         if self.message is None:
             self.message = await self.send_initial_message(ctx, ctx.channel)
         else:
-            page = await self._source.get_page(self.current_page)
-            kwargs = await self._get_kwargs_from_page(page)
+            kwargs = self.page_kwargs(await self.render_page(self.current_page))
+            self.prerender(self.current_page)
             response = interaction and not interaction.response.is_done()
             edit_method = self.message.edit
             if response:
@@ -223,6 +225,11 @@ class InteractionPages(CallbackView, MenuBase):
         value.update({'allowed_mentions': discord.AllowedMentions(replied_user=False)})
         return value
 
+    def page_kwargs(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        self.format_view()
+        kwargs.setdefault('view', self)
+        return super().page_kwargs(kwargs)
+
     def format_view(self) -> None:
         for i, b in enumerate(self.children):
             b.disabled = any(
@@ -1,19 +1,48 @@
+import asyncio
+import collections
+import contextlib
 import re
-from typing import Any, Dict, Union
+import traceback
+from typing import Any, Dict, List, Optional, Sequence, Union
 
 import discord
+import tabulate
 from discord.ext import menus, commands
 from discord.ext.menus import PageSource, First, Last
 
+from utils import metrics
+
+PAGE_RENDERS = metrics.Counter("nebu_page_renders_total", "Menu pages shown, rendered or served from the cache.",
+                               ["result"])
+PAGE_REGEX = re.compile(r'(Page)?(\s)?((\[)?((?P<current>\d+)/(?P<last>\d+))(\])?)')
+
+
+class PageRender:
+    """The menu as `format_page` sees it while a page other than the current one is rendered ahead."""
+    def __init__(self, menu: "MenuBase", page_number: int):
+        self.menu = menu
+        self.current_page = page_number
+
+    def generate_page(self, content: Union[discord.Embed, str], maximum: int) -> Union[discord.Embed, str]:
+        return self.menu.generate_page(content, maximum, page_number=self.current_page)
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self.menu, item)
+
 
 class MenuBase(menus.MenuPages):
     """This is a MenuPages class that is used every single paginator menus. All it does is replace the default emoji
-       with a custom emoji, and keep the functionality."""
+       with a custom emoji, and keep the functionality.
+
+       Rendered pages are kept for the last `RENDER_CACHE_SIZE` pages and the pages next to the one shown are
+       rendered in the background, so flipping pages is only a message edit."""
+    RENDER_CACHE_SIZE = 8
 
     def __init__(self, source: PageSource, *, generate_page: bool = True, **kwargs: Any):
         super().__init__(source, delete_message_after=kwargs.pop('delete_message_after', True), **kwargs)
         self.info = False
         self._generate_page = generate_page
+        self.init_render_cache()
         for x in list(self._buttons):
             if ":" not in str(x):  # I dont care
                 self._buttons.pop(x)
@@ -43,10 +72,11 @@ class MenuBase(menus.MenuPages):
         """Remove this message."""
         self.stop()
 
-    async def _get_kwargs_format_page(self, page: Any) -> Dict[str, Any]:
-        value = await discord.utils.maybe_coroutine(self._source.format_page, self, page)
+    async def _get_kwargs_format_page(self, page: Any, page_number: Optional[int] = None) -> Dict[str, Any]:
+        menu = self if page_number in (None, self.current_page) else PageRender(self, page_number)
+        value = await discord.utils.maybe_coroutine(self._source.format_page, menu, page)
         if self._generate_page:
-            value = self.generate_page(value, self._source.get_max_pages())
+            value = menu.generate_page(value, self._source.get_max_pages())
         if isinstance(value, dict):
             return value
         elif isinstance(value, str):
@@ -59,25 +89,162 @@ class MenuBase(menus.MenuPages):
         dicts.update({'allowed_mentions': discord.AllowedMentions(replied_user=False)})
         return dicts
 
-    def generate_page(self, content: Union[discord.Embed, str], maximum: int) -> Union[discord.Embed, str]:
-        PAGE_REGEX = r'(Page)?(\s)?((\[)?((?P<current>\d+)/(?P<last>\d+))(\])?)'
+    def init_render_cache(self) -> None:
+        """State of the rendered pages, for menus that don't go through `__init__`."""
+        self._rendered: collections.OrderedDict[tuple, Dict[str, Any]] = collections.OrderedDict()
+        self._prerendering: Optional[asyncio.Task] = None
+
+    def render_key(self, page_number: int) -> tuple:
+        # lazy sources show whether they ran out of rows, which can change without the page count changing
+        return page_number, self._source.get_max_pages(), getattr(self._source, "exhausted", None)
+
+    async def render_page(self, page_number: int) -> Dict[str, Any]:
+        """The message kwargs of a page, memoised per page and what the source knows about its pages."""
+        key = self.render_key(page_number)
+        if (kwargs := self._rendered.get(key)) is not None:
+            self._rendered.move_to_end(key)
+            PAGE_RENDERS.inc(result="cached")
+            return {**kwargs}
+
+        page = await self._source.get_page(page_number)
+        kwargs = await self._get_kwargs_format_page(page, page_number)
+        # sources that load lazily know more pages once the page is loaded
+        self._rendered[self.render_key(page_number)] = kwargs
+        while len(self._rendered) > self.RENDER_CACHE_SIZE:
+            self._rendered.popitem(last=False)
+        PAGE_RENDERS.inc(result="rendered")
+        return {**kwargs}
+
+    def page_kwargs(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        kwargs.update({'allowed_mentions': discord.AllowedMentions(replied_user=False)})
+        return kwargs
+
+    async def show_page(self, page_number: int) -> None:
+        kwargs = await self.render_page(page_number)
+        self.current_page = page_number
+        await self.message.edit(**self.page_kwargs(kwargs))
+        self.prerender(page_number)
+
+    def prerender(self, page_number: int) -> None:
+        """Renders the pages around `page_number` in the background."""
+        if self._prerendering is not None:
+            self._prerendering.cancel()
+        self._prerendering = asyncio.create_task(self.prerender_pages([page_number + 1, page_number - 1]))
+
+    async def prerender_pages(self, page_numbers: List[int]) -> None:
+        for page_number in page_numbers:
+            max_pages = self._source.get_max_pages()
+            if page_number < 0 or (max_pages is not None and page_number >= max_pages):
+                continue
+            try:
+                await self.render_page(page_number)
+            except IndexError:
+                pass
+            except Exception:
+                traceback.print_exc()
+
+    def stop_prerendering(self) -> None:
+        if self._prerendering is not None:
+            self._prerendering.cancel()
+            self._prerendering = None
+
+    def stop(self) -> None:
+        self.stop_prerendering()
+        super().stop()
+
+    def generate_page(self, content: Union[discord.Embed, str], maximum: int, *,
+                      page_number: Optional[int] = None) -> Union[discord.Embed, str]:
         if maximum > 0:
-            page = f"Page {self.current_page + 1}/{maximum}"
+            current = self.current_page if page_number is None else page_number
+            page = f"Page {current + 1}/{maximum}"
             if isinstance(content, discord.Embed):
                 if embed_dict := getattr(content, "_author", None):
-                    if not re.match(PAGE_REGEX, embed_dict["name"]):
+                    if not PAGE_REGEX.match(embed_dict["name"]):
                         embed_dict["name"] += f"[{page.replace('Page ', '')}]"
                     return content
                 return content.set_author(name=page)
-            elif isinstance(content, str) and not re.match(PAGE_REGEX, content):
+            elif isinstance(content, str) and not PAGE_REGEX.match(content):
                 return f"{page}\n{content}"
         return content
 
     async def send_initial_message(self, ctx: commands.Context, channel: discord.TextChannel) -> discord.Message:
-        page = await self._source.get_page(self.current_page)
-        kwargs = await self._get_kwargs_from_page(page)
+        kwargs = self.page_kwargs(await self.render_page(self.current_page))
+        self.prerender(self.current_page)
         if self.message is None:
             return await ctx.reply(**kwargs)
         else:
             await self.message.edit(**kwargs)
             return self.message
+
+
+class CursorPageSource(PageSource):
+    """Pages over the rows of a query that are fetched through a server-side cursor as they are viewed.
+
+    The query runs in a read only transaction, on a connection that is held until `close`. Every fetch is bound by
+    `timeout` and no more than `max_rows` rows are read. Pages are tabulated once when fetched, the page after the one
+    being shown is always fetched ahead.
+    """
+    def __init__(self, pool: Any, query: str, *args: Any, per_page: int = 8, max_rows: int = 1000,
+                 timeout: float = 10):
+        self.pool = pool
+        self.query = query
+        self.args = args
+        self.per_page = per_page
+        self.max_rows = max_rows
+        self.timeout = timeout
+        self.pages: List[str] = []
+        self.rows = 0
+        self.exhausted = False
+        self.cursor = None
+        self._stack = contextlib.AsyncExitStack()
+        self._lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        try:
+            connection = await self._stack.enter_async_context(self.pool.acquire())
+            await self._stack.enter_async_context(connection.transaction(readonly=True))
+            self.cursor = await connection.cursor(self.query, *self.args, timeout=self.timeout)
+            await self.load(0)
+        except BaseException:
+            await self.close()
+            raise
+
+    async def close(self) -> None:
+        self.cursor = None
+        await self._stack.aclose()
+
+    async def fetch_page(self) -> None:
+        size = min(self.per_page, self.max_rows - self.rows)
+        rows = await self.cursor.fetch(size, timeout=self.timeout)
+        self.rows += len(rows)
+        if len(rows) < size or self.rows >= self.max_rows:
+            self.exhausted = True
+        if rows:
+            self.pages.append(self.tabulate(rows))
+
+    @staticmethod
+    def tabulate(rows: Sequence[Any]) -> str:
+        table = tabulate.tabulate([[*row.values()] for row in rows], [*rows[0].keys()], "pretty")
+        return f"```py\n{table}```"
+
+    async def load(self, page_number: int) -> None:
+        """Fetches the pages up to the one after `page_number`."""
+        async with self._lock:
+            while len(self.pages) <= page_number + 1 and not self.exhausted and self.cursor is not None:
+                await self.fetch_page()
+
+    async def get_page(self, page_number: int) -> str:
+        await self.load(page_number)
+        return self.pages[page_number]
+
+    def is_paginating(self) -> bool:
+        return len(self.pages) > 1
+
+    def get_max_pages(self) -> Optional[int]:
+        # one page past the shown one is always fetched, the last page is only known once the rows run out
+        return len(self.pages)
+
+    async def format_page(self, menu: menus.MenuPages, page: str) -> str:
+        more = "" if self.exhausted else "+"
+        capped = f", stopped at {self.max_rows:,} rows" if self.exhausted and self.rows >= self.max_rows else ""
+        return f"Page {menu.current_page + 1}/{len(self.pages)}{more}{capped}\n{page}"
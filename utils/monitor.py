@@ -0,0 +1,122 @@
+import asyncio
+import collections
+import dataclasses
+import datetime
+import heapq
+import inspect
+import os
+import sys
+import threading
+import time
+import traceback
+from types import FrameType
+from typing import Deque, List, Optional, Tuple
+
+import discord
+
+from utils import metrics
+
+LOOP_LAG = metrics.Histogram("nebu_loop_lag_seconds", "Delay of the event loop behind its schedule.",
+                             buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+LOOP_LAG_CURRENT = metrics.Gauge("nebu_loop_lag_current_seconds", "Latest event loop lag sample.")
+SLOW_CALLBACKS = metrics.Counter("nebu_slow_callbacks_total", "Callbacks that blocked the event loop.", ["name"])
+SLOW_CALLBACK_MAX = metrics.Gauge("nebu_slow_callback_max_seconds", "Longest event loop block seen so far.")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@dataclasses.dataclass(order=True)
+class SlowCallback:
+    duration: float
+    name: str = dataclasses.field(compare=False)
+    stack: str = dataclasses.field(compare=False)
+    occurred_at: datetime.datetime = dataclasses.field(compare=False)
+
+
+def describe_frame(frame: FrameType, *, limit: int = 30) -> Tuple[str, str]:
+    """Names a blocked stack by its outermost coroutine living in this repository."""
+    name = None
+    current = frame
+    while current is not None:
+        code = current.f_code
+        if code.co_flags & inspect.CO_COROUTINE and code.co_filename.startswith(ROOT):
+            name = getattr(code, "co_qualname", code.co_name)
+        current = current.f_back
+
+    if name is None:
+        name = getattr(frame.f_code, "co_qualname", frame.f_code.co_name)
+    return name, "".join(traceback.format_stack(frame, limit=limit))
+
+
+class LoopMonitor:
+    """Samples the event loop lag and records what was running whenever the loop was blocked.
+
+    A task wakes up every `interval` seconds and measures how late it was woken. A watchdog thread grabs the
+    stack of the loop thread when no wake up happened for longer than `threshold`, which is then attributed to the
+    stall once the loop recovers.
+    """
+    def __init__(self, *, interval: float = .25, threshold: float = .25, keep: int = 20):
+        self.interval = interval
+        self.threshold = threshold
+        self.keep = keep
+        self.worst: List[SlowCallback] = []
+        self.recent: Deque[SlowCallback] = collections.deque(maxlen=keep)
+        self.last_lag = 0.0
+        self._beat = time.monotonic()
+        self._captured: Optional[Tuple[str, str]] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        if self._task is not None:
+            return
+
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self.sampler())
+        self._thread = threading.Thread(target=self.watchdog, name="nebu-loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def sampler(self) -> None:
+        while True:
+            start = self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = self._beat = time.monotonic()
+            lag = max(now - start - self.interval, 0)
+            self.last_lag = lag
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_CURRENT.set(lag)
+            captured, self._captured = self._captured, None
+            if lag >= self.threshold:
+                name, stack = captured or ("<unknown>", "The loop recovered before its stack was captured.")
+                self.record(SlowCallback(lag, name, stack, discord.utils.utcnow()))
+
+    def watchdog(self) -> None:
+        while not self._stop.wait(self.threshold / 2):
+            stalled = time.monotonic() - self._beat > self.interval + self.threshold
+            if not stalled or self._captured is not None:
+                continue
+
+            if (frame := sys._current_frames().get(self._loop_thread)) is not None:
+                self._captured = describe_frame(frame)
+
+    def record(self, callback: SlowCallback) -> None:
+        self.recent.append(callback)
+        if len(self.worst) < self.keep:
+            heapq.heappush(self.worst, callback)
+        else:
+            heapq.heappushpop(self.worst, callback)
+        SLOW_CALLBACKS.inc(name=callback.name)
+        SLOW_CALLBACK_MAX.set(max(SLOW_CALLBACK_MAX.get(), callback.duration))
+
+    def worst_offenders(self) -> List[SlowCallback]:
+        return sorted(self.worst, reverse=True)
@@ -0,0 +1,171 @@
+import asyncio
+import collections
+import time
+from typing import Any, Deque, Dict, Iterable, Optional
+
+import asyncpg
+
+from utils import metrics
+
+POOL_CONNECTIONS = metrics.Gauge("nebu_pool_connections", "Connections of the asyncpg pool.", ["state"])
+POOL_WAITING = metrics.Gauge("nebu_pool_waiting", "Callers currently waiting for a pool connection.", ["lane"])
+POOL_WAIT_SECONDS = metrics.Histogram("nebu_pool_wait_seconds", "Time spent waiting for a pool connection.", ["lane"])
+POOL_LANE_IN_USE = metrics.Gauge("nebu_pool_lane_in_use", "Connections held by each lane of the pool.", ["lane"])
+
+# in order of priority, a freed connection goes to the first lane that has a waiter within its budget
+LANES = ("interactive", "ingestion", "backfill")
+# share of the pool each lane may hold at once
+LANE_SHARES = {"interactive": 1.0, "ingestion": .6, "backfill": .3}
+
+
+def lane_limits(size: int, overrides: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+    limits = {lane: max(int(size * share), 1) for lane, share in LANE_SHARES.items()}
+    for lane, limit in (overrides or {}).items():
+        if lane not in limits:
+            raise ValueError(f"Unknown pool lane {lane!r}, expected one of {', '.join(LANES)}")
+        limits[lane] = min(max(limit, 1), size)
+    return limits
+
+
+class LaneScheduler:
+    """Admits connection requests per lane, so background work cannot take the connections commands need.
+
+    Every lane holds at most its limit of the `size` connections. When a connection is released it is handed to the
+    waiter of the highest priority lane that is still within its budget, waiters of one lane are served in order.
+    """
+    def __init__(self, size: int, limits: Dict[str, int]):
+        self.free = size
+        self.limits = limits
+        self.in_use = dict.fromkeys(LANES, 0)
+        self.waiters: Dict[str, Deque[asyncio.Future]] = {lane: collections.deque() for lane in LANES}
+
+    def admissible(self, lane: str) -> bool:
+        return self.free > 0 and self.in_use[lane] < self.limits[lane]
+
+    def take(self, lane: str) -> None:
+        self.free -= 1
+        self.in_use[lane] += 1
+
+    async def admit(self, lane: str) -> None:
+        # admissible waiters are woken as soon as a connection frees up, a waiting lane is always over budget
+        if not self.waiters[lane] and self.admissible(lane):
+            self.take(lane)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[lane].append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(lane)
+            else:
+                self.waiters[lane].remove(future)
+            raise
+
+    def release(self, lane: str) -> None:
+        self.free += 1
+        self.in_use[lane] -= 1
+        for lane in LANES:
+            waiters = self.waiters[lane]
+            while waiters and self.admissible(lane):
+                future = waiters.popleft()
+                if not future.done():
+                    self.take(lane)
+                    future.set_result(None)
+
+
+class _PoolAcquire:
+    __slots__ = ("pool", "scheduler", "lane", "timeout", "connection")
+
+    def __init__(self, pool: asyncpg.Pool, scheduler: LaneScheduler, lane: str, timeout: Optional[float]):
+        self.pool = pool
+        self.scheduler = scheduler
+        self.lane = lane
+        self.timeout = timeout
+        self.connection = None
+
+    async def __aenter__(self) -> asyncpg.Connection:
+        POOL_WAITING.inc(lane=self.lane)
+        start = time.perf_counter()
+        try:
+            admission = self.scheduler.admit(self.lane)
+            await (admission if self.timeout is None else asyncio.wait_for(admission, self.timeout))
+            try:
+                self.connection = await self.pool.acquire(timeout=self.timeout)
+            except BaseException:
+                self.scheduler.release(self.lane)
+                raise
+        finally:
+            POOL_WAITING.dec(lane=self.lane)
+            POOL_WAIT_SECONDS.observe(time.perf_counter() - start, lane=self.lane)
+        return self.connection
+
+    async def __aexit__(self, *_: Any) -> None:
+        connection, self.connection = self.connection, None
+        try:
+            await self.pool.release(connection)
+        finally:
+            self.scheduler.release(self.lane)
+
+
+class PoolLane:
+    """The query methods of a `MeteredPool`, with every connection taken from one lane."""
+    def __init__(self, pool: "MeteredPool", name: str):
+        self.pool = pool
+        self.name = name
+
+    def acquire(self, *, timeout: Optional[float] = None) -> _PoolAcquire:
+        return self.pool.acquire(timeout=timeout, lane=self.name)
+
+    async def execute(self, query: str, *args: Any, timeout: Optional[float] = None) -> str:
+        async with self.acquire() as con:
+            return await con.execute(query, *args, timeout=timeout)
+
+    async def executemany(self, command: str, args: Iterable[Any], *, timeout: Optional[float] = None) -> None:
+        async with self.acquire() as con:
+            return await con.executemany(command, args, timeout=timeout)
+
+    async def fetch(self, query: str, *args: Any, timeout: Optional[float] = None) -> list:
+        async with self.acquire() as con:
+            return await con.fetch(query, *args, timeout=timeout)
+
+    async def fetchrow(self, query: str, *args: Any, timeout: Optional[float] = None) -> Optional[asyncpg.Record]:
+        async with self.acquire() as con:
+            return await con.fetchrow(query, *args, timeout=timeout)
+
+    async def fetchval(self, query: str, *args: Any, column: int = 0, timeout: Optional[float] = None) -> Any:
+        async with self.acquire() as con:
+            return await con.fetchval(query, *args, column=column, timeout=timeout)
+
+
+class MeteredPool(PoolLane):
+    """Wraps an asyncpg pool so connection wait time and usage are visible in the metrics.
+
+    Connections are taken from the interactive lane unless the caller goes through `lane`, see `LaneScheduler`.
+    """
+    def __init__(self, pool: asyncpg.Pool, *, lanes: Optional[Dict[str, int]] = None):
+        super().__init__(self, "interactive")
+        self._pool = pool
+        self.scheduler = LaneScheduler(pool.get_max_size(), lane_limits(pool.get_max_size(), lanes))
+        self._lanes = {lane: PoolLane(self, lane) for lane in LANES}
+        POOL_CONNECTIONS.set_function(pool.get_size, state="open")
+        POOL_CONNECTIONS.set_function(pool.get_max_size, state="max")
+        POOL_CONNECTIONS.set_function(lambda: pool.get_size() - pool.get_idle_size(), state="in_use")
+        for lane in LANES:
+            POOL_LANE_IN_USE.set_function(lambda lane=lane: self.scheduler.in_use[lane], lane=lane)
+
+    def lane(self, name: str) -> PoolLane:
+        return self._lanes[name]
+
+    def acquire(self, *, timeout: Optional[float] = None, lane: str = "interactive") -> _PoolAcquire:
+        return _PoolAcquire(self._pool, self.scheduler, lane, timeout)
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self._pool, item)
+
+    async def __aenter__(self) -> "MeteredPool":
+        return self
+
+    async def __aexit__(self, *_: Any) -> None:
+        await self._pool.close()
@@ -0,0 +1,147 @@
+import asyncio
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+from types import CodeType, FrameType
+from typing import Counter, Iterator, List, Optional
+
+from utils.monitor import ROOT
+
+_NULL_CONTEXT = contextlib.nullcontext()
+_WORKER_FILE = os.path.join("concurrent", "futures", "thread.py")
+
+
+def frame_label(code: CodeType) -> str:
+    filename = code.co_filename
+    if filename.startswith(ROOT):
+        filename = os.path.relpath(filename, ROOT)
+    elif "site-packages" in filename:
+        filename = filename.split("site-packages" + os.sep, 1)[1]
+    else:
+        filename = os.path.basename(filename)
+    name = getattr(code, "co_qualname", code.co_name)
+    # ';' separates frames in the collapsed format
+    return f"{name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+def walk_codes(frame: Optional[FrameType]) -> List[CodeType]:
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return codes
+
+
+class Profile:
+    """Result of a sampling session, either for a time window or for a number of invocations of a target."""
+    def __init__(self, target: Optional[str] = None, code: Optional[CodeType] = None, invocations: int = 0):
+        self.target = target
+        self.code = code
+        self.remaining = invocations
+        self.active = 0
+        self.stacks: Counter[str] = collections.Counter()
+        self.loop_samples = 0
+        self.executor_samples = 0
+        self.started_at = time.perf_counter()
+        self.elapsed = 0.0
+        self.finished = asyncio.Event()
+
+    @property
+    def recording(self) -> bool:
+        return self.target is None or self.active > 0
+
+    def add(self, kind: str, codes: List[CodeType]) -> None:
+        if kind == "loop":
+            self.loop_samples += 1
+        else:
+            self.executor_samples += 1
+        self.stacks[";".join([kind, *map(frame_label, codes)])] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def hottest(self, amount: int = 5) -> List[tuple]:
+        leaves: Counter[str] = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        return leaves.most_common(amount)
+
+
+class SamplingProfiler:
+    """Samples the stacks of the event loop thread and the executor threads from a background thread.
+
+    Loop samples only count when the profiled target is on the stack, executor samples count while the target is
+    running since the loop hands its blocking work to them.
+    """
+    def __init__(self, *, interval: float = .005):
+        self.interval = interval
+        self.profile: Optional[Profile] = None
+        self._loop_thread: Optional[int] = None
+
+    @property
+    def running(self) -> bool:
+        return self.profile is not None
+
+    def track(self, name: Optional[str]) -> contextlib.AbstractContextManager:
+        profile = self.profile
+        if profile is None or profile.target is None or profile.target != name:
+            return _NULL_CONTEXT
+        return self._tracking(profile)
+
+    @contextlib.contextmanager
+    def _tracking(self, profile: Profile) -> Iterator[None]:
+        profile.active += 1
+        try:
+            yield
+        finally:
+            profile.active -= 1
+            profile.remaining -= 1
+            if profile.remaining <= 0 and not profile.active:
+                profile.finished.set()
+
+    async def run(self, profile: Profile, *, duration: float) -> Profile:
+        """Samples until the target ran enough times or until `duration` runs out, whichever comes first."""
+        if self.profile is not None:
+            raise RuntimeError("A profile is already running.")
+
+        self._loop_thread = threading.get_ident()
+        self.profile = profile
+        stop = threading.Event()
+        thread = threading.Thread(target=self.sampler, args=(profile, stop), name="nebu-profiler", daemon=True)
+        thread.start()
+        try:
+            if profile.target is None:
+                await asyncio.sleep(duration)
+            else:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(profile.finished.wait(), timeout=duration)
+        finally:
+            self.profile = None
+            stop.set()
+            await asyncio.to_thread(thread.join)
+            profile.elapsed = time.perf_counter() - profile.started_at
+        return profile
+
+    def sampler(self, profile: Profile, stop: threading.Event) -> None:
+        own = threading.get_ident()
+        while not stop.wait(self.interval):
+            if not profile.recording:
+                continue
+
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                codes = walk_codes(frame)
+                if ident == self._loop_thread:
+                    if profile.code is None or profile.code in codes:
+                        profile.add("loop", codes)
+                elif names.get(ident, "").startswith(("asyncio", "ThreadPoolExecutor")):
+                    working = any(c.co_name == "run" and c.co_filename.endswith(_WORKER_FILE) for c in codes)
+                    if working:
+                        profile.add("executor", codes)
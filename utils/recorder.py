@@ -0,0 +1,66 @@
+import gzip
+import json
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+import discord
+
+RECORDED_EVENTS = ("MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE", "MESSAGE_DELETE_BULK")
+TRACE_DIRECTORY = os.path.join("data", "traces")
+
+
+class EventRecorder:
+    """Writes the raw gateway events consumed by PersonalCog into a gzip compressed JSON lines file.
+
+    The parsers of the connection state are swapped for the duration of the recording, every other event is left
+    untouched. The first line of the file describes the recording, every other line is `{"t", "at", "d"}` where `at`
+    is the offset in seconds since the recording started.
+    """
+    def __init__(self, bot: discord.Client):
+        self.bot = bot
+        self.path: Optional[str] = None
+        self.recorded = 0
+        self._file = None
+        self._started = 0.0
+        self._originals: Dict[str, Callable[[Any], None]] = {}
+
+    @property
+    def recording(self) -> bool:
+        return self._file is not None
+
+    def start(self, name: Optional[str] = None) -> str:
+        if self.recording:
+            raise RuntimeError("Already recording.")
+
+        os.makedirs(TRACE_DIRECTORY, exist_ok=True)
+        name = name or discord.utils.utcnow().strftime("%Y%m%d-%H%M%S")
+        self.path = os.path.join(TRACE_DIRECTORY, f"{name}.jsonl.gz")
+        self._file = gzip.open(self.path, "wt", compresslevel=6)
+        self._file.write(json.dumps({"version": 1, "events": RECORDED_EVENTS,
+                                     "started_at": discord.utils.utcnow().isoformat()}) + "\n")
+        self.recorded = 0
+        self._started = time.monotonic()
+        parsers = self.bot._connection.parsers
+        for event in RECORDED_EVENTS:
+            self._originals[event] = parsers[event]
+            parsers[event] = self._wrap(event, parsers[event])
+        return self.path
+
+    def _wrap(self, event: str, original: Callable[[Any], None]) -> Callable[[Any], None]:
+        def parser(data: Any) -> None:
+            self._file.write(json.dumps({"t": event, "at": round(time.monotonic() - self._started, 6), "d": data}))
+            self._file.write("\n")
+            self.recorded += 1
+            original(data)
+        return parser
+
+    def stop(self) -> str:
+        if not self.recording:
+            raise RuntimeError("Not recording.")
+
+        self.bot._connection.parsers.update(self._originals)
+        self._originals.clear()
+        self._file.close()
+        self._file = None
+        return self.path
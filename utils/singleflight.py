@@ -0,0 +1,41 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+from utils import metrics
+
+T = TypeVar("T")
+
+LOADS = metrics.Counter("nebu_loads_total", "Loads by key, shared when they joined one already in flight.",
+                        ["loader", "result"])
+
+
+class SingleFlight:
+    """Runs at most one load per key, concurrent callers of the same key wait for that load instead of starting one.
+
+    The load runs in its own task, a caller that is cancelled does not cancel it for the others.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def load(self, key: Hashable, loader: Callable[[], Awaitable[T]]) -> T:
+        if (flight := self._flights.get(key)) is not None:
+            LOADS.inc(loader=self.name, result="shared")
+        else:
+            LOADS.inc(loader=self.name, result="loaded")
+            flight = self._flights[key] = asyncio.ensure_future(loader())
+            flight.add_done_callback(lambda _: self._done(key, flight))
+        return await asyncio.shield(flight)
+
+    def _done(self, key: Hashable, flight: asyncio.Future) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.cancelled():
+            # marks the error as retrieved, every caller may have been cancelled before it was raised
+            flight.exception()
+
+    def __repr__(self) -> str:
+        return f"<SingleFlight name={self.name!r} in_flight={len(self)}>"
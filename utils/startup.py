@@ -0,0 +1,92 @@
+import contextlib
+import dataclasses
+import importlib
+import os
+import time
+import types
+from typing import Iterator, List, Optional
+
+import tabulate
+
+from utils import metrics
+
+STARTUP_SECONDS = metrics.Gauge("nebu_startup_phase_seconds",
+                                "Duration of each startup phase, or the offset of startup milestones.", ["phase"])
+
+
+def process_started() -> float:
+    """`time.monotonic()` of the moment the process started, falls back to now when /proc is not available."""
+    try:
+        with open("/proc/self/stat") as file:
+            # the command name can contain spaces, the fields after it are fixed
+            fields = file.read().rsplit(")", 1)[1].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.monotonic() - (time.clock_gettime(time.CLOCK_BOOTTIME) - started)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.monotonic()
+
+
+@dataclasses.dataclass
+class Phase:
+    name: str
+    offset: float
+    duration: Optional[float]
+
+
+class StartupTimeline:
+    """Phases of the startup with their offset from the start of the process.
+
+    Phases are timed with `phase`, milestones such as the gateway READY are recorded once with `mark`.
+    """
+    def __init__(self, origin: Optional[float] = None):
+        self.origin = process_started() if origin is None else origin
+        self.phases: List[Phase] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.monotonic())
+
+    def record(self, name: str, start: float, end: float) -> None:
+        self.phases.append(Phase(name, start - self.origin, end - start))
+        STARTUP_SECONDS.set(end - start, phase=name)
+
+    def mark(self, name: str) -> None:
+        if any(phase.name == name for phase in self.phases):
+            return
+
+        offset = time.monotonic() - self.origin
+        self.phases.append(Phase(name, offset, None))
+        STARTUP_SECONDS.set(offset, phase=name)
+
+    def report(self) -> str:
+        rows = [(phase.name, f"{phase.offset:.3f}s", "" if phase.duration is None else f"{phase.duration:.3f}s")
+                for phase in sorted(self.phases, key=lambda phase: phase.offset)]
+        return tabulate.tabulate(rows, headers=("Phase", "At", "Took"))
+
+
+class LazyModule:
+    """Stands in for a module that is only imported the first time one of its attributes is used."""
+    __slots__ = ("name", "_module")
+
+    def __init__(self, name: str):
+        self.name = name
+        self._module: Optional[types.ModuleType] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._module is not None
+
+    def load(self) -> types.ModuleType:
+        if self._module is None:
+            self._module = importlib.import_module(self.name)
+        return self._module
+
+    def __getattr__(self, item: str):
+        return getattr(self.load(), item)
+
+    def __repr__(self) -> str:
+        return f"<LazyModule name={self.name!r} loaded={self.loaded}>"
@@ -1,50 +1,156 @@
 import asyncio
 import itertools
 
+import discord
+from discord.ext import commands
+
+from utils import metrics
+
+STATUS_EDITS = metrics.Counter("nebu_status_edits_total", "Thinking status messages and edits by outcome.",
+                               ["kind", "result"])
+# the spinner is only sent for operations that are still running after this many seconds
+SPINNER_DELAY = 1.5
+
+
+class StatusEdits:
+    """Owns the edits of every Thinking message in flight, sharing a message edit budget per channel.
+
+    Status edits only keep the latest text of each message, older text waiting for the budget is dropped. They are
+    sent while more than `reserved` edits are left in the channel's window, so the final edits always have room and
+    are sent right away.
+    """
+    def __init__(self, *, rate=5, per=5.0, reserved=2):
+        self.reserved = reserved
+        self.buckets = commands.CooldownMapping.from_cooldown(rate, per, lambda channel: channel.id)
+        self.pending = {}
+        self.workers = {}
+
+    def update(self, thinking, content):
+        """Queues `content` as the next status of `thinking`, replacing the one still queued."""
+        if thinking.message is None:
+            thinking._thinking = content
+            return
+
+        pending = self.pending.setdefault(thinking.channel.id, {})
+        if thinking in pending:
+            STATUS_EDITS.inc(kind="status", result="dropped")
+        pending[thinking] = content
+        if thinking.channel.id not in self.workers:
+            self.workers[thinking.channel.id] = asyncio.create_task(self.send_edits(thinking.channel))
+
+    def discard(self, thinking):
+        pending = self.pending.get(thinking.channel.id, {})
+        if pending.pop(thinking, None) is not None:
+            STATUS_EDITS.inc(kind="status", result="dropped")
+
+    async def send_edits(self, channel):
+        try:
+            while pending := self.pending.get(channel.id):
+                bucket = self.buckets.get_bucket(channel)
+                if bucket.get_tokens() <= self.reserved:
+                    await asyncio.sleep(bucket.per / bucket.rate)
+                    continue
+
+                # the message waiting the longest goes first
+                thinking = next(iter(pending))
+                content = pending.pop(thinking)
+                bucket.update_rate_limit()
+                try:
+                    await thinking.message.edit(content=content)
+                except discord.HTTPException:
+                    STATUS_EDITS.inc(kind="status", result="failed")
+                else:
+                    STATUS_EDITS.inc(kind="status", result="sent")
+        finally:
+            self.workers.pop(channel.id, None)
+            if not self.pending.get(channel.id):
+                self.pending.pop(channel.id, None)
+
+    async def finish(self, thinking, **kwargs):
+        """Edits `thinking` into its result, ahead of any status edit."""
+        self.discard(thinking)
+        self.buckets.update_rate_limit(thinking.channel)
+        await thinking.message.edit(**kwargs)
+        STATUS_EDITS.inc(kind="final", result="sent")
+
+
+status_edits = StatusEdits()
+
 
 class Thinking:
     def __init__(self, channel, *, thinking="<a:typing:597589448607399949> Thinking", delete_after=False,
-                 random_messages=()):
+                 random_messages=(), spinner_delay=SPINNER_DELAY, scheduler=None):
         self.channel = channel
         self.random_messages = random_messages
         self.delete_after = delete_after
+        self.spinner_delay = spinner_delay
+        self.scheduler = scheduler or status_edits
         self._thinking = thinking
         self.__kwargs_set = None
         self.__done = False
+        self.__sending = False
         self.message = None
         self.task = None
+        self.spinner = None
 
     async def __aenter__(self):
-        self.message = await self.channel.send(self._thinking)
+        self.spinner = asyncio.create_task(self.send_spinner())
         if self.random_messages:
             self.task = asyncio.create_task(self.random_interaction())
         return self
 
+    async def send_spinner(self):
+        await asyncio.sleep(self.spinner_delay)
+        self.__sending = True
+        self.message = await self.channel.send(self._thinking)
+        STATUS_EDITS.inc(kind="spinner", result="sent")
+
     async def random_interaction(self):
         for i, message in enumerate(itertools.cycle(self.random_messages)):
             await asyncio.sleep(5)
-            await self.message.edit(content=message)
+            self.scheduler.update(self, message)
             if i > 35:
                 break  # terminate after 3 minutes
 
     async def set_thinking(self, thinking):
-        await self.message.edit(content=thinking)
+        self.scheduler.update(self, thinking)
 
     def set(self, /, **kwargs):
         self.__kwargs_set = kwargs
         self.__done = True
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.delete_after:
-            await self.message.delete(delay=0)
-
         if self.task:
             self.task.cancel()
 
-        if not self.__done:
-            await self.message.edit(content=f"<:crossmark:753620331851284480>")
+        if not self.__sending:
+            self.spinner.cancel()
+            STATUS_EDITS.inc(kind="spinner", result="skipped")
+        else:
+            # a spinner being sent can't be taken back, the result replaces it once it's there
+            try:
+                await self.spinner
+            except discord.HTTPException:
+                pass
+        self.scheduler.discard(self)
+
+        if self.delete_after:
+            if self.message is not None:
+                await self.message.delete(delay=0)
             return
-        if not self.__kwargs_set:
-            await self.message.edit(content=f"<:checkmark:753619798021373974> Done")
+
+        if not self.__done:
+            kwargs = {"content": "<:crossmark:753620331851284480>"}
+        elif not self.__kwargs_set:
+            kwargs = {"content": "<:checkmark:753619798021373974> Done"}
+        else:
+            kwargs = self.__kwargs_set
+
+        if self.message is None:
+            if not self.__done:
+                # nothing was sent for a quick failure, the error handler already replies
+                return
+            self.message = await self.channel.send(**kwargs)
+            STATUS_EDITS.inc(kind="final", result="sent")
         else:
-            await self.message.edit(**self.__kwargs_set)
+            await self.scheduler.finish(self, **kwargs)